@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+Asset url helper micro-benchmark.
+
+Times the helpers that rewrite static asset urls for the CDN, as a product
+grid page calls them hundreds of times per render.
+
+    PYTHONPATH=. python benchmarks/bench_assets.py [--number 100000]
+'''
+import argparse
+import timeit
+import pybald
+pybald.configure(config_object=dict(debug=False, cache_path=None,
+                                    project_name='bench', USE_CDN=True,
+                                    CDN_HOST='cdn.example.com',
+                                    STATIC_HOSTS=['s0.example.com',
+                                                  's1.example.com'],
+                                    STATIC_SOURCES=['example.com']))
+from routes import request_config
+from pybald.core import page
+from pybald.core.helpers import img, AssetUrl
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=100000)
+    options = parser.parse_args()
+    request_config().protocol = 'http'
+    cases = (('AssetUrl', lambda: str(AssetUrl('/img/product.jpg'))),
+             ('img', lambda: img('/img/product.jpg').__html__()),
+             ('add_js', lambda: page.add_js('/js/app.js')))
+    for label, call in cases:
+        call()
+        seconds = min(timeit.repeat(call, number=options.number,
+                                    repeat=3)) / options.number
+        print("{0:<10} {1:8.2f} us/call".format(label, seconds * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+Dispatch micro-benchmark.
+
+Times a request through the Router to a pybald action that returns a short
+string, so almost all of the time is routing and dispatch overhead.
+
+    PYTHONPATH=. python benchmarks/bench_dispatch.py [--routes 900] [--number 20000]
+'''
+import argparse
+import timeit
+import pybald
+pybald.configure(config_object=dict(debug=False, cache_path=None,
+                                    project_name='bench'))
+from webob import Request
+from pybald.core.router import Router
+from pybald.core.controllers import Controller, action
+
+
+class BenchController(Controller):
+    @action
+    def index(self, req):
+        return u"index"
+
+    @action
+    def show(self, req):
+        return u"show {0}".format(self.item_id)
+
+
+def make_map(route_count):
+    def map(urls):
+        for index in range(route_count):
+            urls.connect('filler{0}'.format(index),
+                         r'/filler{0}/{{item_id}}'.format(index),
+                         controller='bench', action='show')
+        urls.connect('home', r'/', controller='bench', action='index')
+        urls.connect('show', r'/items/{item_id}', controller='bench',
+                     action='show')
+    return map
+
+
+def run(app, path, number):
+    environ = Request.blank(path).environ
+
+    def start_response(status, headers, exc_info=None):
+        pass
+
+    def request():
+        app(dict(environ), start_response)
+    # warm up
+    request()
+    return min(timeit.repeat(request, number=number, repeat=3)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--routes', type=int, default=900)
+    parser.add_argument('--number', type=int, default=20000)
+    options = parser.parse_args()
+    routes = make_map(options.routes)
+    for label, kargs in (('default', {}),
+                         ('compile_routes', dict(compile_routes=True))):
+        app = Router(routes=routes, controllers=[BenchController], **kargs)
+        for path in ('/', '/items/12'):
+            seconds = run(app, path, options.number)
+            print("{0:<16} {1:<10} {2:8.2f} us/request".format(
+                  label, path, seconds * 1e6))
+
+
+if __name__ == "__main__":
+    main()
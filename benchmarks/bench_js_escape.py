@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+js_escape micro-benchmark.
+
+Times escaping 100 KB inputs for inline scripts with the current escaper,
+the original replace per escape and a str.translate table, and escaping
+many short values one at a time and with ``js_escape_many``.
+
+    PYTHONPATH=. python benchmarks/bench_js_escape.py [--number 50]
+'''
+import argparse
+import json
+import random
+import timeit
+from pybald.core.helpers import _js_escapes, js_escape, js_escape_many
+
+SIZE = 100 * 1024
+translate_table = dict((ord(bad), good) for bad, good in _js_escapes)
+
+
+def replace_escape(value):
+    for bad, good in _js_escapes:
+        value = value.replace(bad, good)
+    return value
+
+
+def translate_escape(value):
+    return value.translate(translate_table)
+
+
+def inputs():
+    rand = random.Random(1)
+    words = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+             "eiusmod tempor").split()
+    records = [{'id': index,
+                'title': ' '.join(rand.choice(words) for _ in range(8)),
+                'body': ' '.join(rand.choice(words) for _ in range(40))}
+               for index in range(400)]
+    markup = [{'id': index, 'name': u"Product <{0}> & 'friends'".format(index),
+               'note': u'a-b;c=d\n'} for index in range(1500)]
+    return (('json', json.dumps(records)[:SIZE]),
+            ('json markup', json.dumps(markup)[:SIZE]),
+            ('plain text', (u'The quick brown fox jumps over the lazy dog. ' *
+                            2300)[:SIZE]),
+            ('cjk text', (u'中文文本 ' * 30000)[:SIZE]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=50)
+    options = parser.parse_args()
+    escapers = (('js_escape', js_escape),
+                ('replace', replace_escape),
+                ('translate', translate_escape))
+    for name, value in inputs():
+        for label, escaper in escapers:
+            assert escaper(value) == js_escape(value)
+            seconds = min(timeit.repeat(lambda: escaper(value),
+                                        number=options.number,
+                                        repeat=3)) / options.number
+            print("{0:<12} {1:<10} {2:8.3f} ms".format(name, label,
+                                                       seconds * 1e3))
+
+    values = [u"<b>'{0}'</b>".format(index) for index in range(5000)]
+    cases = (('one by one', lambda: [js_escape(value) for value in values]),
+             ('js_escape_many', lambda: js_escape_many(values)))
+    for label, call in cases:
+        seconds = min(timeit.repeat(call, number=options.number,
+                                    repeat=3)) / options.number
+        print("{0:<12} {1:<15} {2:8.3f} ms".format('5000 values', label,
+                                                   seconds * 1e3))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+Template render micro-benchmark.
+
+Renders a small template through the template engine with a large
+``page_options`` config and a controller sized data dictionary, so most of
+the time is spent setting up the render rather than in the template.
+
+    PYTHONPATH=. python benchmarks/bench_render.py [--options 500] [--number 20000]
+'''
+import argparse
+import timeit
+import pybald
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--options', type=int, default=500)
+    parser.add_argument('--number', type=int, default=20000)
+    options = parser.parse_args()
+    page_options = dict(('option{0}'.format(index), index)
+                        for index in range(options.options))
+    page_options['site_name'] = u'bench'
+    pybald.configure(config_object=dict(debug=False, cache_path=None,
+                                        project_name='bench',
+                                        page_options=page_options))
+    from pybald import context
+    data = dict(('attribute{0}'.format(index), index) for index in range(20))
+    data['title'] = u'A page'
+    template = u'<h1>${title}</h1><p>${site_name}</p>'
+
+    def render():
+        context.render.raw_template(template, data)
+    # warm up (and compile the template)
+    render()
+    seconds = min(timeit.repeat(render, number=options.number,
+                                repeat=3)) / options.number
+    print("{0} page options {1:8.2f} us/render".format(options.options,
+                                                       seconds * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -82,8 +82,15 @@ from pybald.core.templates import TemplateEngine
 from pybald.util.command_line import start
 from pybald.core.models import ContextBoundModels
 from pybald.db.db_engine import create_dump_engine
+from pybald.util.cache import MemoryCache
+from pybald.core.tasks import TaskPool
+from pybald.util.assets import load_manifest
 
 render = TemplateEngine()
+action_cache = MemoryCache(config.action_cache_size)
+background_tasks = TaskPool(config.background_workers,
+                            config.background_queue_size)
+asset_manifest = load_manifest(config)
 dump_engine = create_dump_engine()
 if config.database_engine_uri:
     models = ContextBoundModels()
@@ -0,0 +1,442 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+ASGI support for pybald applications.
+
+The ASGI adapter serves the same url map and controllers as the WSGI stack
+from an asyncio event loop. Controller actions can be ``async def`` methods
+that run on the event loop (useful for long-polling or waiting on slow
+upstream services without tying up a thread) while regular, synchronous
+actions and any other blocking work run on a bounded thread pool.
+
+Inside the adapter the pipeline uses an *async WSGI* calling convention,
+``await app(environ, start_response)``, so the async middleware in
+:mod:`pybald.core.middleware.asgi` can be stacked just like their WSGI
+equivalents:
+
+.. sourcecode:: python
+
+    from pybald.core.asgi import ASGIAdapter, AsyncRouter
+    from pybald.core.middleware.asgi import AsyncErrorMiddleware
+
+    app = Router(routes=map, controllers=context.controller_registry)
+    app = AsyncRouter(app)
+    app = AsyncErrorMiddleware(app)
+    app = ASGIAdapter(app, max_workers=20)
+
+The ASGI adapter and async middleware require Python 3.7 or newer, the rest
+of pybald doesn't import them.
+
+Routes keeps its ``request_config`` in a thread local, so async actions
+should build urls with the ``url_for`` assigned to the controller rather than
+the module level Routes ``url_for``.
+'''
+import asyncio
+import io
+import sys
+from contextvars import copy_context
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+from inspect import iscoroutinefunction
+from timeit import default_timer
+from mako import exceptions
+from webob import Response, exc
+from pybald import context
+from pybald.util.context import request_scope
+import logging
+log = logging.getLogger(__name__)
+
+
+def is_async_app(app):
+    '''Return True if app is an async WSGI callable (an ``async def``
+    function or an object with an ``async def __call__``).'''
+    return (iscoroutinefunction(app) or
+            iscoroutinefunction(getattr(app, '__call__', None)))
+
+
+def _run_in_request(environ, func, pargs, kargs):
+    '''Set up the per-thread request state and call func.'''
+    router = environ.get('pybald.router')
+    if router is not None and 'wsgiorg.routing_args' in environ:
+        router.bind_request_config(environ)
+    return func(*pargs, **kargs)
+
+
+async def run_sync(environ, func, *pargs, **kargs):
+    '''
+    Run blocking code for a request on the adapter's thread pool.
+
+    :param environ: The request environ, used to find the thread pool and to
+                    set up the thread local request state for the call.
+    :param func: The function to call with any additional arguments.
+
+    The call runs in a copy of the current context so the request scope
+    (and so the request's database session) follows it into the thread.
+    '''
+    executor = environ.get('pybald.executor')
+    loop = asyncio.get_event_loop()
+    call = partial(copy_context().run, _run_in_request, environ, func,
+                   pargs, kargs)
+    return await loop.run_in_executor(executor, call)
+
+
+async def call_application(app, environ, start_response):
+    '''
+    Call the next application in an async pipeline.
+
+    Async applications are awaited on the event loop, plain WSGI
+    applications are called on the thread pool. Either way the response
+    body is returned as it is, it's read a chunk at a time when the
+    response is sent (see ``iter_body``).
+    '''
+    if is_async_app(app):
+        return await app(environ, start_response)
+    return await run_sync(environ, app, environ, start_response)
+
+
+class ResponseBody(object):
+    '''A response body made of chunks already written followed by the rest
+    of the application's body, which is closed with it.'''
+    def __init__(self, written, chunks, app_iter):
+        self.written = written
+        self.chunks = chunks
+        self.app_iter = app_iter
+
+    def __iter__(self):
+        for chunk in self.written:
+            yield chunk
+        for chunk in self.chunks:
+            yield chunk
+
+    def close(self):
+        close = getattr(self.app_iter, 'close', None)
+        if close is not None:
+            close()
+
+
+async def close_body(environ, app_iter):
+    '''Close a response body on the thread pool, closing a generator can
+    run application code.'''
+    close = getattr(app_iter, 'close', None)
+    if close is not None:
+        await run_sync(environ, close)
+
+
+async def iter_body(environ, app_iter):
+    '''
+    Iterate over a response body from the event loop.
+
+    Lists and tuples are already in memory, any other body (a generator
+    action, a streamed template or JSON response) is advanced one chunk at a
+    time on the thread pool so producing it never blocks the loop. The body
+    is not closed, see ``close_body``.
+    '''
+    if isinstance(app_iter, (list, tuple)):
+        for chunk in app_iter:
+            yield chunk
+        return
+    iterator = await run_sync(environ, iter, app_iter)
+    done = object()
+    while True:
+        chunk = await run_sync(environ, next, iterator, done)
+        if chunk is done:
+            return
+        yield chunk
+
+
+async def get_response(app, environ):
+    '''Call an application in an async pipeline and return the result as a
+    WebOb Response, the async equivalent of ``Request.get_response``. The
+    body isn't read.'''
+    captured = {}
+
+    def start_response(status, headers, exc_info=None):
+        captured['status'] = status
+        captured['headers'] = headers
+        return lambda data: captured.setdefault('written', []).append(data)
+
+    body = await call_application(app, environ, start_response)
+    chunks = body
+    written = captured.get('written', [])
+    if 'status' not in captured:
+        # a generator application calls start_response when it's first
+        # advanced
+        try:
+            chunks = await run_sync(environ, iter, body)
+            first = await run_sync(environ, next, chunks, None)
+        except BaseException:
+            await close_body(environ, body)
+            raise
+        written = captured.get('written', []) + [first or b'']
+    return Response(status=captured['status'],
+                    headerlist=list(captured['headers']),
+                    app_iter=(ResponseBody(written, chunks, body)
+                              if written else body))
+
+
+def async_action(method, template_name):
+    '''
+    Wrap an ``async def`` controller method as an asynchronous pybald action.
+
+    This behaves like the ``action`` decorator (which calls this for async
+    methods): ``_pre`` and ``_post`` hooks still run and returning nothing
+    renders the default view. Hooks and the view render are synchronous so
+    they run on the thread pool.
+    '''
+    from pybald.core.controllers import bind_request, as_response, noop_func
+    from pybald.core.tasks import submit_tasks
+
+    @wraps(method)
+    async def action_wrapper(self, environ, start_response):
+        req = bind_request(self, environ, template_name)
+
+        # set pre/post/view to a no-op if they don't exist
+        pre = getattr(self, '_pre', noop_func)
+        post = getattr(self, '_post', noop_func)
+
+        resp = await run_sync(environ, pre, req)
+        if not resp:
+            resp = await method(self, req)
+        if not resp:
+            resp = await run_sync(environ, context.render,
+                                  template=self.template_id,
+                                  data=self.__dict__ or {})
+        resp = as_response(resp)
+        await run_sync(environ, post, req, resp)
+        tasks = self.__dict__.get('_after_response_tasks')
+        if tasks:
+            submit_tasks(environ, tasks)
+        return resp(environ, start_response)
+    return action_wrapper
+
+
+def async_action_cached(action_method, bind_hooks, use_cache):
+    '''The ``action_cached`` wrapper for async actions.'''
+    @wraps(action_method)
+    async def replacement(self, environ, start_response):
+        if use_cache(environ):
+            bind_hooks(self)
+        return await action_method(self, environ, start_response)
+    return replacement
+
+
+class AsyncRouter(object):
+    '''
+    Async pipeline wrapper around a pybald Router.
+
+    :param router: The Router to dispatch with.
+
+    Matching happens on the event loop, async actions are awaited and
+    synchronous actions are run on the thread pool.
+    '''
+    def __init__(self, router):
+        self.router = router
+
+    def __repr__(self):
+        return "<AsyncRouter {0!r}>".format(self.router)
+
+    async def dispatch(self, environ, start_response):
+        handler = self.router.resolve(environ)
+        try:
+            return await call_application(handler, environ, start_response)
+        # This is a mako 'missing template' exception
+        except exceptions.TopLevelLookupException:
+            raise exc.HTTPNotFound("Missing Template")
+
+    async def __call__(self, environ, start_response):
+        metrics = self.router.metrics
+        if metrics is None:
+            return await self.dispatch(environ, start_response)
+        if environ['PATH_INFO'] == self.router.metrics_path:
+            return metrics(environ, start_response)
+
+        statuses = []
+
+        def recording_start_response(status, headers, exc_info=None):
+            statuses.append(status)
+            return start_response(status, headers, exc_info)
+
+        start = default_timer()
+        error = False
+        try:
+            return await self.dispatch(environ, recording_start_response)
+        except exc.HTTPException as err:
+            error = getattr(err, 'code', 500) >= 500
+            raise
+        except Exception:
+            error = True
+            raise
+        finally:
+            if statuses and statuses[-1][:1] == '5':
+                error = True
+            metrics.record(self.router.route_name(environ),
+                           default_timer() - start, error)
+
+
+def build_environ(scope, body):
+    '''Build a WSGI environ from an ASGI http scope and request body.'''
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    # WSGI paths are the url decoded bytes as latin-1 strings
+    path = scope['path'].encode('utf-8').decode('latin-1')
+    root_path = scope.get('root_path', '').encode('utf-8').decode('latin-1')
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path,
+        'PATH_INFO': path,
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'REMOTE_ADDR': client[0],
+        'SERVER_PROTOCOL': 'HTTP/{0}'.format(scope.get('http_version',
+                                                       '1.1')),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+        'asgi.scope': scope,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+            continue
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = 'HTTP_' + name
+        if key in environ:
+            value = environ[key] + ',' + value
+        environ[key] = value
+    return environ
+
+
+async def wait_for_disconnect(receive):
+    '''Wait for the client to disconnect.'''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+class ASGIAdapter(object):
+    '''
+    An ASGI application serving a pybald pipeline.
+
+    :param application: The async pipeline to serve (e.g. an ``AsyncRouter``
+                        wrapped in async middleware). A plain WSGI
+                        application also works, it is run entirely on the
+                        thread pool.
+    :param max_workers: The size of the thread pool used for synchronous
+                        actions and other blocking work.
+
+    Each request is given its own request scope (see
+    ``pybald.util.context.request_scope``) so per-request database sessions
+    follow the request from the event loop to the thread pool and back.
+    Response bodies are streamed, each chunk is produced on the thread pool
+    and sent as it's ready. If the client disconnects the request is
+    cancelled and the body closed.
+    The thread pool (and the ``context.background_tasks`` pool) is drained
+    when the server sends the lifespan shutdown event.
+    '''
+    def __init__(self, application, max_workers=10):
+        self.application = application
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def __repr__(self):
+        return "<ASGIAdapter {0!r}>".format(self.application)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError("Unsupported ASGI scope type "
+                             "{0}".format(scope['type']))
+
+        body = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.append(message.get('body', b''))
+            more_body = message.get('more_body', False)
+        environ = build_environ(scope, b''.join(body))
+        environ['pybald.executor'] = self.executor
+
+        token = request_scope.set(object())
+        # the request is abandoned if the client goes away, so long polls
+        # don't run to completion for nobody
+        disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+        try:
+            resp = await self.respond(environ, disconnected)
+            if resp is not None:
+                await self.send_response(environ, resp, send, disconnected)
+        finally:
+            disconnected.cancel()
+            request_scope.reset(token)
+
+    async def respond(self, environ, disconnected):
+        '''Run the application for a request, returning its Response or None
+        if the client disconnected first.'''
+        response = asyncio.ensure_future(self.get_response(environ))
+        await asyncio.wait((response, disconnected),
+                           return_when=asyncio.FIRST_COMPLETED)
+        if not response.done():
+            log.debug("Client disconnected, cancelling "
+                      "{0}".format(environ['PATH_INFO']))
+            response.cancel()
+            return None
+        return response.result()
+
+    async def get_response(self, environ):
+        try:
+            return await get_response(self.application, environ)
+        # HTTP exceptions are also WSGI apps, anything else is a fault
+        except exc.HTTPException as err:
+            return await get_response(err, environ)
+        except Exception:
+            log.exception("General Exception thrown")
+            return await get_response(exc.HTTPServerError('General Fault'),
+                                      environ)
+
+    async def send_response(self, environ, resp, send, disconnected):
+        '''Send a response, reading its body a chunk at a time and closing
+        it when done or when the client disconnects.'''
+        app_iter = resp.app_iter
+        try:
+            await send({'type': 'http.response.start',
+                        'status': resp.status_code,
+                        'headers': [(name.lower().encode('latin-1'),
+                                     value.encode('latin-1'))
+                                    for name, value in resp.headerlist]})
+            async for chunk in iter_body(environ, app_iter):
+                if disconnected.done():
+                    return
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk,
+                                'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            await close_body(environ, app_iter)
+
+    async def lifespan(self, receive, send):
+        '''Handle the ASGI lifespan protocol, draining the thread pool on
+        shutdown.'''
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                loop = asyncio.get_event_loop()
+                await loop.run_in_executor(None, self.executor.shutdown)
+                await loop.run_in_executor(None,
+                                           context.background_tasks.shutdown)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+Static asset bundles.
+
+Wrap the scripts or stylesheets of a page in a ``<bundle>`` inside a block
+filtered with ``assets.bundle`` and, when ``BUNDLE_ASSETS`` is on, they're
+served as a single minified file:
+
+.. code-block:: mako
+
+    <%block name="css" filter="assets.bundle">
+    <bundle filters="cssmin">
+    ${page.add_css('/css/reset.css')}
+    ${page.add_css('/css/site.css')}
+    </bundle>
+    </%block>
+
+The bundle is written under ``BUNDLE_OUTPUT_PATH`` in the static path, named
+after a hash of the filters and the contents of its files, so changed files
+get a new bundle url. Bundles are built on first use (``BUNDLE_AUTO_BUILD``)
+or ahead of time with ``python app.py assets``.
+
+With ``BUNDLE_ASSETS`` off the files are linked individually, as written.
+'''
+import hashlib
+import os
+import re
+from six.moves.urllib.parse import urlparse
+from pybald import context
+from pybald.core.helpers import HTMLLiteral, asset_url
+from pybald.util.assets import hash_file
+from pybald.util.cache import LRUCache
+import logging
+log = logging.getLogger(__name__)
+
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+BUNDLE_PATTERN = re.compile(r'<bundle(?:\s+filters="(?P<filters>[^"]*)")?\s*>'
+                            r'(?P<body>.*?)</bundle>', re.S)
+TAG_PATTERN = re.compile(r'<script\b[^>]*?\ssrc="(?P<src>[^"]+)"[^>]*>\s*'
+                         r'</script>|<link\b(?P<attributes>[^>]*?)'
+                         r'\shref="(?P<href>[^"]+)"[^>]*>', re.S)
+MEDIA_PATTERN = re.compile(r'\smedia="([^"]*)"')
+FILTER_SEPARATOR = re.compile(r'[\s,]+')
+# literal add_js/add_css calls in template source, for prebuilding bundles
+HELPER_PATTERN = re.compile(r'''add_(?P<kind>js|css)\(\s*(?P<quote>['"])'''
+                            r'''(?P<path>[^'"]+)(?P=quote)''')
+
+# strings and comments of a stylesheet, comments are removed first
+CSS_STRING = r'''("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')'''
+CSS_COMMENTS = re.compile(CSS_STRING + r'|/\*.*?\*/', re.S)
+# then whitespace around punctuation is removed, strings are kept
+CSS_TOKENS = re.compile(CSS_STRING +
+                        r'''|\s*;\s*(})\s*'''
+                        r'''|\s*([{};,>])\s*'''
+                        r'''|(:)\s+'''
+                        r'''|\s+''', re.S)
+
+# the body of a bundle -> its replacement, see bundle_pieces
+bundle_cache = LRUCache(256)
+
+
+def _css_token(match):
+    string, close, punctuation, colon = match.groups()
+    return string or close or punctuation or colon or ' '
+
+
+def css_minify(text):
+    '''Minify a stylesheet, with rcssmin when it's installed.'''
+    if rcssmin is not None:
+        return rcssmin.cssmin(text)
+    text = CSS_COMMENTS.sub(lambda match: match.group(1) or '', text)
+    return CSS_TOKENS.sub(_css_token, text).strip()
+
+
+def js_minify(text):
+    '''Minify a script with rjsmin. Without rjsmin installed scripts are
+    only concatenated.'''
+    if rjsmin is not None:
+        return rjsmin.jsmin(text)
+    return text
+
+
+# the filters a bundle can name, projects can add their own
+BUNDLE_FILTERS = {'cssmin': css_minify,
+                  'rcssmin': css_minify,
+                  'jsmin': js_minify,
+                  'rjsmin': js_minify}
+
+# how the files of a bundle are joined, newlines end any trailing comments
+SEPARATORS = {'css': u'\n', 'js': u'\n;\n'}
+
+
+def split_filters(filters):
+    '''Filter names can be comma or space separated.'''
+    return tuple(name for name in FILTER_SEPARATOR.split(filters or '')
+                 if name)
+
+
+def static_root(config):
+    return os.path.join(config.path, config.static_path)
+
+
+def local_path(url, config):
+    '''Return the static file a url refers to, or None if it isn't one of
+    ours.'''
+    parsed = urlparse(url)
+    if parsed.netloc:
+        hosts = set(config.STATIC_SOURCES or ())
+        hosts.update(getattr(config, 'STATIC_HOSTS', None) or ())
+        hosts.add(getattr(config, 'CDN_HOST', None))
+        if parsed.netloc not in hosts:
+            return None
+    path = os.path.join(static_root(config), parsed.path.lstrip('/'))
+    if not os.path.isfile(path):
+        log.warning("Can't bundle {0}, {1} doesn't exist".format(url, path))
+        return None
+    return path
+
+
+def build_bundle(kind, paths, filters, config, build=True):
+    '''
+    Return the url of the bundle of files, building it if necessary.
+
+    :param kind: 'js' or 'css'.
+    :param paths: The paths of the files to bundle, in order.
+    :param filters: The names of the ``BUNDLE_FILTERS`` to apply.
+    :param config: The application config.
+    :param build: If False, return None rather than building a bundle that
+                  doesn't exist yet.
+    '''
+    for name in filters:
+        if name not in BUNDLE_FILTERS:
+            raise ValueError("Unknown bundle filter {0}".format(name))
+    digest = hashlib.md5(u' '.join(filters).encode('utf-8'))
+    for path in paths:
+        digest.update(hash_file(path).encode('utf-8'))
+    filename = "{0}.{1}".format(digest.hexdigest()[:12], kind)
+    output_path = config.BUNDLE_OUTPUT_PATH.strip('/')
+    url = '/{0}/{1}'.format(output_path, filename).replace('//', '/')
+    bundle_path = os.path.join(static_root(config), output_path, filename)
+    if os.path.exists(bundle_path):
+        return url
+    if not build:
+        return None
+
+    contents = []
+    for path in paths:
+        with open(path, 'rb') as asset_file:
+            contents.append(asset_file.read().decode('utf-8'))
+    text = SEPARATORS[kind].join(contents)
+    for name in filters:
+        text = BUNDLE_FILTERS[name](text)
+
+    directory = os.path.dirname(bundle_path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    # write then rename so other processes never serve half a bundle
+    temp_path = "{0}.{1}.tmp".format(bundle_path, os.getpid())
+    with open(temp_path, 'wb') as bundle_file:
+        bundle_file.write(text.encode('utf-8'))
+    os.rename(temp_path, bundle_path)
+    log.debug("Built bundle {0} from {1} files".format(url, len(paths)))
+    return url
+
+
+def bundle_tag(kind, url, media):
+    if kind == 'js':
+        return u'<script src="{0}"></script>'.format(asset_url(url))
+    return (u'<link type="text/css" href="{0}" media="{1}" '
+            u'rel="stylesheet">'.format(asset_url(url), media))
+
+
+def bundle_pieces(filters, body, config):
+    '''
+    Work out the replacement for the body of a bundle: a list of the tags
+    that can't be bundled, kept as they are, and (kind, url, media) tuples
+    for the bundle of each kind of asset, in the place of its first file.
+
+    Returns None if a bundle isn't built and auto building is off.
+    '''
+    pieces = []
+    # kind -> [index of the bundle in pieces, paths, media]
+    kinds = {}
+    for match in TAG_PATTERN.finditer(body):
+        kind = 'js' if match.group('src') else 'css'
+        path = local_path(match.group('src') or match.group('href'), config)
+        if path is None:
+            pieces.append(match.group(0))
+            continue
+        if kind not in kinds:
+            media = MEDIA_PATTERN.search(match.group('attributes') or '')
+            kinds[kind] = [len(pieces), [], media.group(1) if media
+                           else 'screen']
+            pieces.append(None)
+        kinds[kind][1].append(path)
+
+    for kind, (index, paths, media) in kinds.items():
+        url = build_bundle(kind, paths, filters, config,
+                           build=config.BUNDLE_AUTO_BUILD)
+        if url is None:
+            log.warning("The bundle of {0} isn't built".format(paths))
+            return None
+        pieces[index] = (kind, url, media)
+    return pieces
+
+
+def render_bundle(filters, body, config):
+    '''Replace the tags in the body of a bundle with a tag for each kind of
+    asset.'''
+    # the body includes the asset tags of the files, so it changes when
+    # they do
+    key = (static_root(config), filters, body)
+    pieces = bundle_cache.get(key)
+    if pieces is None:
+        pieces = bundle_pieces(filters, body, config)
+        if pieces is None:
+            return body
+        bundle_cache.set(key, pieces)
+    # tags are made for every render, the CDN host depends on the request
+    return u'\n'.join(piece if not isinstance(piece, tuple)
+                       else bundle_tag(*piece) for piece in pieces)
+
+
+def bundle(text):
+    '''
+    The Mako filter that bundles the assets listed in ``<bundle>`` tags.
+
+    Each ``<bundle filters="...">`` is replaced by a single script and/or
+    stylesheet tag for a file combining the ones it lists, with the named
+    ``BUNDLE_FILTERS`` applied. Bundled files are found by their url under
+    the static path, tags for other urls are left alone.
+    '''
+    config = context.config
+    if not config.BUNDLE_ASSETS:
+        return HTMLLiteral(BUNDLE_PATTERN.sub(
+                                lambda match: match.group('body'), text))
+    return HTMLLiteral(BUNDLE_PATTERN.sub(
+                lambda match: render_bundle(split_filters(
+                                                match.group('filters')),
+                                            match.group('body'), config),
+                text))
+
+
+def find_bundles(template_text):
+    '''Return the (filters, [(kind, url path)]) of the bundles in a
+    template's source that list their files with literal ``page.add_js``
+    and ``page.add_css`` calls.'''
+    bundles = []
+    for match in BUNDLE_PATTERN.finditer(template_text):
+        assets = [(helper.group('kind'), helper.group('path'))
+                  for helper in HELPER_PATTERN.finditer(match.group('body'))]
+        if assets:
+            bundles.append((split_filters(match.group('filters')), assets))
+    return bundles
+
+
+def prebuild_bundles(directories, config):
+    '''
+    Build the bundles listed in the templates under the directories.
+
+    Bundles that list their files with anything other than literal urls
+    can't be found ahead of time, they're built on first use. Returns the
+    urls of the bundles.
+    '''
+    from pybald.util.precompile import find_templates
+    urls = []
+    seen = set()
+    for uri in find_templates(directories):
+        for directory in directories:
+            template_path = os.path.join(directory, uri.lstrip('/'))
+            if os.path.isfile(template_path):
+                break
+        with open(template_path, 'rb') as template_file:
+            template_text = template_file.read().decode('utf-8')
+        for filters, assets in find_bundles(template_text):
+            for kind in ('css', 'js'):
+                paths = [local_path(url, config) for asset_kind, url in assets
+                         if asset_kind == kind]
+                paths = [path for path in paths if path is not None]
+                if not paths:
+                    continue
+                url = build_bundle(kind, paths, filters, config)
+                if url not in seen:
+                    seen.add(url)
+                    urls.append(url)
+    return urls
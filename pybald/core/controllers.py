@@ -1,15 +1,32 @@
 #!/usr/bin/env python
 # encoding: utf-8
-from six import with_metaclass
+from six import with_metaclass, string_types, text_type
 from functools import wraps
+try:
+    from collections.abc import Iterator
+except ImportError:
+    from collections import Iterator
+try:
+    from inspect import iscoroutinefunction
+except ImportError:
+    # no coroutines, no async actions
+    def iscoroutinefunction(func):
+        return False
 from webob import Request, Response, exc
+from webob.datetime_utils import UTC
+from webob.etag import NoETag
 import re
-from pybald.util import camel_to_underscore
+from pybald.util import camel_to_underscore, encoders
 from routes import redirect_to
 from pybald import context
+from pybald.core.tasks import submit_tasks
 
-import json
+import datetime
 import random
+import base64
+import hashlib
+import hmac
+import time
 
 import uuid
 import logging
@@ -22,6 +39,42 @@ class CSRFValidationFailure(exc.HTTPForbidden):
     pass
 
 
+def csrf_session_id(session):
+    '''Return the identifier of the session that stateless CSRF tokens are
+    bound to, the ``session_id`` or ``id`` of the session object.'''
+    return (getattr(session, 'session_id', None) or
+            getattr(session, 'id', None))
+
+
+def stateless_csrf_token(session_id, window=None):
+    '''
+    Create a stateless CSRF token, an HMAC of the session id and the
+    current time window signed with the ``csrf_secret`` config value.
+
+    Tokens are valid for between one and two ``csrf_token_lifetime`` periods.
+    '''
+    secret = context.config.csrf_secret
+    if not secret:
+        raise ValueError("Stateless CSRF tokens require a csrf_secret to be "
+                         "configured.")
+    if window is None:
+        window = int(time.time() // context.config.csrf_token_lifetime)
+    message = u"{0}:{1}".format(session_id, window).encode('utf-8')
+    return hmac.new(secret.encode('utf-8'), message,
+                    hashlib.sha256).hexdigest()
+
+
+def check_stateless_csrf_token(session_id, token):
+    '''Return True if the token was issued to the session in the current or
+    previous time window.'''
+    current = int(time.time() // context.config.csrf_token_lifetime)
+    token = token.encode('utf-8')
+    return any(hmac.compare_digest(
+                   stateless_csrf_token(session_id, window).encode('utf-8'),
+                   token)
+               for window in (current, current - 1))
+
+
 def csrf_protected(action_func):
     """
     Decorator to add CSRF (cross-site request forgery) protection to POST
@@ -41,11 +94,25 @@ def csrf_protected(action_func):
     ${csrf_input}
     ...
     </form>
+
+    By default a new single use token is stashed in the session on every
+    request. With the ``csrf_stateless`` config option set, tokens are
+    instead signed with ``csrf_secret`` over the session id and a time window
+    (see ``stateless_csrf_token``) and checked without storing anything, so
+    protected pages don't cause a session write. Stateless tokens can be
+    reused until they expire. A token stashed in the session is still
+    accepted, for forms rendered before the session had an id or before
+    ``csrf_stateless`` was switched on.
     """
     CSRF_TOKEN_POST_VARIABLE = '__csrf_token__'
 
     @wraps(action_func)
     def replacement(self, req):
+        session_id = None
+        if context.config.csrf_stateless:
+            # sessions without an id fall back to stashed tokens
+            session_id = csrf_session_id(self.session)
+
         if req.method == 'POST':
             try:
                 if CSRF_TOKEN_POST_VARIABLE not in req.POST:
@@ -54,30 +121,45 @@ def csrf_protected(action_func):
                          "that a ${csrf_input} is used in the form template.")
                         % CSRF_TOKEN_POST_VARIABLE)
 
-                if not self.session.stash.get("csrf_token"):
+                provided_csrf_token = req.POST.get(CSRF_TOKEN_POST_VARIABLE)
+                stashed_csrf_token = self.session.stash.get("csrf_token")
+
+                # a stashed token is accepted even with stateless tokens on,
+                # the form may have been rendered before the session had an
+                # id or before csrf_stateless was switched on
+                if (stashed_csrf_token and
+                        provided_csrf_token == stashed_csrf_token):
+                    # success! wipe out the used token
+                    self.session.stash(csrf_token=None)
+                    #del self.session.csrf_token
+
+                elif session_id:
+                    if not check_stateless_csrf_token(session_id,
+                                                      provided_csrf_token):
+                        raise CSRFValidationFailure(
+                            "CSRF validation failed: token mismatch.")
+
+                elif not stashed_csrf_token:
                     raise CSRFValidationFailure(
                         "CSRF validation failed: no validation token available "
                         "in this session.")
 
-                provided_csrf_token = req.POST.get(CSRF_TOKEN_POST_VARIABLE)
-
-                if provided_csrf_token != self.session.stash.get("csrf_token"):
+                else:
                     raise CSRFValidationFailure(
                         "CSRF validation failed: token mismatch.")
 
-                else:
-                    # success! wipe out the used token
-                    self.session.stash(csrf_token=None)
-                    #del self.session.csrf_token
-
             except CSRFValidationFailure:
                 # gentle mode, redirect to GET version of the page
                 # return self._redirect_to(req.path_qs)
                 raise
 
-        # always stash a new token
-        new_token = str(uuid.uuid4()).replace("-", "")
-        self.session.stash(csrf_token=new_token)
+        if session_id:
+            # signed tokens don't need to be stored
+            new_token = stateless_csrf_token(session_id)
+        else:
+            # always stash a new token
+            new_token = str(uuid.uuid4()).replace("-", "")
+            self.session.stash(csrf_token=new_token)
 
         self.csrf_input = ("<input type='hidden' name='%s' value='%s' />" % (
             CSRF_TOKEN_POST_VARIABLE, new_token))
@@ -92,6 +174,10 @@ def noop_func(*pargs, **kargs):
     pass
 
 
+# controller class -> default template root name
+template_root_names = {}
+
+
 def get_template_name(instance, method_name):
     '''
     Defines the template id to match against.
@@ -108,16 +194,126 @@ def get_template_name(instance, method_name):
     template_id = getattr(instance, 'template_id', None)
     if template_id:
         return template_id
-    # build a default template name if one isn't explicitly set
+    # build a default template name if one isn't explicitly set, the
+    # root name only depends on the class so it's computed once
+    controller_class = instance.__class__
     try:
-        template_root_name = camel_to_underscore(
-                  controller_pattern.search(instance.__class__.__name__
-                                            ).group(1))
-    except AttributeError:
-        template_root_name = ''
+        template_root_name = template_root_names[controller_class]
+    except KeyError:
+        try:
+            template_root_name = camel_to_underscore(
+                      controller_pattern.search(controller_class.__name__
+                                                ).group(1))
+        except AttributeError:
+            template_root_name = ''
+        template_root_names[controller_class] = template_root_name
     return "/".join(filter(None, [template_root_name, method_name]))
 
 
+# controller class -> whether request state can be written straight into
+# the instance __dict__
+plain_state_classes = {}
+
+
+def has_plain_state(controller_class):
+    '''
+    Returns True if instances of a controller class have no custom
+    ``__setattr__`` and no data descriptors (properties, slots...) that
+    assigning attributes would need to go through.
+
+    Request state for these controllers is copied into the instance
+    ``__dict__`` with a single update instead of one setattr per value.
+    '''
+    try:
+        return plain_state_classes[controller_class]
+    except KeyError:
+        pass
+    plain = (getattr(controller_class, '__setattr__', None) is
+             object.__setattr__)
+    if plain:
+        for klass in controller_class.__mro__:
+            if klass is object:
+                continue
+            for name, value in vars(klass).items():
+                if name.startswith('__'):
+                    continue
+                if hasattr(type(value), '__set__'):
+                    plain = False
+                    break
+            if not plain:
+                break
+    plain_state_classes[controller_class] = plain
+    return plain
+
+
+def bind_request(controller, environ, template_name):
+    '''
+    Copy the request state onto a controller instance before running an
+    action and return the WebOb request.
+
+    Url variables and the ``pybald.extension`` values are assigned as
+    instance variables along with ``request``, ``request_url`` and the
+    ``template_id`` for the action.
+    '''
+    req = Request(environ)
+    extension = environ.setdefault('pybald.extension', {})
+    if has_plain_state(controller.__class__):
+        # same as the setattr calls below, without the per value churn
+        state = controller.__dict__
+        state.update(req.urlvars)
+        state.update(extension)
+        state['request'] = req
+        state['request_url'] = req.url
+    else:
+        # add any url variables as members of the controller
+        for varname, value in req.urlvars.items():
+            # Set the controller object to contain the url variables
+            # parsed from the dispatcher / router
+            setattr(controller, varname, value)
+
+        # add the pybald extension dict to the controller
+        # object
+        for key, value in extension.items():
+            setattr(controller, key, value)
+
+        # TODO: fixme this is a hack
+        setattr(controller, 'request', req)
+        setattr(controller, 'request_url', req.url)
+
+    # set the template_id for this request
+    controller.template_id = get_template_name(controller, template_name)
+    return req
+
+
+def iter_encoded(iterable, encoding='utf-8'):
+    '''Encode the text chunks of a streamed response, closing the original
+    iterable when the response is finished.'''
+    try:
+        for chunk in iterable:
+            if isinstance(chunk, text_type):
+                chunk = chunk.encode(encoding)
+            if chunk:
+                yield chunk
+    finally:
+        close = getattr(iterable, 'close', None)
+        if close is not None:
+            close()
+
+
+def as_response(resp):
+    '''Wrap string results from an action in a Response object.
+
+    Generators and other iterators become the ``app_iter`` of a streamed
+    response.'''
+    # if the response is currently a string
+    # wrap it in a response object
+    if isinstance(resp, str) or isinstance(resp, bytes):
+        resp = Response(body=resp, charset="utf-8")
+    elif isinstance(resp, Iterator):
+        resp = Response(app_iter=iter_encoded(resp), charset="utf-8")
+    return resp
+
+
 # action / method decorator
 def action(method):
     '''
@@ -136,6 +332,9 @@ def action(method):
     assigns instance variables from the ``pybald.extension`` environ variables
     that can be set from other parts of the WSGI pipeline.
 
+    ``async def`` methods are turned into asynchronous actions, which can
+    only be served through the ASGI adapter (see :mod:`pybald.core.asgi`).
+
     This decorator is optional but recommended for making working
     with requests and responses easier.
     '''
@@ -148,81 +347,96 @@ def action(method):
     if template_name in ('index', '__call__'):
         template_name = ''
 
+    if iscoroutinefunction(method):
+        from pybald.core.asgi import async_action
+        return async_action(method, template_name)
+
     @wraps(method)
     def action_wrapper(self, environ, start_response):
-        req = Request(environ)
-        # add any url variables as members of the controller
-        for varname, value in req.urlvars.items():
-            # Set the controller object to contain the url variables
-            # parsed from the dispatcher / router
-            setattr(self, varname, value)
-
-        # add the pybald extension dict to the controller
-        # object
-        for key, value in req.environ.setdefault('pybald.extension', {}).items():
-            setattr(self, key, value)
-
-        # TODO: fixme this is a hack
-        setattr(self, 'request', req)
-        setattr(self, 'request_url', req.url)
+        req = bind_request(self, environ, template_name)
 
         # set pre/post/view to a no-op if they don't exist
         pre = getattr(self, '_pre', noop_func)
         post = getattr(self, '_post', noop_func)
 
-        # set the template_id for this request
-        self.template_id = get_template_name(self, template_name)
-
         # The response is either the controllers _pre code, whatever
         # is returned from the controller
         # or the view. So pre has precedence over
         # the return which has precedence over the view
-        resp = (pre(req) or
-                 method(self, req) or
-                 context.render(template=self.template_id,
-                             data=self.__dict__ or {}))
-        # if the response is currently a string
-        # wrap it in a response object
-        if isinstance(resp, str) or isinstance(resp, bytes):
-            resp = Response(body=resp, charset="utf-8")
+        resp = as_response(pre(req) or
+                           method(self, req) or
+                           context.render(template=self.template_id,
+                                          data=self.__dict__ or {}))
         # run the controllers post code
         post(req, resp)
+        tasks = self.__dict__.get('_after_response_tasks')
+        if tasks:
+            submit_tasks(environ, tasks)
         return resp(environ, start_response)
     return action_wrapper
 
 
-# def caching_pre(keys, method_name, prefix=''):
-#     '''Decorator for pybald _pre to return cached responses if available.'''
-#     if keys is None:
-#         keys = []
-
-#     def pre_wrapper(pre):
-#         def replacement(self, req):
-#             val = ":".join([prefix] + [str(getattr(self, k, '')) for
-#                         k in keys] + [method_name])
-#             self.cache_key = base64.urlsafe_b64encode(hashlib.md5(val).digest())
-#             resp = project.mc.get(self.cache_key)
-#             if resp:
-#                 return resp
-#             return pre(req)
-#         return replacement
-#     return pre_wrapper
-
-
-# def caching_post(time=0):
-#     '''Decorator for pybald _post to cache/store responses.'''
-#     def post_wrapper(post):
-#         def replacement(self, req, resp):
-#             post(req, resp)
-#             # only cache 2XX or 4XX responses
-#             if (200 <= resp.status_code < 300) or (400 <= resp.status_code < 500):
-#                 if 'X-Cache' not in resp.headers:
-#                     resp.headerlist.append(('X-Cache', 'MISS'))
-#                     project.mc.set(self.cache_key, resp, time)
-#                 else:
-#                     resp.headers['X-Cache'] = 'HIT'
-#         return replacement
-#     return post_wrapper
+def caching_pre(keys, method_name, prefix='', backend=None):
+    '''Decorator for pybald _pre to return cached responses if available.
+
+    The controller's own ``_pre`` runs first so access checks are never
+    skipped, the cache is only used if it returns nothing.'''
+    if keys is None:
+        keys = []
+
+    def pre_wrapper(pre):
+        def replacement(self, req):
+            resp = pre(req)
+            if resp:
+                # responses from _pre (redirects, access checks) depend on
+                # the client and are never cached
+                self.cache_key = None
+                return resp
+            # controllers share the action cache, so the key includes the
+            # controller class as well as the action
+            controller_class = self.__class__
+            val = ":".join([prefix] + [str(getattr(self, k, '')) for
+                        k in keys] + ["{0}.{1}".format(
+                            controller_class.__module__,
+                            controller_class.__name__), method_name])
+            self.cache_key = base64.urlsafe_b64encode(
+                            hashlib.md5(val.encode('utf-8')).digest()
+                            ).decode('ascii')
+            cache = backend if backend is not None else context.action_cache
+            cached = cache.get(self.cache_key)
+            if cached:
+                status, headerlist, body = cached
+                resp = Response(status=status, headerlist=list(headerlist),
+                                body=body)
+                resp.headers['X-Cache'] = 'HIT'
+                return resp
+            return None
+        return replacement
+    return pre_wrapper
+
+
+def caching_post(time=0, backend=None):
+    '''Decorator for pybald _post to cache/store responses.'''
+    def post_wrapper(post):
+        def replacement(self, req, resp):
+            post(req, resp)
+            if (resp.headers.get('X-Cache') == 'HIT' or
+                    getattr(self, 'cache_key', None) is None):
+                return
+            # only cache 2XX or 4XX responses, and never responses
+            # setting cookies since those are specific to one client or
+            # streamed responses that aren't in memory
+            if (((200 <= resp.status_code < 300) or
+                    (400 <= resp.status_code < 500)) and
+                    'Set-Cookie' not in resp.headers and
+                    isinstance(resp.app_iter, list)):
+                resp.headers['X-Cache'] = 'MISS'
+                cache = backend if backend is not None else context.action_cache
+                cache.set(self.cache_key,
+                          (resp.status, list(resp.headerlist), resp.body),
+                          time)
+        return replacement
+    return post_wrapper
 
 # regenerate a content_cache_prefix on every reload so that content will
 # be force loaded after any full application restart
@@ -231,30 +445,178 @@ def action(method):
 content_cache_prefix = hex(random.randrange(0, 2 ** 32 - 1))
 
 
-# # memcache for actions
-# def action_cached(prefix=content_cache_prefix, keys=None, time=0):
-#     '''
-#     Wrap actions and return pre-generated responses when appropriate.
-#     '''
-#     if keys is None:
-#         keys = []
-
-#     # def cached_wrapper(my_action_method):
-#     #     @wraps(my_action_method)
-#     #     def replacement(self, environ, start_response):
-#     #         # bind newly wrapped methods to self
-#     #         self._pre = caching_pre(keys,
-#     #                                 my_action_method.__name__,
-#     #                                 prefix=prefix)(self._pre
-#     #                                     ).__get__(self, self.__class__)
-#     #         self._post = caching_post(time)(self._post
-#     #                                     ).__get__(self, self.__class__)
-#     #         return my_action_method(self, environ, start_response)
-#     #     # don't enable caching if requested
-#     #     if project.DISABLE_STATIC_CONTENT_CACHE:
-#     #         return my_action_method
-#     #     return replacement
-#     # return cached_wrapper
+# memcache for actions
+def action_cached(prefix=content_cache_prefix, keys=None, ttl=0, backend=None):
+    '''
+    Wrap actions and return pre-generated responses when appropriate.
+
+    :param prefix: The cache key namespace, by default regenerated on every
+                   application restart so cached content doesn't outlive the
+                   code that produced it.
+    :param keys: The names of controller attributes (url variables, pybald
+                 extensions...) that the response depends on.
+    :param ttl: How many seconds to keep the response, 0 keeps it until it's
+                evicted.
+    :param backend: The cache backend to use, defaults to the
+                    ``context.action_cache`` (see :mod:`pybald.util.cache`).
+
+    The whole response (status, headers and body) of GET and HEAD requests
+    is cached and returned with an ``X-Cache`` HIT or MISS header. Caching is
+    skipped when the ``DISABLE_STATIC_CONTENT_CACHE`` config option is set.
+    ``_pre`` runs before the cache is checked so authentication checks are
+    never skipped, and responses returned by ``_pre`` aren't cached.
+
+    .. sourcecode:: python
+
+        @action_cached(keys=['item_id'], ttl=60)
+        @action
+        def show(self, req):
+            ...
+    '''
+    if keys is None:
+        keys = []
+
+    def cached_wrapper(my_action_method):
+        def bind_hooks(self):
+            # bind newly wrapped methods to self
+            self._pre = caching_pre(keys,
+                                    my_action_method.__name__,
+                                    prefix=prefix,
+                                    backend=backend)(getattr(self, '_pre', noop_func)
+                                        ).__get__(self, self.__class__)
+            self._post = caching_post(ttl, backend=backend)(
+                                        getattr(self, '_post', noop_func)
+                                        ).__get__(self, self.__class__)
+
+        def use_cache(environ):
+            # don't enable caching if requested
+            return (environ['REQUEST_METHOD'] in ('GET', 'HEAD') and
+                    not context.config.DISABLE_STATIC_CONTENT_CACHE)
+
+        if iscoroutinefunction(my_action_method):
+            from pybald.core.asgi import async_action_cached
+            return async_action_cached(my_action_method, bind_hooks, use_cache)
+
+        @wraps(my_action_method)
+        def replacement(self, environ, start_response):
+            if use_cache(environ):
+                bind_hooks(self)
+            return my_action_method(self, environ, start_response)
+        return replacement
+    return cached_wrapper
+
+
+def conditional_pre(validate, method_name, validators):
+    '''Decorator for pybald _pre to answer conditional requests with a 304
+    before the action runs, using an action's cheap validator.'''
+    def pre_wrapper(pre):
+        def replacement(self, req):
+            resp = pre(req)
+            if resp or validate is None:
+                return resp
+            value = validate(self, req)
+            if value is None:
+                return None
+            if isinstance(value, datetime.datetime):
+                if value.tzinfo is None:
+                    value = value.replace(tzinfo=UTC)
+                validators['last_modified'] = value
+                not_modified = (req.if_modified_since is not None and
+                                req.if_none_match is NoETag and
+                                value.replace(microsecond=0) <=
+                                req.if_modified_since)
+            else:
+                etag = hashlib.md5(u"{0}:{1}".format(method_name, value
+                                                     ).encode('utf-8')
+                                   ).hexdigest()
+                validators['etag'] = etag
+                not_modified = etag in req.if_none_match
+            if not_modified:
+                return exc.HTTPNotModified(**validators)
+            return None
+        return replacement
+    return pre_wrapper
+
+
+def conditional_post(validators):
+    '''Decorator for pybald _post to tag responses with a validator and
+    enable WebOb's conditional response handling.'''
+    def post_wrapper(post):
+        def replacement(self, req, resp):
+            post(req, resp)
+            if resp.status_code != 200:
+                return
+            if 'etag' in validators:
+                resp.etag = validators['etag']
+            elif 'last_modified' in validators:
+                resp.last_modified = validators['last_modified']
+            elif resp.etag is None and isinstance(resp.app_iter, list):
+                # a strong ETag from the body, only for responses that
+                # are already in memory
+                resp.md5_etag()
+            resp.conditional_response = True
+        return replacement
+    return post_wrapper
+
+
+def action_conditional(validator=None):
+    '''
+    Answer conditional GET requests (``If-None-Match`` and
+    ``If-Modified-Since``) for an action with ``304 Not Modified``.
+
+    :param validator: An optional cheap validator for the response, either a
+                      callable taking ``(self, req)`` or the name of a
+                      controller method with that signature. It runs before
+                      the action and returns a ``datetime`` (sent as
+                      ``Last-Modified``) or any other value such as a
+                      version number (hashed into the ``ETag``). Returning
+                      None skips the early check for the request.
+
+    With a validator, a request the client already has the content for is
+    answered without running the action, rendering a template or touching
+    the database. Without one the action runs as usual and a strong ETag is
+    computed from the response body, which still saves sending the body.
+    Only GET and HEAD requests are handled; ``_pre`` runs before the
+    validator so authentication checks are never skipped.
+
+    .. sourcecode:: python
+
+        @action_conditional(validator=lambda self, req: self.page_version())
+        @action
+        def show(self, req):
+            ...
+    '''
+    def conditional_wrapper(my_action_method):
+        def bind_hooks(self):
+            # validators for this request, shared by the pre and post hooks
+            validators = {}
+            validate = validator
+            if isinstance(validate, string_types):
+                validate = getattr(self.__class__, validate)
+            self._pre = conditional_pre(validate,
+                                        my_action_method.__name__,
+                                        validators)(getattr(self, '_pre', noop_func)
+                                            ).__get__(self, self.__class__)
+            self._post = conditional_post(validators)(
+                                        getattr(self, '_post', noop_func)
+                                        ).__get__(self, self.__class__)
+
+        def use_conditional(environ):
+            return environ['REQUEST_METHOD'] in ('GET', 'HEAD')
+
+        if iscoroutinefunction(my_action_method):
+            from pybald.core.asgi import async_action_cached
+            return async_action_cached(my_action_method, bind_hooks,
+                                       use_conditional)
+
+        @wraps(my_action_method)
+        def replacement(self, environ, start_response):
+            if use_conditional(environ):
+                bind_hooks(self)
+            return my_action_method(self, environ, start_response)
+        return replacement
+    return conditional_wrapper
+
 
 class RegistryMount(type):
     '''
@@ -289,6 +651,12 @@ class Controller(with_metaclass(RegistryMount, object)):
     def _post(self, req, resp):
         pass
 
+    def _after_response(self, func, *pargs, **kargs):
+        '''Run func with the given arguments on the background task pool
+        after the response has been sent (see :mod:`pybald.core.tasks`).'''
+        self.__dict__.setdefault('_after_response_tasks', []).append(
+                                                        (func, pargs, kargs))
+
     def _redirect_to(self, *pargs, **kargs):
         '''Redirect the controller'''
         return redirect_to(*pargs, **kargs)
@@ -301,13 +669,48 @@ class Controller(with_metaclass(RegistryMount, object)):
         '''Raise an http_client_error exception using a specific code'''
         raise exc.status_map[int(code)]
 
-    def _JSON(self, data, status=200):
-        '''Return JSON object with the proper-ish headers.'''
-        res = Response(body=json.dumps(data),
+    def _stream(self, template=None, data=None, format="html"):
+        '''Return a Response streaming the rendered template, by default the
+        action's view (see ``TemplateEngine.stream``).'''
+        if template is None:
+            template = self.template_id
+        if data is None:
+            data = self.__dict__
+        return Response(app_iter=context.render.stream(template=template,
+                                                       data=data,
+                                                       format=format),
+                        charset="utf-8")
+
+    # the function used to encode _JSON responses, see pybald.util.encoders
+    json_encoder = staticmethod(encoders.dumps)
+
+    def _JSON(self, data, status=200, encoder=None):
+        '''Return JSON object with the proper-ish headers.
+
+        The data is encoded with ``encoder`` or the controller's
+        ``json_encoder``, which uses orjson when it's installed.'''
+        body = (encoder or self.json_encoder)(data)
+        if isinstance(body, text_type):
+            body = body.encode('utf-8')
+        res = Response(body=body,
                        status=status,
                        content_type="application/json",
                        charset='UTF-8')
         return res
 
+    def _JSON_stream(self, iterable, status=200, encoder=None):
+        '''Return a JSON array response that's encoded while it's sent.
+
+        Each item of the iterable is encoded separately (with ``encoder`` or
+        the controller's ``json_encoder``) so memory use stays flat no matter
+        how many items there are. Pass a query using ``yield_per`` to stream
+        rows straight from the database.'''
+        return Response(app_iter=encoders.iter_json_array(
+                                        iterable,
+                                        encoder=encoder or self.json_encoder),
+                        status=status,
+                        content_type="application/json",
+                        charset='UTF-8')
+
 # alias for backwards copatibility
 BaseController = Controller
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+Compiled route dispatching.
+
+The Routes mapper matches a request by trying every connected route's regular
+expression in order. For applications with many routes this linear scan can
+dominate the cost of routing. The ``CompiledDispatcher`` compiles the mapper's
+routes once into a trie of path segments: static segments are plain dict
+lookups and dynamic ``{var}`` segments get a small per-node regex.
+
+Any route that can't be represented in the trie (wildcard paths, requirements
+that can span segments, sub-domain conditions, minimized routes...) is kept
+in a fallback list and matched with the route's own regex, so the result is
+always the same ``(urlvars, route)`` tuple ``Mapper.routematch`` would return.
+'''
+import re
+from routes.util import as_unicode
+import logging
+log = logging.getLogger(__name__)
+
+# requirement regexes that could match a '/' (or are too clever to reason
+# about) can't be confined to a single path segment
+UNSAFE_REQUIREMENT = re.compile(r'[./]|\\[SWDs]|\[\^')
+
+
+class _Node(object):
+    '''A single path segment position in the route trie.'''
+    __slots__ = ('static', 'dynamic', 'patterns', 'leaves')
+
+    def __init__(self):
+        # segment text -> child node
+        self.static = {}
+        # (compiled segment regex match, child node) in insertion order
+        self.dynamic = []
+        # segment regex source -> child node, to share identical patterns
+        self.patterns = {}
+        # (route index, route) pairs for routes ending at this node
+        self.leaves = []
+
+    def child(self, static, segment):
+        if static:
+            try:
+                return self.static[segment]
+            except KeyError:
+                node = self.static[segment] = _Node()
+                return node
+        try:
+            return self.patterns[segment]
+        except KeyError:
+            node = self.patterns[segment] = _Node()
+            self.dynamic.append((re.compile(segment).match, node))
+            return node
+
+
+def _variable_pattern(route, part, clist):
+    '''Return the regex source for a single route variable, or None if the
+    variable can't be matched within one path segment.'''
+    var = part['name']
+    if var == 'controller':
+        partmatch = '|'.join(map(re.escape, clist))
+    else:
+        requirement = route.reqs.get(var)
+        if requirement and UNSAFE_REQUIREMENT.search(requirement):
+            return None
+        if part['type'] == ':':
+            partmatch = requirement or '[^/]+?'
+        else:
+            partmatch = requirement or '[^/.]+?'
+    regpart = '(?P<{0}>{1})'.format(var, partmatch)
+    if part['type'] == '.':
+        return r'(?:\.{0})??'.format(regpart)
+    return regpart
+
+
+def compile_segments(route, clist):
+    '''
+    Split a route into a list of ``(static, segment)`` matchers, one per path
+    segment.
+
+    Static segments are the literal segment text, dynamic segments are the
+    regex source used to match that segment. Returns None if the route can't
+    be represented in the trie.
+    '''
+    if (route.static or route.minimization or
+            not route.routepath.startswith('/')):
+        return None
+    if route.conditions and 'sub_domain' in route.conditions:
+        return None
+
+    segments = [[]]
+    for part in route.routelist:
+        if isinstance(part, dict):
+            if part['type'] not in (':', '.'):
+                return None
+            segments[-1].append(part)
+        else:
+            pieces = part.split('/')
+            if pieces[0]:
+                segments[-1].append(pieces[0])
+            segments.extend([piece] if piece else [] for piece in pieces[1:])
+    # the route starts with '/', so nothing precedes the first segment
+    if segments.pop(0):
+        return None
+
+    compiled = []
+    for segment in segments:
+        if not any(isinstance(part, dict) for part in segment):
+            compiled.append((True, ''.join(segment)))
+            continue
+        regparts = []
+        for part in segment:
+            if isinstance(part, dict):
+                regpart = _variable_pattern(route, part, clist)
+                if regpart is None:
+                    return None
+                regparts.append(regpart)
+            else:
+                regparts.append(re.escape(part))
+        compiled.append((False, ''.join(regparts) + '$'))
+    return compiled
+
+
+def match_result(route, matchdict, environ):
+    '''
+    Build the urlvars for a route from the variables captured while walking
+    the trie.
+
+    This mirrors the checks ``Route.match`` makes after its regex matched
+    (method conditions, default values, decoding and condition functions).
+    Returns False if the route doesn't apply to this request.
+    '''
+    conditions = route.conditions
+    if (conditions and 'method' in conditions and environ and
+            environ['REQUEST_METHOD'] not in conditions['method']):
+        return False
+
+    defaults = route.defaults
+    result = {}
+    for key, val in matchdict.items():
+        if key != 'path_info' and route.encoding:
+            try:
+                val = as_unicode(val, route.encoding, route.decode_errors)
+            except UnicodeDecodeError:
+                return False
+        if not val and key in defaults and defaults[key]:
+            result[key] = defaults[key]
+        else:
+            result[key] = val
+    for key in defaults:
+        if key not in matchdict:
+            result[key] = defaults[key]
+
+    if (conditions and 'function' in conditions and
+            not conditions['function'](environ, result)):
+        return False
+    return result
+
+
+class CompiledDispatcher(object):
+    '''
+    A segment trie built from a Routes mapper.
+
+    :param mapper: The Routes mapper with all routes connected and its
+                   regular expressions created.
+    :param clist: The list of controller names the ``{controller}`` variable
+                  is allowed to match.
+
+    ``match`` is a drop in replacement for ``mapper.routematch`` and returns
+    the same ``(urlvars, route)`` tuple or None.
+    '''
+    def __init__(self, mapper, clist=None):
+        self.mapper = mapper
+        self.root = _Node()
+        # routes that couldn't be compiled, matched the slow way
+        self.fallback = []
+        # mapper level features change how every url is matched, the
+        # dispatcher simply defers to the mapper when they are in use
+        self.enabled = not (mapper.prefix or mapper.sub_domains or
+                            mapper.debug)
+        if not self.enabled:
+            log.debug("Route compilation disabled by mapper options")
+            return
+
+        clist = clist or []
+        for index, route in enumerate(mapper.matchlist):
+            if route.static:
+                # static routes only generate, they never match
+                continue
+            segments = compile_segments(route, clist)
+            if segments is None:
+                self.fallback.append((index, route))
+                continue
+            node = self.root
+            for static, segment in segments:
+                node = node.child(static, segment)
+            node.leaves.append((index, route))
+        log.debug("Compiled {0} routes, {1} fallback routes".format(
+                  len(mapper.matchlist) - len(self.fallback),
+                  len(self.fallback)))
+
+    def __repr__(self):
+        return "<CompiledDispatcher {0} fallback routes>".format(
+                                                         len(self.fallback))
+
+    def _walk(self, node, segments, position, captured, found):
+        '''Collect every compiled route that matches the path segments.'''
+        if position == len(segments):
+            for index, route in node.leaves:
+                found.append((index, route, captured))
+            return
+        segment = segments[position]
+        child = node.static.get(segment)
+        if child is not None:
+            self._walk(child, segments, position + 1, captured, found)
+        for regmatch, child in node.dynamic:
+            match = regmatch(segment)
+            if match:
+                values = captured.copy()
+                values.update(match.groupdict())
+                self._walk(child, segments, position + 1, values, found)
+
+    def match(self, url=None, environ=None):
+        '''
+        Match a url (or the PATH_INFO of the environ) against the compiled
+        routes.
+
+        The first route in mapper order that matches wins, exactly as with
+        ``Mapper.routematch``.
+        '''
+        if not self.enabled:
+            return self.mapper.routematch(url=url, environ=environ)
+        if url is None:
+            url = environ['PATH_INFO']
+
+        found = []
+        if url.startswith('/'):
+            self._walk(self.root, url[1:].split('/'), 0, {}, found)
+            found.sort(key=lambda candidate: candidate[0])
+
+        mapper = self.mapper
+        fallback = iter(self.fallback)
+        pending = next(fallback, None)
+        for index, route, captured in found:
+            # uncompiled routes connected before this one get first shot
+            while pending is not None and pending[0] < index:
+                result = pending[1].match(url, environ, mapper.sub_domains,
+                                          mapper.sub_domains_ignore,
+                                          mapper.domain_match)
+                if result or isinstance(result, dict):
+                    return result, pending[1]
+                pending = next(fallback, None)
+            result = match_result(route, captured, environ)
+            if result is not False:
+                return result, route
+        while pending is not None:
+            result = pending[1].match(url, environ, mapper.sub_domains,
+                                      mapper.sub_domains_ignore,
+                                      mapper.domain_match)
+            if result or isinstance(result, dict):
+                return result, pending[1]
+            pending = next(fallback, None)
+        return None
@@ -10,6 +10,7 @@
 
 # TODO: add javascript escape code here so it's available in the template engine
 
+import hashlib
 from datetime import datetime
 from routes import url_for
 from mako import filters
@@ -17,25 +18,29 @@ from six.moves.urllib.parse import urlparse, ParseResult
 import re
 from routes import request_config
 from pybald import context
+from pybald.util.cache import LRUCache
 import logging
 log = logging.getLogger(__name__)
 
-try:
-    import pyhash
-    hashfunc = pyhash.super_fast_hash()
-except ImportError:
-    log.warning("-"*80 + '''
-    Warning
-    -------
-    Using python built-in hash() for asset URL generation. This is system
-    implementation specific and may result in different hosts mapping static
-    assets to different static hosts. That may cause inefficient use of browser
-    caches. Optionally you can install pyhash to install additional fast,
-    non-cryptographic, hashes that are not system dependent.
-
-    pip install pyhash
-'''+"-"*80)
-    hashfunc = hash
+
+def host_score(host, key):
+    '''A stable pseudo random score for a host and key, the same in every
+    process.'''
+    digest = hashlib.md5(u"{0}\0{1}".format(host, key).encode('utf-8'))
+    return int(digest.hexdigest()[:16], 16)
+
+
+def rendezvous_host(hosts, key):
+    '''
+    Pick one of the hosts for a key with rendezvous (highest random weight)
+    hashing.
+
+    Every host is scored for the key and the highest score wins, so a key
+    maps to the same host in every process and adding or removing a host
+    only moves the keys that belong to it, about 1/N of them.
+    '''
+    return max(hosts, key=lambda host: host_score(host, key))
+
 
 try:
     type(unicode)
@@ -43,6 +48,43 @@ except NameError:
     unicode = str
 
 
+# (raw url, request protocol) -> rewritten url, for the config in
+# asset_url_config
+asset_url_cache = LRUCache(4096)
+asset_url_config = [None]
+
+
+def request_protocol():
+    '''Return the protocol of the current request, or None outside of a
+    request.'''
+    # this requires the custom HTTP header X-Forwarded-Proto set if running
+    # behind a proxy (or if SSL is terminated upstream)
+    return getattr(request_config(), 'protocol', None)
+
+
+def asset_url(raw_url, asset=None):
+    '''
+    Return the url to link a static asset with, rewritten for the CDN when
+    it's configured (see ``AssetUrl``).
+
+    Rewritten urls are memoized by url and request protocol. The cache is
+    emptied when the application's config changes.
+    '''
+    config = getattr(context._proxied(), 'config', None)
+    if config is not asset_url_config[0]:
+        asset_url_cache.clear()
+        asset_url_config[0] = config
+    protocol = request_protocol()
+    key = (raw_url, protocol)
+    url = asset_url_cache.get(key)
+    if url is None:
+        if asset is None:
+            asset = AssetUrl(raw_url)
+        url = asset.rewrite(protocol)
+        asset_url_cache.set(key, url)
+    return url
+
+
 # parse result keys
 class AssetUrl(dict):
     '''
@@ -61,6 +103,10 @@ class AssetUrl(dict):
 
     def __html__(self):
         '''Return a transformed URL if necessary (appending protocol and CDN)'''
+        return asset_url(self.raw_url, self)
+
+    def rewrite(self, protocol=None):
+        '''Transform the URL for the request protocol, without the cache.'''
         host = self.get('netloc', None)
         # Don't CDN urls with hosts we're not re-writing
         if host:
@@ -68,19 +114,14 @@ class AssetUrl(dict):
                                            host not in context.config.STATIC_SOURCES):
                 return self.raw_url
         if (context.config.USE_CDN and (context.config.CDN_HOST or context.config.STATIC_HOSTS)):
-            # get the protocol for the current request
-            # this requires the custom HTTP header X-Forwarded-Proto
-            # set if running behind a proxy (or if SSL is terminated
-            # upstream)
-            try:
-                protocol = request_config().protocol
-            except AttributeError:
+            if protocol is None:
                 # are we not in a request? Use a default protocol
                 protocol = context.config.DEFAULT_PROTOCOL
-            # use the round robin hosts to speed download when not https
+            # spread assets over the static hosts to speed download when
+            # not https
             if protocol != "https" and context.config.STATIC_HOSTS:
-                self['netloc'] = context.config.STATIC_HOSTS[hashfunc(self.raw_url) %
-                                                      len(context.config.STATIC_HOSTS)]
+                self['netloc'] = rendezvous_host(context.config.STATIC_HOSTS,
+                                                 self.raw_url)
             else:
                 self['netloc'] = context.config.CDN_HOST
             # adjust the scheme of any link with a net location
@@ -135,7 +176,7 @@ class img(tag):
 
     def __html__(self):
         '''Return the image in string form.'''
-        return u'''<img src="{0}" {1} />'''.format(AssetUrl(str(self.img_src)),
+        return u'''<img src="{0}" {1} />'''.format(asset_url(str(self.img_src)),
                                                    " ".join(self.attribs))
 
 
@@ -268,12 +309,45 @@ _js_escapes = (_base_js_escapes +
               tuple([(chr(ascii_val), r"\u{:04X}".format(ascii_val)) for ascii_val in range(32)]))
 
 
+# character -> escape, applied in a single pass by splitting the value on
+# the characters that need escaping. str.translate is one pass too, but it
+# drops to a slow per-character lookup after the first escape and is several
+# times slower on JSON, see benchmarks/bench_js_escape.py
+_js_escape_table = dict(_js_escapes)
+_js_escape_pattern = re.compile(u"([{0}])".format(
+                        re.escape(u''.join(bad for bad, good in _js_escapes))))
+
+
 def js_escape(value):
     """
     Hex encodes characters for use in JavaScript strings.
     (from django.utils.html)
     """
     if value:
-        for bad, good in _js_escapes:
-            value = value.replace(bad, good)
+        pieces = _js_escape_pattern.split(value)
+        if len(pieces) > 1:
+            # the characters to escape are at the odd indexes
+            pieces[1::2] = map(_js_escape_table.__getitem__, pieces[1::2])
+            value = u''.join(pieces)
     return value
+
+
+def js_escape_many(values):
+    """
+    Hex encodes a sequence of values for use in JavaScript strings,
+    returning a list of the escaped values.
+
+    The values are escaped together in one pass, which saves the per-call
+    overhead of ``js_escape`` when there are many small values.
+    """
+    values = list(values)
+    try:
+        joined = u'\x00'.join(values)
+    except TypeError:
+        return [js_escape(value) for value in values]
+    # the joins are the only escaped NULs unless a value has NULs of its
+    # own, a literal backslash in a value is escaped so can't match
+    escaped = js_escape(joined).split(_js_escape_table[u'\x00'])
+    if len(escaped) != len(values):
+        return [js_escape(value) for value in values]
+    return escaped
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+Per-route request metrics.
+
+``RouteMetrics`` keeps request counts, error counts and a latency histogram
+for every route the Router dispatches to. Each thread records into its own
+table so the request path never waits on a lock; the tables are only merged
+when the metrics are read, or when their thread ends.
+
+A ``RouteMetrics`` object is also a WSGI application that serves the
+collected numbers in the Prometheus text exposition format.
+'''
+import weakref
+from bisect import bisect_left
+from threading import RLock, local
+import logging
+log = logging.getLogger(__name__)
+
+# histogram bucket upper bounds in seconds, a fixed 1-2.5-5 series from half
+# a millisecond to ten seconds (anything slower lands in the +Inf bucket)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def escape_label(value):
+    '''Escape a Prometheus label value.'''
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+                 .replace('\n', '\\n'))
+
+
+class RouteStats(object):
+    '''The counters and latency histogram for a single route.'''
+    __slots__ = ('count', 'errors', 'total', 'buckets')
+
+    def __init__(self, bucket_count):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        # one slot per bucket plus the +Inf bucket, not cumulative
+        self.buckets = [0] * (bucket_count + 1)
+
+    def merge(self, other):
+        self.count += other.count
+        self.errors += other.errors
+        self.total += other.total
+        for index, value in enumerate(other.buckets):
+            self.buckets[index] += value
+
+
+class ThreadToken(object):
+    '''Kept in a thread local, it goes away when the thread ends.'''
+    __slots__ = ('__weakref__',)
+
+
+class RouteMetrics(object):
+    '''
+    Request counts, error counts and latency histograms by route name.
+
+    :param buckets: The upper bounds (in seconds) of the latency histogram
+                    buckets, in increasing order.
+    :param prefix: The prefix for the exported metric names.
+
+    Pass ``metrics=True`` (or a ``RouteMetrics`` instance) to the Router to
+    collect metrics. The Router records every request with ``record``.
+    '''
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, prefix='pybald'):
+        self.bounds = tuple(buckets)
+        self.prefix = prefix
+        self._local = local()
+        # the table of every live thread, by a weak reference to its token,
+        # only locked when a thread first records or ends
+        self._tables = {}
+        # the merged tables of threads that have ended, so a thread per
+        # request server doesn't keep a table for every request
+        self._retired = {}
+        self._lock = RLock()
+
+    def __repr__(self):
+        return "<RouteMetrics {0} threads>".format(len(self._tables))
+
+    def _table(self):
+        try:
+            return self._local.table
+        except AttributeError:
+            table = self._local.table = {}
+            token = self._local.token = ThreadToken()
+            with self._lock:
+                self._tables[weakref.ref(token, self._retire)] = table
+            return table
+
+    def _retire(self, reference):
+        '''Merge the table of a thread that has ended into the retired
+        table.'''
+        with self._lock:
+            table = self._tables.pop(reference, None)
+            if table:
+                self._merge(self._retired, table)
+
+    def _merge(self, merged, table):
+        for route_name, stats in list(table.items()):
+            try:
+                total = merged[route_name]
+            except KeyError:
+                total = merged[route_name] = RouteStats(len(self.bounds))
+            total.merge(stats)
+
+    def record(self, route_name, duration, error=False):
+        '''
+        Record a single request.
+
+        :param route_name: The name to file the request under.
+        :param duration: The time taken to handle the request in seconds.
+        :param error: True if the request failed (an exception or a 5xx
+                      response).
+        '''
+        table = self._table()
+        try:
+            stats = table[route_name]
+        except KeyError:
+            stats = table[route_name] = RouteStats(len(self.bounds))
+        stats.count += 1
+        stats.total += duration
+        stats.buckets[bisect_left(self.bounds, duration)] += 1
+        if error:
+            stats.errors += 1
+
+    def snapshot(self):
+        '''Return a dictionary of route name to the merged ``RouteStats``
+        from every thread.'''
+        merged = {}
+        with self._lock:
+            tables = list(self._tables.values())
+            self._merge(merged, self._retired)
+        for table in tables:
+            self._merge(merged, table)
+        return merged
+
+    def reset(self):
+        '''Throw away everything recorded so far.'''
+        with self._lock:
+            self._retired.clear()
+            for table in self._tables.values():
+                table.clear()
+
+    def quantile(self, route_name, quantile, stats=None):
+        '''
+        Estimate a latency quantile (e.g. 0.99) for a route from its
+        histogram, interpolating linearly within the bucket it falls in.
+
+        Returns None if nothing has been recorded for the route. Requests
+        slower than the largest bucket report that bucket's upper bound.
+        '''
+        if stats is None:
+            stats = self.snapshot().get(route_name)
+        if not stats or not stats.count:
+            return None
+        rank = quantile * stats.count
+        seen = 0
+        lower = 0.0
+        for index, bucket_count in enumerate(stats.buckets):
+            if index == len(self.bounds):
+                return self.bounds[-1]
+            upper = self.bounds[index]
+            if bucket_count and seen + bucket_count >= rank:
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+            lower = upper
+        return self.bounds[-1]
+
+    def prometheus(self):
+        '''Return the metrics in the Prometheus text exposition format.'''
+        stats_by_route = sorted(self.snapshot().items())
+        prefix = self.prefix
+        lines = []
+
+        def counter(name, help_text, attribute):
+            lines.append('# HELP {0}_{1} {2}'.format(prefix, name, help_text))
+            lines.append('# TYPE {0}_{1} counter'.format(prefix, name))
+            for route_name, stats in stats_by_route:
+                lines.append('{0}_{1}{{route="{2}"}} {3}'.format(
+                             prefix, name, escape_label(route_name),
+                             getattr(stats, attribute)))
+
+        counter('requests_total', 'Requests handled by route.', 'count')
+        counter('request_errors_total', 'Requests that failed by route.',
+                'errors')
+
+        name = prefix + '_request_duration_seconds'
+        lines.append('# HELP {0} Request latency by route.'.format(name))
+        lines.append('# TYPE {0} histogram'.format(name))
+        for route_name, stats in stats_by_route:
+            label = escape_label(route_name)
+            cumulative = 0
+            for bound, bucket_count in zip(self.bounds + ('+Inf',),
+                                           stats.buckets):
+                cumulative += bucket_count
+                lines.append('{0}_bucket{{route="{1}",le="{2}"}} {3}'.format(
+                             name, label, bound, cumulative))
+            lines.append('{0}_sum{{route="{1}"}} {2!r}'.format(name, label,
+                                                               stats.total))
+            lines.append('{0}_count{{route="{1}"}} {2}'.format(name, label,
+                                                               stats.count))
+        return '\n'.join(lines) + '\n'
+
+    def __call__(self, environ, start_response):
+        '''Serve the metrics in the Prometheus text format.'''
+        body = self.prometheus().encode('utf-8')
+        start_response('200 OK', [('Content-Type', self.content_type),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
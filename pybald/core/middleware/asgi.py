@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+Async equivalents of the pybald middleware for use with the ASGI adapter
+(see :mod:`pybald.core.asgi`).
+
+Each class takes the same arguments as its WSGI counterpart and wraps the
+next application in an async pipeline. Blocking work (loading and saving
+sessions, database commits, error pages) runs on the adapter's thread pool.
+Like the adapter, these require Python 3.7 or newer.
+'''
+from sqlalchemy.exc import SQLAlchemyError
+from webob import Request, exc
+from pybald import context
+from pybald.core.asgi import call_application, get_response, run_sync
+from pybald.core.middleware.errors import ErrorMiddleware
+from pybald.core.middleware.db_middleware import (ClosingIterator,
+                                                  DbMiddleware, is_streamed)
+from pybald.core.middleware.sessions import SessionManager
+from pybald.core.middleware.users import UserManager
+import logging
+log = logging.getLogger(__name__)
+
+
+class AsyncErrorMiddleware(ErrorMiddleware):
+    '''Handles exceptions raised in an async pipeline, see
+    :class:`~pybald.core.middleware.errors.ErrorMiddleware`.'''
+    async def __call__(self, environ, start_response):
+        #pass through if no exceptions occur
+        try:
+            return await call_application(self.application, environ,
+                                          start_response)
+        # handle HTTP errors
+        except exc.HTTPException as err:
+            handler = self.http_error_handler(err)
+            try:
+                return await call_application(handler, environ,
+                                              start_response)
+            except Exception:
+                log.exception("Exception thrown during error_controller handling")
+                raise
+        except Exception as err:
+            handler = self.error_handler(err)
+            return await call_application(handler, environ, start_response)
+
+
+class AsyncDbMiddleware(DbMiddleware):
+    '''
+    Commits, rolls back and closes the database session for an async
+    pipeline, see :class:`~pybald.core.middleware.db_middleware.DbMiddleware`.
+
+    The database session has to follow the request across threads, so the
+    application must be configured with ``database_request_scope=True``.
+    With per thread sessions an action's writes and the commit could happen
+    in different sessions, so a ValueError is raised without it.
+    '''
+    def __init__(self, application=None):
+        if not getattr(context.config, 'database_request_scope', False):
+            raise ValueError("AsyncDbMiddleware requires database_request_scope"
+                             " to be configured, so the database session "
+                             "follows the request across threads.")
+        super(AsyncDbMiddleware, self).__init__(application)
+
+    async def __call__(self, environ, start_response):
+        streamed = False
+        # pass through if no exceptions occur, commit sessions on complete
+        try:
+            resp = await call_application(self.application, environ,
+                                          start_response)
+            # commit any outstanding sql
+            await run_sync(environ, context.db.commit)
+        # on any SQLAlchemy Errors, rollback the transaction
+        except SQLAlchemyError:
+            log.exception("SQLAlchemy Error")
+            await run_sync(environ, context.db.rollback)
+            raise
+        else:
+            # streamed bodies are read on the thread pool after this returns,
+            # the session is closed with the body
+            streamed = is_streamed(resp)
+            if streamed:
+                return ClosingIterator(resp, context.db.remove)
+            return resp
+        finally:
+            if not streamed:
+                # always, always, ALWAYS close the session regardless
+                await run_sync(environ, context.db.remove)
+
+
+class AsyncSessionManager(SessionManager):
+    '''Session handling for an async pipeline, see
+    :class:`~pybald.core.middleware.sessions.SessionManager`.'''
+    async def __call__(self, environ, start_response):
+        req = Request(environ)
+
+        session = await run_sync(environ, self.start_session, req)
+
+        # call the next part of the pipeline
+        resp = await get_response(self.application, environ)
+
+        # execute any post-processing code for the session
+        # this includes saving the session if necessary.
+        await run_sync(environ, session._after, req, resp)
+
+        return resp(environ, start_response)
+
+
+class AsyncUserManager(UserManager):
+    '''User handling for an async pipeline, see
+    :class:`~pybald.core.middleware.users.UserManager`.'''
+    async def __call__(self, environ, start_response):
+        await run_sync(environ, self.set_user, environ)
+        # call the next part of the pipeline
+        return await call_application(self.application, environ,
+                                      start_response)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+Response compression, implemented as WSGI middleware.
+
+Responses are compressed with the best codec the client accepts: brotli
+(when the ``brotli`` package is installed), gzip or deflate. Compressed
+bodies of responses with a strong ETag are kept in a bounded cache so
+repeated responses aren't compressed again.
+
+    pip install brotli
+'''
+import re
+import zlib
+from webob import Request
+from pybald.util.cache import LRUCache
+import logging
+log = logging.getLogger(__name__)
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# content types that are worth compressing
+DEFAULT_CONTENT_TYPES = ('text/html', 'text/plain', 'text/css', 'text/csv',
+                         'text/xml', 'text/javascript',
+                         'application/javascript', 'application/json',
+                         'application/xml', 'image/svg+xml')
+
+# wbits for zlib: gzip wraps the stream in a gzip header, HTTP's deflate is
+# the zlib format
+ZLIB_WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+class BrotliCompressor(object):
+    '''A brotli compressor with the zlib compressobj interface.'''
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=min(level, 11))
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self, mode=None):
+        if mode == zlib.Z_SYNC_FLUSH:
+            return self.compressor.flush()
+        return self.compressor.finish()
+
+
+def compressor(codec, level):
+    '''Return a new compressor for a codec.'''
+    if codec == 'br':
+        return BrotliCompressor(level)
+    return zlib.compressobj(level, zlib.DEFLATED, ZLIB_WBITS[codec])
+
+
+def compress(codec, body, level):
+    '''Compress a whole body with a codec.'''
+    if codec == 'br':
+        return brotli.compress(body, quality=min(level, 11))
+    compressobj = compressor(codec, level)
+    return compressobj.compress(body) + compressobj.flush()
+
+
+def iter_compressed(app_iter, codec, level):
+    '''Compress a streamed body, flushing after every chunk so the client
+    gets data as soon as the application produces it.'''
+    compressobj = compressor(codec, level)
+    try:
+        for chunk in app_iter:
+            data = compressobj.compress(chunk)
+            data += compressobj.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressobj.flush()
+    finally:
+        close = getattr(app_iter, 'close', None)
+        if close is not None:
+            close()
+
+
+class CompressionMiddleware(object):
+    '''
+    Compresses responses for clients that accept it.
+
+    :param application: The WSGI application to wrap.
+    :param min_size: Responses smaller than this many bytes are sent as is.
+    :param content_types: The content types to compress.
+    :param level: The compression level, 1 (fastest) to 9 (smallest).
+    :param cache_size: How many compressed bodies to keep, by ETag and
+                       codec. Zero disables the cache.
+
+    Only successful responses in one of the ``content_types`` are
+    compressed. Streamed responses are compressed as they're sent. The ETag
+    of a compressed response gets the codec appended (``"abc-gzip"``) and the
+    suffix is removed from ``If-None-Match`` headers so conditional requests
+    keep working, ``304`` responses get it back. Cached bodies are kept by
+    url as well as ETag. HEAD responses aren't compressed, so their
+    Content-Length stays accurate.
+    '''
+    codecs = ('br', 'gzip', 'deflate') if brotli else ('gzip', 'deflate')
+    etag_suffix = re.compile(r'-(?:br|gzip|deflate)"')
+
+    def __init__(self, application=None, min_size=1024,
+                 content_types=DEFAULT_CONTENT_TYPES, level=6, cache_size=256):
+        self.application = application
+        self.min_size = min_size
+        self.content_types = frozenset(content_types)
+        self.level = level
+        self.cache = LRUCache(cache_size) if cache_size else None
+
+    def __repr__(self):
+        return "<CompressionMiddleware {0!r}>".format(self.application)
+
+    def choose_codec(self, req):
+        '''Return the preferred codec the client accepts, or None.'''
+        if not req.environ.get('HTTP_ACCEPT_ENCODING'):
+            return None
+        offers = req.accept_encoding.acceptable_offers(self.codecs)
+        if offers:
+            return offers[0][0]
+        return None
+
+    def compressible(self, resp):
+        '''Return True if the response should be compressed.'''
+        return (200 <= resp.status_code < 300 and
+                resp.status_code not in (204, 206) and
+                'Content-Encoding' not in resp.headers and
+                resp.content_type in self.content_types)
+
+    def compressed_body(self, req, resp, codec):
+        '''Compress an in-memory body, using the cache when the response has
+        a strong ETag.'''
+        etag = resp.headers.get('ETag')
+        if self.cache is None or not etag or etag.startswith('W/'):
+            return compress(codec, resp.body, self.level)
+        # an ETag only identifies a representation of one url
+        key = (req.path_qs, etag, codec)
+        body = self.cache.get(key)
+        if body is None:
+            body = compress(codec, resp.body, self.level)
+            self.cache.set(key, body)
+        return body
+
+    def __call__(self, environ, start_response):
+        req = Request(environ)
+        codec = self.choose_codec(req)
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if codec and if_none_match:
+            # the application only knows its own ETags
+            environ['HTTP_IF_NONE_MATCH'] = self.etag_suffix.sub(
+                                                        '"', if_none_match)
+
+        resp = req.get_response(self.application)
+
+        if codec and resp.status_code == 304:
+            # answer with the ETag the client has, the one the compressed
+            # response was sent with
+            etag = resp.headers.get('ETag')
+            if etag and etag.endswith('"'):
+                compressed_etag = '{0}-{1}"'.format(etag[:-1], codec)
+                if compressed_etag in if_none_match:
+                    resp.headers['ETag'] = compressed_etag
+        elif self.compressible(resp):
+            vary = resp.vary or ()
+            if 'accept-encoding' not in [value.lower() for value in vary]:
+                resp.vary = tuple(vary) + ('Accept-Encoding',)
+            # HEAD responses have no body to compress and keep the
+            # Content-Length of the uncompressed body
+            if codec and req.method != 'HEAD':
+                etag = resp.headers.get('ETag')
+                if isinstance(resp.app_iter, (list, tuple)):
+                    if len(resp.body) >= self.min_size:
+                        resp.body = self.compressed_body(req, resp, codec)
+                        resp.content_encoding = codec
+                else:
+                    resp.app_iter = iter_compressed(resp.app_iter, codec,
+                                                    self.level)
+                    resp.content_length = None
+                    resp.content_encoding = codec
+                if (etag and etag.endswith('"') and
+                        resp.content_encoding == codec):
+                    resp.headers['ETag'] = '{0}-{1}"'.format(etag[:-1], codec)
+        return resp(environ, start_response)
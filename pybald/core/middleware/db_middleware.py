@@ -6,6 +6,30 @@ from webob import Response
 import logging
 log = logging.getLogger(__name__)
 
+class ClosingIterator(object):
+    '''Wraps a streamed response body, calling on_close after the WSGI
+    server closes it.'''
+    def __init__(self, app_iter, on_close):
+        self.app_iter = app_iter
+        self.on_close = on_close
+
+    def __iter__(self):
+        return iter(self.app_iter)
+
+    def close(self):
+        try:
+            close = getattr(self.app_iter, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self.on_close()
+
+
+def is_streamed(app_iter):
+    '''True if a response body is produced while it's being sent.'''
+    return not isinstance(app_iter, (list, tuple))
+
+
 class EndPybaldMiddleware(object):
     '''Utilitiy middleware to force remove current session at the end of
     the request.'''
@@ -13,11 +37,18 @@ class EndPybaldMiddleware(object):
         self.application = application
 
     def __call__(self, environ, start_response):
+        streamed = False
         try:
-            return self.application(environ, start_response)
+            app_iter = self.application(environ, start_response)
+            # streamed responses keep the session until they're sent
+            streamed = is_streamed(app_iter)
+            if streamed:
+                return ClosingIterator(app_iter, context.db.remove)
+            return app_iter
         finally:
-            # always, always, ALWAYS close the session regardless
-            context.db.remove()
+            if not streamed:
+                # always, always, ALWAYS close the session regardless
+                context.db.remove()
 
 
 class DbMiddleware(object):
@@ -33,6 +64,7 @@ class DbMiddleware(object):
             self.application = Response()
 
     def __call__(self, environ, start_response):
+        streamed = False
         # pass through if no exceptions occur, commit sessions on complete
         try:
             resp = self.application(environ, start_response)
@@ -45,7 +77,13 @@ class DbMiddleware(object):
             context.db.rollback()
             raise
         else:
+            # streamed responses can still read from the session while
+            # they're sent, it's closed once the server is done with them
+            streamed = is_streamed(resp)
+            if streamed:
+                return ClosingIterator(resp, context.db.remove)
             return resp
         finally:
-            # always, always, ALWAYS close the session regardless
-            context.db.remove()
+            if not streamed:
+                # always, always, ALWAYS close the session regardless
+                context.db.remove()
@@ -2,6 +2,9 @@
 # encoding: utf-8
 
 from webob import Response, exc
+from pybald.context import config
+from pybald.core.profiling import (collect_request_renders, stop_collecting,
+                                   current_request_renders)
 # from six.moves.urllib.parse import unquote
 import logging
 log = logging.getLogger(__name__)
@@ -27,7 +30,9 @@ def create_default_error_controller():
                 return req.get_response(self.exception)
             else:
                 if config.debug:
-                    stack_trace = render(template='stack_trace', data={'req': req})
+                    stack_trace = render(template='stack_trace', data={
+                                    'req': req,
+                                    'renders': current_request_renders()})
                     return Response(body=stack_trace, status=self.status_code)
                 else:
                     return req.get_response(exc.HTTPServerError('General Fault'))
@@ -63,33 +68,49 @@ class ErrorMiddleware(object):
             # no pipeline so just generate a generic response
             self.application = Response()
 
+    def http_error_handler(self, err):
+        '''Return the WSGI application that displays an HTTP exception.'''
+        log.debug(u"{0} Thrown: {1}".format(err.__class__.__name__, err))
+        # if the middleware is configured with an error controller
+        # use that to display the errors
+        if self.error_controller:
+            return self.error_controller(err, status_code=err.code)
+        # HTTPExceptions are also WSGI apps and can be called as such
+        return err
+
+    def error_handler(self, err):
+        '''Return the WSGI application that displays a general exception.'''
+        log.exception("General Exception thrown")
+        if self.error_controller:
+            return self.error_controller(err, message=str(err))
+        # create a generic HTTP server Error webob exception
+        return exc.HTTPServerError('General Fault')
+
     def __call__(self, environ, start_response):
+        # with template profiling on, keep this request's renders to list
+        # on the stack trace page
+        token = None
+        if getattr(config, 'template_profiling', False):
+            token = collect_request_renders()
+        try:
+            return self.handle(environ, start_response)
+        finally:
+            stop_collecting(token)
+
+    def handle(self, environ, start_response):
         #pass through if no exceptions occur
         try:
             return self.application(environ, start_response)
         # handle HTTP errors
         except exc.HTTPException as err:
-            log.debug(u"{0} Thrown: {1}".format(err.__class__.__name__, err))
-            # if the middleware is configured with an error controller
-            # use that to display the errors
-            if self.error_controller:
-                handler = self.error_controller(err, status_code=err.code)
-
-                try:
-                    # try executing error_handler code
-                    # otherwise re-raise the exception
-                    return handler(environ, start_response)
-                except Exception:
-                    log.exception("Exception thrown during error_controller handling")
-                    raise
-            else:
-                # HTTPExceptions are also WSGI apps and can be called as such
-                return err(environ, start_response)
+            handler = self.http_error_handler(err)
+            try:
+                # try executing error_handler code
+                # otherwise re-raise the exception
+                return handler(environ, start_response)
+            except Exception:
+                log.exception("Exception thrown during error_controller handling")
+                raise
         except Exception as err:
-            log.exception("General Exception thrown")
-            if self.error_controller:
-                handler = self.error_controller(err, message=str(err))
-            else:
-                # create a generic HTTP server Error webob exception
-                handler = exc.HTTPServerError('General Fault')
+            handler = self.error_handler(err)
             return handler(environ, start_response)
@@ -15,13 +15,20 @@ class SessionManager(object):
             # no pipeline so just generate a generic response
             self.application = Response()
 
-    def __call__(self, environ, start_response):
-        req = Request(environ)
-
+    def start_session(self, req):
+        '''Load (or create) the session for a request and add it to the
+        environ and the pybald extension.'''
+        environ = req.environ
         environ['pybald.session'] = self.session_class._before(req)
 
         # update or create the pybald.extension to populate controller instances
         environ.setdefault('pybald.extension', {})['session'] = environ['pybald.session']
+        return environ['pybald.session']
+
+    def __call__(self, environ, start_response):
+        req = Request(environ)
+
+        self.start_session(req)
 
         # call the next part of the pipeline
         resp = req.get_response(self.application)
@@ -31,4 +38,3 @@ class SessionManager(object):
         environ['pybald.session']._after(req, resp)
 
         return resp(environ,start_response)
-
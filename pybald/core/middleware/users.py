@@ -15,7 +15,9 @@ class UserManager(object):
             raise ValueError("User Manager Middleware doesn't work stand alone, it is expected to wrap another application.")
         self.application = application
 
-    def __call__(self, environ, start_response):
+    def set_user(self, environ):
+        '''Validate the session's user and record it in the environ as
+        REMOTE_USER and in the pybald extension.'''
         session = environ.get('pybald.session', None)
         environ['REMOTE_USER'] = session.user
 
@@ -39,5 +41,8 @@ class UserManager(object):
         # update or create the pybald.extension for other pybald aware WSGI code
         environ['pybald.extension'] = environ.get('pybald.extension', {})
         environ['pybald.extension']['user'] = environ['REMOTE_USER']
+
+    def __call__(self, environ, start_response):
+        self.set_user(environ)
         # call the next part of the pipeline
         return self.application(environ, start_response)
@@ -14,6 +14,7 @@ from sqlalchemy.orm.util import (
 from sqlalchemy.dialects import postgresql as pg
 
 from pybald import context
+from pybald.util.context import request_scope_id
 from pybald.util import camel_to_underscore, pluralize
 
 from pybald.db import ext
@@ -281,5 +282,11 @@ class ContextBoundModels(object):
         # build session
         if session_args is None:
             session_args = {}
-        session = self.scoped_session(self.sessionmaker(bind=engine, **session_args))
+        scopefunc = None
+        if getattr(self.config, 'database_request_scope', False):
+            # sessions follow the request rather than the thread, needed
+            # when requests hop between threads (ASGI)
+            scopefunc = request_scope_id
+        session = self.scoped_session(self.sessionmaker(bind=engine, **session_args),
+                                      scopefunc=scopefunc)
         return session
@@ -4,30 +4,54 @@
 
 import os
 from pybald import context
-from pybald.core.helpers import HTMLLiteral, AssetUrl
+from pybald.core.helpers import HTMLLiteral, asset_url
+from pybald.util.cache import LRUCache
 import logging
 log = logging.getLogger(__name__)
 
-# TODO - this singleton should be replaced
-asset_tag_cache = {}
+# mtime based asset tags by full path, used when there's no asset manifest
+asset_tag_cache = LRUCache(1024)
+
+
+def mtime_asset_tag(filename):
+    '''
+    Return the modification time of a static file as its asset tag.
+
+    Tags are cached, except in debug mode where files are checked for
+    changes every time. Missing files have no tag, and that isn't cached so
+    the real tag is used once the file exists.
+    '''
+    config = context.config
+    path = os.path.join(config.path, config.static_path, filename.lstrip("/"))
+    asset_tag = None if config.debug else asset_tag_cache.get(path)
+    if asset_tag is None:
+        try:
+            asset_tag = str(int(round(os.path.getmtime(path))))
+        except OSError:
+            return None
+        asset_tag_cache.set(path, asset_tag)
+    return asset_tag
+
 
 def compute_asset_tag(filename, pattern='{filename}{extension}?v={tag}'):
     '''
     Create a unique signature for a file.
 
-    This asset tag is used for cache busting.
+    This asset tag is used for cache busting. When the application has an
+    asset manifest (see :mod:`pybald.util.assets`) the tag is the hash of the
+    file's contents from the manifest, otherwise it's the file's modification
+    time. Files that don't exist have no tag and are returned as they are.
     '''
-    asset_tag = asset_tag_cache.get(filename, None)
-    try:
-        if not asset_tag:
-            asset_tag = str(
-                int(round(os.path.getmtime(os.path.join(context.config.path,
-                                                        "public",
-                                                        filename.lstrip("/"))))
-                ))
-        asset_tag_cache[filename] = asset_tag
-    except OSError:
-        asset_tag_cache[filename] = "xxx"
+    manifest = context.asset_manifest
+    if manifest:
+        asset_tag = manifest.get(filename if filename.startswith("/")
+                                 else "/" + filename)
+        if asset_tag is None:
+            asset_tag = mtime_asset_tag(filename)
+    else:
+        asset_tag = mtime_asset_tag(filename)
+    if asset_tag is None:
+        return filename
     filename, ext = os.path.splitext(filename)
     return pattern.format(filename=filename, tag=asset_tag, extension=ext)
 
@@ -38,7 +62,7 @@ def add_js(filename):
     This helper function is also config aware and will re-write asset urls
     based on CDN and other rules.'''
     return HTMLLiteral('''<script src="{0}"></script>'''.format(
-                                        AssetUrl(compute_asset_tag(filename))))
+                                        asset_url(compute_asset_tag(filename))))
 
 
 def add_css(filename, media="screen"):
@@ -47,7 +71,7 @@ def add_css(filename, media="screen"):
     This helper function is also config aware and will re-write asset urls
     based on CDN and other rules.'''
     return HTMLLiteral('''<link type="text/css" href="{0}" media="{1}" rel="stylesheet">'''.format(
-                                                AssetUrl(compute_asset_tag(filename)),
+                                                asset_url(compute_asset_tag(filename)),
                                                 str(media)))
 
 
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+Template render profiling.
+
+With the ``template_profiling`` config option on, the template engine
+records every template it renders (views, partials and forms) in
+``context.render.profiler``: the render count, total and slowest wall time,
+output size and the time spent rendering nested partials, by template.
+
+    >>> for uri, stats in context.render.profiler.top(5):
+    ...     print(uri, stats.count, stats.total, stats.self_time)
+
+The renders of the current request are also kept, when the
+``ErrorMiddleware`` is in the pipeline, and listed on the debug stack trace
+page.
+'''
+from threading import Lock, local
+from timeit import default_timer
+try:
+    from contextvars import ContextVar
+except ImportError:
+    ContextVar = None
+import logging
+log = logging.getLogger(__name__)
+
+# the renders of the request being handled, a list of RenderRecords or None
+# when nothing is collecting them
+request_renders = ContextVar('pybald_request_renders',
+                             default=None) if ContextVar else None
+
+
+class TemplateStats(object):
+    '''The render counters for a single template.'''
+    __slots__ = ('count', 'total', 'max', 'size', 'nested')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.size = 0
+        self.nested = 0.0
+
+    def __repr__(self):
+        return "<TemplateStats {0} renders {1:.6f}s>".format(self.count,
+                                                             self.total)
+
+    @property
+    def mean(self):
+        '''The average render time in seconds.'''
+        return self.total / self.count if self.count else 0.0
+
+    @property
+    def self_time(self):
+        '''The render time not spent in nested templates.'''
+        return self.total - self.nested
+
+
+class RenderRecord(object):
+    '''A single render, as listed for a request.'''
+    __slots__ = ('uri', 'depth', 'start', 'duration', 'nested', 'size')
+
+    def __init__(self, uri, depth):
+        self.uri = uri
+        self.depth = depth
+        self.start = default_timer()
+        self.duration = 0.0
+        self.nested = 0.0
+        self.size = 0
+
+    def __repr__(self):
+        return "<RenderRecord {0} {1:.6f}s>".format(self.uri, self.duration)
+
+
+class TemplateProfiler(object):
+    '''
+    Render counts, times and output sizes by template.
+
+    The template engine calls ``start`` before and ``stop`` after each
+    render. Renders that happen during another render (partials called from
+    a template) are counted towards the outer template's ``nested`` time.
+    Streamed renders aren't profiled, their time depends on the client.
+    '''
+    def __init__(self):
+        self._stats = {}
+        self._local = local()
+        self._lock = Lock()
+
+    def __repr__(self):
+        return "<TemplateProfiler {0} templates>".format(len(self._stats))
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            stack = self._local.stack = []
+            return stack
+
+    def start(self, uri):
+        '''Start timing a render of the template, returns the record to pass
+        to ``stop``.'''
+        stack = self._stack()
+        record = RenderRecord(uri, len(stack))
+        stack.append(record)
+        renders = request_renders.get() if request_renders else None
+        if renders is not None:
+            renders.append(record)
+        return record
+
+    def stop(self, record, output=None):
+        '''Finish timing a render and record it.'''
+        record.duration = default_timer() - record.start
+        if output is not None:
+            record.size = len(output)
+        stack = self._stack()
+        # an exception in a nested render can leave its record behind
+        while stack and stack.pop() is not record:
+            pass
+        if stack:
+            stack[-1].nested += record.duration
+        with self._lock:
+            try:
+                stats = self._stats[record.uri]
+            except KeyError:
+                stats = self._stats[record.uri] = TemplateStats()
+            stats.count += 1
+            stats.total += record.duration
+            stats.max = max(stats.max, record.duration)
+            stats.size += record.size
+            stats.nested += record.nested
+
+    def stats(self):
+        '''Return a dictionary of template uri to a copy of its
+        ``TemplateStats``.'''
+        with self._lock:
+            snapshot = {}
+            for uri, stats in self._stats.items():
+                copy = snapshot[uri] = TemplateStats()
+                for name in TemplateStats.__slots__:
+                    setattr(copy, name, getattr(stats, name))
+            return snapshot
+
+    def top(self, count=10, key='total'):
+        '''Return the (uri, stats) pairs of the templates with the highest
+        value of a ``TemplateStats`` attribute (``total``, ``self_time``,
+        ``max``, ``count``...), highest first.'''
+        return sorted(self.stats().items(),
+                      key=lambda item: getattr(item[1], key),
+                      reverse=True)[:count]
+
+    def reset(self):
+        '''Throw away everything recorded so far.'''
+        with self._lock:
+            self._stats.clear()
+
+
+def collect_request_renders():
+    '''Start collecting the renders of the current request, returns a token
+    for ``stop_collecting``.'''
+    if request_renders is None:
+        return None
+    return request_renders.set([])
+
+
+def stop_collecting(token):
+    '''Stop collecting the renders of the current request.'''
+    if token is not None:
+        request_renders.reset(token)
+
+
+def current_request_renders():
+    '''Return a list of the RenderRecords of the current request so far, or
+    None if they're not being collected.'''
+    renders = request_renders.get() if request_renders else None
+    if renders is None:
+        return None
+    return list(renders)
@@ -6,6 +6,12 @@ from routes import Mapper, request_config, URLGenerator
 # handle Mako's top level lookup
 from mako import exceptions
 from pybald.util import camel_to_underscore
+from pybald.core.dispatch import CompiledDispatcher
+from pybald.core.metrics import RouteMetrics
+from pybald.util.cache import LRUCache, MISSING
+from threading import Lock
+from timeit import default_timer
+from types import FunctionType
 import logging
 log = logging.getLogger(__name__)
 
@@ -16,7 +22,10 @@ class Router(object):
 
     # add controllers=None to the call sig and use that for controller
     # loading
-    def __init__(self, application=None, routes=None, controllers=None):
+    def __init__(self, application=None, routes=None, controllers=None,
+                 compile_routes=False, match_cache_size=0,
+                 override_body_limit=1024 * 1024, metrics=None,
+                 metrics_path=None):
         '''
         Create a Router object, the core of the pybald framework.
 
@@ -31,6 +40,30 @@ class Router(object):
                             security precaution since only registered
                             controllers can be matched against.
 
+        :param compile_routes: Compile the url map into a segment trie
+                               (see :class:`~pybald.core.dispatch.CompiledDispatcher`)
+                               instead of scanning every route's regex on
+                               each request. Useful for applications with
+                               many routes.
+
+        :param match_cache_size: Keep the route match results for this many
+                                 (method, host, path) combinations in an LRU
+                                 cache. Useful when most traffic goes to a
+                                 small set of urls. Zero (the default)
+                                 disables the cache.
+
+        :param override_body_limit: The largest urlencoded POST body (in
+                                    bytes) that will be parsed looking for a
+                                    ``_method`` override parameter.
+
+        :param metrics: Record request counts, errors and latency for every
+                        route. Either True or a
+                        :class:`~pybald.core.metrics.RouteMetrics` instance.
+
+        :param metrics_path: If set (e.g. ``'/metrics'``), requests for this
+                             path are answered with the recorded metrics in
+                             the Prometheus text format.
+
         '''
         if routes is None or not callable(routes):
             raise TypeError("Route mapping is required. Please pass in a "
@@ -41,6 +74,19 @@ class Router(object):
                             "See pybald docs for more details.")
 
         self.controllers = {}
+        self.actions = {}
+        self.compile_routes = compile_routes
+        self.dispatcher = None
+        self.match_cache = None
+        if match_cache_size:
+            self.match_cache = LRUCache(match_cache_size)
+        self.override_body_limit = override_body_limit
+        if metrics is True:
+            metrics = RouteMetrics()
+        self.metrics = metrics or None
+        self.metrics_path = metrics_path
+        self._mapped_routes = 0
+        self._map_lock = Lock()
         # initialize Router
         # explicit turns off route memory and 'index' for
         # default action
@@ -67,6 +113,12 @@ class Router(object):
         The _controller suffix is removed from the module name for the url
         route mapping table (so controller="home" matches home_controller).
 
+        The public methods of every controller are also collected into the
+        ``actions`` dispatch table so matching a request to an action
+        doesn't require searching the controller class on every request.
+        Actions replaced on a controller class after loading won't be seen
+        until ``load`` is run again.
+
         This method is called only once at the start of a pybald application.
         '''
 
@@ -84,15 +136,195 @@ class Router(object):
             # self.controllers holds paths to map to modules and controller
             # names
             self.controllers[controller_path_name] = controller
+            for action_name, action in self.controller_actions(controller):
+                self.actions[controller_path_name, action_name] = (controller,
+                                                                   action)
 
         # register the controller module names
         # with the mapper, creates the internal regular
         # expressions
         self.map.create_regs(controller_names)
+        self._build_dispatch()
+
+    def _build_dispatch(self):
+        '''Rebuild everything derived from the url map: the compiled
+        dispatcher and the match cache.'''
+        if self.compile_routes:
+            self.dispatcher = CompiledDispatcher(self.map,
+                                                 list(self.controllers))
+        # routes with condition functions can depend on anything in the
+        # environ, so matches on or after them can't be cached
+        self._route_index = {}
+        self._cacheable_before = len(self.map.matchlist)
+        for index, route in enumerate(self.map.matchlist):
+            self._route_index[id(route)] = index
+            if (route.conditions and 'function' in route.conditions and
+                    index < self._cacheable_before):
+                self._cacheable_before = index
+        self.static_routes = self.build_static_routes()
+        if self.match_cache is not None:
+            self.match_cache.clear()
+        self._mapped_routes = len(self.map.matchlist)
+
+    def build_static_routes(self):
+        '''
+        Build the exact match table for routes without any url variables
+        (``/``, ``/about``...).
+
+        The table maps ``(method, path)`` to the ``(urlvars, route)`` match
+        result, with a method of None for routes that match any method. Paths
+        where an earlier route with variables, a redirect or a condition
+        function could also match are stored as None so they go through
+        the regular matching and the first matching route still wins.
+        '''
+        mapper = self.map
+        if mapper.prefix or mapper.sub_domains or mapper.debug:
+            return {}
+
+        def is_static(route):
+            conditions = route.conditions or {}
+            return (not route.minimization and not route.redirect and
+                    'function' not in conditions and
+                    'sub_domain' not in conditions and
+                    'controller' in route.defaults and
+                    'action' in route.defaults and
+                    all(not isinstance(part, dict)
+                        for part in route.routelist))
+
+        candidates = dict((id(route), ''.join(route.routelist))
+                          for route in mapper.matchlist
+                          if not route.static and is_static(route))
+        paths = set(candidates.values())
+        table = {}
+        # paths already taken for every method by an earlier route
+        claimed = set()
+        for route in mapper.matchlist:
+            if route.static:
+                continue
+            methods = (route.conditions or {}).get('method') or [None]
+            if id(route) in candidates:
+                entry = (route.defaults.copy(), route)
+                matched = [candidates[id(route)]]
+            else:
+                entry = None
+                matched = [path for path in paths
+                           if route.regmatch.match(path)]
+            for path in matched:
+                if path in claimed:
+                    continue
+                for method in methods:
+                    table.setdefault((method, path), entry)
+                if methods == [None]:
+                    claimed.add(path)
+        return table
 
     def __repr__(self):
         return "<Router Object>"
 
+    @staticmethod
+    def controller_actions(controller):
+        '''Yield the name and function of every method on a controller class
+        that can be dispatched to as an action.
+
+        Only plain functions are included, methods starting with an underscore
+        are never actions.
+        '''
+        seen = set()
+        for klass in getattr(controller, '__mro__', ()):
+            for name, value in vars(klass).items():
+                if name in seen:
+                    continue
+                seen.add(name)
+                if not name.startswith('_') and isinstance(value, FunctionType):
+                    yield name, value
+
+    def _check_map(self):
+        '''Rebuild the dispatch structures if the url map changed after
+        loading.'''
+        if len(self.map.matchlist) != self._mapped_routes:
+            with self._map_lock:
+                if len(self.map.matchlist) != self._mapped_routes:
+                    self.map.create_regs(list(self.controllers))
+                    self._build_dispatch()
+
+    def match_static(self, environ):
+        '''Look the request up in the exact match table for routes without
+        url variables. Returns the ``(urlvars, route)`` tuple or None.'''
+        self._check_map()
+        path = environ['PATH_INFO']
+        table = self.static_routes
+        results = table.get((environ['REQUEST_METHOD'], path), MISSING)
+        if results is MISSING:
+            results = table.get((None, path))
+        if results:
+            urlvars, route = results
+            return dict(urlvars), route
+        return None
+
+    def match(self, environ):
+        '''Match the request against the url map and return the
+        ``(urlvars, route)`` tuple, or None if nothing matched.
+
+        Uses the compiled dispatcher when one has been built and the match
+        cache when enabled.
+        '''
+        self._check_map()
+
+        if self.match_cache is None:
+            return self._match(environ)
+
+        key = (environ['REQUEST_METHOD'],
+               environ.get('HTTP_HOST') or environ.get('SERVER_NAME'),
+               environ['PATH_INFO'])
+        results = self.match_cache.get(key, MISSING)
+        if results is MISSING:
+            results = self._match(environ)
+            if results:
+                index = self._route_index.get(id(results[1]))
+                if index is not None and index < self._cacheable_before:
+                    urlvars, route = results
+                    self.match_cache.set(key, (dict(urlvars), route))
+            elif self._cacheable_before == self._mapped_routes:
+                self.match_cache.set(key, results)
+            return results
+        if results:
+            # hand out a copy, urlvars are modified further down the pipeline
+            urlvars, route = results
+            return dict(urlvars), route
+        return results
+
+    def _match(self, environ):
+        if self.dispatcher is not None:
+            return self.dispatcher.match(environ=environ)
+        return self.map.routematch(environ=environ)
+
+    def method_override(self, req):
+        '''
+        Return the HTTP method a POST request asks to be treated as, or None.
+
+        The ``X-HTTP-Method-Override`` header is checked first since it
+        doesn't require reading the request body. Otherwise a ``_method``
+        parameter is looked for in urlencoded form bodies no larger than
+        ``override_body_limit``. Other bodies (multipart uploads in particular)
+        are never parsed here and stream through untouched to the controller.
+        '''
+        environ = req.environ
+        if environ['REQUEST_METHOD'] != 'POST':
+            return None
+        override_method = environ.get('HTTP_X_HTTP_METHOD_OVERRIDE')
+        if override_method:
+            return override_method
+        content_type = environ.get('CONTENT_TYPE', '').split(';', 1)[0]
+        if content_type.strip().lower() != 'application/x-www-form-urlencoded':
+            return None
+        try:
+            content_length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return None
+        if not 0 < content_length <= self.override_body_limit:
+            return None
+        return req.POST.pop('_method', None)
+
     def get_handler(self, urlvars):
         '''Method that returns the callable code mapped to this current
         request.
@@ -100,13 +332,30 @@ class Router(object):
         This method can be overriden to change the behavior of mapping.
         '''
         controller_name, action_name = urlvars["controller"], urlvars["action"]
+
+        if log.isEnabledFor(logging.DEBUG):
+            for key, value in urlvars.items():
+                log.debug(u'''{0}: {1}'''.format(key, value))
+
+        # the fast path, straight from the dispatch table built at load
+        try:
+            controller_class, action = self.actions[controller_name,
+                                                    action_name]
+        except (KeyError, TypeError):
+            pass
+        else:
+            try:
+                controller = controller_class()
+            except (KeyError, AttributeError):
+                raise exc.HTTPNotFound("Missing Controller or Action")
+            # unless the instance shadows the action with its own attribute
+            if action_name not in getattr(controller, '__dict__', ()):
+                return action.__get__(controller, controller_class)
+
         #methods starting with underscore can't be used as actions
         if action_name.startswith("_"):
             raise exc.HTTPNotFound("Invalid Action")
 
-        for key, value in urlvars.items():
-            log.debug(u'''{0}: {1}'''.format(key, value))
-
         try:
             # create controller instance from controllers dictionary
             # using routes 'controller' returned from the match
@@ -119,25 +368,40 @@ class Router(object):
 
         return handler
 
-    def __call__(self, environ, start_response):
+    def bind_request_config(self, environ, req=None):
         '''
-        A Router instance is a WSGI app. It accepts the standard WSGI call
-        signature of ``environ``, ``start_response``.
+        Populate the Routes ``request_config`` for the current thread from an
+        environ the router has already matched.
 
-        The Router has a few jobs. First it uses the Routes package to
-        compare the requested path to available url patterns that have
-        been loaded and passed to the Router upon init.
+        ``request_config`` is a thread local, so this needs to be re-run when
+        a request is handed off to another thread (see :mod:`pybald.core.asgi`).
+        '''
+        if req is None:
+            req = Request(environ)
+        config = request_config()
 
-        Router is the most *framework-like* component of Pybald. In addition to
-        dispatching urls to controllers, it also allows 'method override'
-        behavior allowing other HTTP methods to be invoked such as ``put`` and
-        ``delete`` from web clients that don't support them natively.
+        # Your mapper object
+        config.mapper = self.map
+        # The dict from m.match for this URL request
+        config.mapper_dict = environ['wsgiorg.routing_args'][1]
+        config.host = req.host
+        config.protocol = req.scheme
+        # defines the redirect method. In this case it generates a
+        # Webob Response object with the location and status headers
+        # set
+        config.redirect = lambda url: Response(location=url, status=302)
+        return config
 
-        :param environ: WSGI CGI-like request environment
+    def resolve(self, environ):
+        '''
+        Match the request and return the WSGI application that will handle
+        it, usually a controller action.
 
-        :param start_response: WSGI callback for starting the response and
-                               setting HTTP response headers
+        :param environ: WSGI CGI-like request environment
 
+        This sets up the environ (url generator, routing args, pybald
+        extension) and request config exactly as when the Router is called,
+        raising an HTTPNotFound if nothing matched.
         '''
         req = Request(environ)
         req.errors = 'ignore'
@@ -145,38 +409,26 @@ class Router(object):
         #===============
         # for REST architecture, this allows a POST parameter of _method
         # to be used to override POST with alternate HTTP verbs (PUT, DELETE)
-        if req.POST:
-            override_method = req.POST.pop('_method', None)
-            if override_method is not None:
-                environ['REQUEST_METHOD'] = override_method.upper()
-                log.debug("Changing request method to {0}".format(
-                                                        environ["REQUEST_METHOD"]))
-
-        results = self.map.routematch(environ=environ)
+        override_method = self.method_override(req)
+        if override_method is not None:
+            environ['REQUEST_METHOD'] = override_method.upper()
+            log.debug("Changing request method to %s", environ["REQUEST_METHOD"])
+
+        # routes without url variables are a single dict lookup
+        results = self.match_static(environ) or self.match(environ)
         if results:
             urlvars, route = results
         else:
             urlvars, route = {}, None
 
         url = URLGenerator(self.map, environ)
-        config = request_config()
-
-        # Your mapper object
-        config.mapper = self.map
-        # The dict from m.match for this URL request
-        config.mapper_dict = urlvars
-        config.host = req.host
-        config.protocol = req.scheme
-        # defines the redirect method. In this case it generates a
-        # Webob Response object with the location and status headers
-        # set
-        config.redirect = lambda url: Response(location=url, status=302)
 
         # TODO: routing args is supposed to be pos, key dict
         environ.update({'wsgiorg.routing_args': ((url), urlvars),
                         'routes.route': route,
                         'routes.url': url,
                         'pybald.router': self})
+        self.bind_request_config(environ, req)
 
         # Add pybald extension
         # the pybald.extension is a dictionary that can be used to copy state
@@ -184,8 +436,9 @@ class Router(object):
         environ.setdefault('pybald.extension', {})["url_for"] = url
 
         # debug print messages
-        log.debug('{0:=^79}'.format(' {0} '.format(req.path_qs)))
-        log.debug('Method: {0}'.format(req.method))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('{0:=^79}'.format(' {0} '.format(req.path_qs)))
+            log.debug('Method: {0}'.format(req.method))
 
         # lifted from Routes middleware, handles 'redirect'
         # routes (map.redirect)
@@ -194,14 +447,43 @@ class Router(object):
             location = url(route_name, **urlvars)
             return Response(location=location,
                             status=route.redirect_status
-                            )(environ, start_response)
+                            )
 
         if urlvars:
-            handler = self.get_handler(urlvars)
+            return self.get_handler(urlvars)
         # No URL vars means nothing matched in the mapper function
         else:
             raise exc.HTTPNotFound("No URL match")
 
+    def __call__(self, environ, start_response):
+        '''
+        A Router instance is a WSGI app. It accepts the standard WSGI call
+        signature of ``environ``, ``start_response``.
+
+        The Router has a few jobs. First it uses the Routes package to
+        compare the requested path to available url patterns that have
+        been loaded and passed to the Router upon init.
+
+        Router is the most *framework-like* component of Pybald. In addition to
+        dispatching urls to controllers, it also allows 'method override'
+        behavior allowing other HTTP methods to be invoked such as ``put`` and
+        ``delete`` from web clients that don't support them natively.
+
+        :param environ: WSGI CGI-like request environment
+
+        :param start_response: WSGI callback for starting the response and
+                               setting HTTP response headers
+
+        '''
+        if self.metrics is not None:
+            if environ['PATH_INFO'] == self.metrics_path:
+                return self.metrics(environ, start_response)
+            return self.measure(environ, start_response)
+        return self.dispatch(environ, start_response)
+
+    def dispatch(self, environ, start_response):
+        '''Resolve the request and call the handler.'''
+        handler = self.resolve(environ)
         try:
             # call the action we determined from the mapper
             return handler(environ, start_response)
@@ -211,3 +493,40 @@ class Router(object):
         # All other program errors are allowed to bubble up
         # e.g. a 500 server error
 
+    @staticmethod
+    def route_name(environ):
+        '''The name a request is recorded under in the metrics: the route
+        name, or controller.action for unnamed routes.'''
+        route = environ.get('routes.route')
+        if route is not None and route.name:
+            return route.name
+        urlvars = environ.get('wsgiorg.routing_args', ((), {}))[1]
+        if urlvars:
+            return u'{0}.{1}'.format(urlvars.get('controller'),
+                                     urlvars.get('action'))
+        return u'unmatched'
+
+    def measure(self, environ, start_response):
+        '''Dispatch the request, recording its latency and outcome in the
+        route metrics.'''
+        statuses = []
+
+        def recording_start_response(status, headers, exc_info=None):
+            statuses.append(status)
+            return start_response(status, headers, exc_info)
+
+        start = default_timer()
+        error = False
+        try:
+            return self.dispatch(environ, recording_start_response)
+        except exc.HTTPException as err:
+            error = getattr(err, 'code', 500) >= 500
+            raise
+        except Exception:
+            error = True
+            raise
+        finally:
+            if statuses and statuses[-1][:1] == '5':
+                error = True
+            self.metrics.record(self.route_name(environ),
+                                default_timer() - start, error)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+Background tasks that run after the response is sent.
+
+Actions register work that doesn't need to hold up the response (sending
+email, audit logging, cache warming) with ``Controller._after_response``.
+The tasks are handed to ``context.background_tasks``, a bounded thread pool
+owned by the application context, once the response has been sent.
+
+Put the ``AfterResponseMiddleware`` at the top of the WSGI stack so tasks
+start only after the server has finished sending the response (and the
+database middleware has committed). Without it, tasks are submitted as soon
+as the action returns.
+'''
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from pybald import context
+import logging
+log = logging.getLogger(__name__)
+
+
+class TaskPool(object):
+    '''
+    A bounded thread pool for background tasks.
+
+    :param max_workers: The number of worker threads.
+    :param max_queue: The most tasks that can be waiting or running at once.
+                      Tasks submitted beyond that are rejected (and logged)
+                      rather than holding up the request.
+
+    ``stats()`` reports the queue depth and the submitted, completed,
+    failed and rejected counts. ``shutdown()`` stops accepting tasks and
+    drains the ones already queued.
+    '''
+    def __init__(self, max_workers=4, max_queue=1000):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.pending = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.closed = False
+        self._lock = Lock()
+
+    def __repr__(self):
+        return "<TaskPool {0} workers, {1} pending>".format(self.max_workers,
+                                                            self.pending)
+
+    def _run(self, func, pargs, kargs):
+        try:
+            func(*pargs, **kargs)
+        except Exception:
+            log.exception("Background task {0!r} failed".format(func))
+            failed = True
+        else:
+            failed = False
+        with self._lock:
+            self.pending -= 1
+            if failed:
+                self.failed += 1
+            else:
+                self.completed += 1
+
+    def submit(self, func, *pargs, **kargs):
+        '''Queue a function to run on the pool. Returns False if the task
+        was rejected because the queue is full or the pool is shut down.'''
+        with self._lock:
+            if self.closed or self.pending >= self.max_queue:
+                self.rejected += 1
+                log.warning("Background task {0!r} rejected, {1} tasks "
+                            "pending".format(func, self.pending))
+                return False
+            self.pending += 1
+            self.submitted += 1
+            self.executor.submit(self._run, func, pargs, kargs)
+        return True
+
+    def stats(self):
+        '''Return a dictionary of the queue depth and task counters.'''
+        with self._lock:
+            return dict(workers=self.max_workers, pending=self.pending,
+                        submitted=self.submitted, completed=self.completed,
+                        failed=self.failed, rejected=self.rejected)
+
+    def shutdown(self, wait=True):
+        '''Stop accepting tasks and, if wait is set, block until the queued
+        tasks have finished.'''
+        with self._lock:
+            self.closed = True
+        self.executor.shutdown(wait=wait)
+
+
+def submit_tasks(environ, tasks):
+    '''
+    Hand tasks registered by an action over to the background pool.
+
+    If the ``AfterResponseMiddleware`` is in the pipeline, the tasks are held
+    until the response has been sent, otherwise they're submitted now.
+    '''
+    deferred = environ.get('pybald.after_response')
+    if deferred is not None:
+        deferred.extend(tasks)
+        return
+    for func, pargs, kargs in tasks:
+        context.background_tasks.submit(func, *pargs, **kargs)
+
+
+class TaskIterator(object):
+    '''Wraps a response body, submitting the request's background tasks
+    once the WSGI server closes it.'''
+    def __init__(self, app_iter, tasks, pool):
+        self.app_iter = app_iter
+        self.tasks = tasks
+        self.pool = pool
+
+    def __iter__(self):
+        return iter(self.app_iter)
+
+    def close(self):
+        try:
+            close = getattr(self.app_iter, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            for func, pargs, kargs in self.tasks:
+                self.pool.submit(func, *pargs, **kargs)
+
+
+class AfterResponseMiddleware(object):
+    '''
+    Runs background tasks registered during a request after the response has
+    been sent.
+
+    :param application: The WSGI application to wrap, this should be the top
+                        of the stack.
+    :param pool: The ``TaskPool`` to run tasks on, ``context.background_tasks``
+                 by default.
+    '''
+    def __init__(self, application, pool=None):
+        self.application = application
+        self.pool = pool
+
+    def __call__(self, environ, start_response):
+        tasks = environ['pybald.after_response'] = []
+        app_iter = self.application(environ, start_response)
+        pool = self.pool if self.pool is not None else context.background_tasks
+        return TaskIterator(app_iter, tasks, pool)
@@ -2,11 +2,34 @@
 # encoding: utf-8
 
 import os
+import sys
+import hashlib
+from threading import Thread
+from timeit import default_timer
+from six import reraise, string_types
+from six.moves.queue import Queue, Empty, Full
+from routes import request_config
 from pybald.context import config
+from pybald.util.cache import LRUCache, MemoryCache, TaggedCache
+from pybald.core.profiling import TemplateProfiler
 from mako.template import Template
+from mako.cache import CacheImpl, register_plugin
 from mako.lookup import TemplateLookup
+from mako.runtime import Context, _kwargs_for_callable
 import re
 import logging
+try:
+    from collections import ChainMap
+except ImportError:
+    # the chainmap backport on python 2
+    from chainmap import ChainMap
+from mako.exceptions import NameConflictError
+from mako.util import FastEncodingBuffer
+from mako.compat import inspect_getargspec
+try:
+    from contextvars import copy_context
+except ImportError:
+    copy_context = None
 
 log = logging.getLogger(__name__)
 
@@ -14,6 +37,276 @@ log = logging.getLogger(__name__)
 # regex check of that pattern
 TEMPLATE_PATTERN = re.compile(r'([^\.]+)\.([^\.]+)\.template$')
 
+# the routes request_config attributes a streaming render carries over to
+# its rendering thread
+REQUEST_CONFIG_ATTRIBUTES = ('mapper', 'mapper_dict', 'host', 'protocol',
+                             'redirect')
+
+TAG_SEPARATOR = re.compile(r'[\s,]+')
+
+
+def split_tags(tags):
+    '''Tags can be given as a list or a comma or space separated string.'''
+    if not tags:
+        return ()
+    if isinstance(tags, string_types):
+        return tuple(tag for tag in TAG_SEPARATOR.split(tags) if tag)
+    return tuple(tags)
+
+
+class FragmentCacheImpl(CacheImpl):
+    '''
+    A Mako cache plugin that stores cached blocks in the template engine's
+    fragment cache.
+
+    It's the default cache implementation for pybald templates so blocks
+    marked ``cached="True"`` are rendered once and then served from the
+    fragment cache::
+
+        <%block name="nav" cached="True" cache_key="nav"
+                cache_timeout="300" cache_tags="nav, categories">
+            ...
+        </%block>
+
+    ``cache_timeout`` is the ttl in seconds and ``cache_tags`` the tags to
+    invalidate the block with. Keys are prefixed with the template uri.
+    '''
+    pass_context = False
+
+    @property
+    def fragment_cache(self):
+        from pybald import context
+        return context.render.fragment_cache
+
+    def _key(self, key):
+        return 'block:{0}:{1}'.format(self.cache.template.uri, key)
+
+    def get_or_create(self, key, creation_function, **kw):
+        fragment_cache = self.fragment_cache
+        if fragment_cache is None:
+            return creation_function()
+        key = self._key(key)
+        value = fragment_cache.get(key)
+        if value is None:
+            value = creation_function()
+            fragment_cache.set(key, value, kw.get('timeout') or 0,
+                               split_tags(kw.get('tags')))
+        return value
+
+    def set(self, key, value, **kw):
+        if self.fragment_cache is not None:
+            self.fragment_cache.set(self._key(key), value,
+                                    kw.get('timeout') or 0,
+                                    split_tags(kw.get('tags')))
+
+    def get(self, key, **kw):
+        if self.fragment_cache is not None:
+            return self.fragment_cache.get(self._key(key))
+
+    def invalidate(self, key, **kw):
+        if self.fragment_cache is not None:
+            self.fragment_cache.delete(self._key(key))
+
+
+register_plugin('pybald', __name__, 'FragmentCacheImpl')
+
+
+def render_data(data):
+    '''Layer the data for a render over the ``page_options`` config, without
+    copying either.'''
+    return ChainMap(data, config.page_options)
+
+
+class LayeredContext(Context):
+    '''
+    A Mako context that looks names up in layers of render data.
+
+    ``Template.render(**data)`` copies the data into the context (and again
+    into the page's ``pageargs``). This context references the layers of a
+    ``ChainMap`` instead, the controller's ``__dict__`` and the page options
+    for example. Names Mako and the template set go into a new top layer so
+    the render data is never changed.
+    '''
+    def __init__(self, buffer, data):
+        Context.__init__(self, buffer)
+        layers = data.maps if isinstance(data, ChainMap) else [data]
+        self._data = ChainMap(self._data, *layers)
+        self._kwargs = data
+
+    def _set_with_template(self, t):
+        self._with_template = t
+        # check the reserved names against the layers, rather than
+        # iterating every key in them
+        illegal_names = [name for name in t.reserved_names
+                         if name in self._data]
+        if illegal_names:
+            raise NameConflictError("Reserved words passed to render(): "
+                                    "{0}".format(", ".join(illegal_names)))
+
+
+def page_kwargs(template, data):
+    '''The keyword arguments to call the template's page with. Pages that
+    take ``**pageargs`` (the default) get the top layer of the data, the
+    values passed for this render, plus any arguments the page declares.'''
+    kwargs = _kwargs_for_callable(template.callable_, data)
+    if kwargs is data and isinstance(data, ChainMap):
+        kwargs = data.maps[0]
+        declared = [arg for arg in inspect_getargspec(template.callable_)[0]
+                    if arg != 'context' and arg not in kwargs and arg in data]
+        if declared:
+            kwargs = dict(kwargs)
+            kwargs.update((arg, data[arg]) for arg in declared)
+    return kwargs
+
+
+def render_layered(template, data, as_unicode=False):
+    '''Render a template with a ``LayeredContext``, the equivalent of
+    ``template.render(**data)`` (or ``render_unicode``) for layered data.'''
+    if as_unicode:
+        buf = FastEncodingBuffer()
+    else:
+        buf = FastEncodingBuffer(encoding=template.output_encoding,
+                                 errors=template.encoding_errors)
+    context = LayeredContext(buf, data)
+    context._outputting_as_unicode = as_unicode
+    context._set_with_template(template)
+    template.render_context(context, **page_kwargs(template, data))
+    return context._pop_buffer().getvalue()
+
+
+class StreamClosed(Exception):
+    '''Raised inside a streaming render when the client has gone away.'''
+
+
+class ChunkWriter(object):
+    '''A Mako output buffer that hands off encoded chunks of at least
+    chunk_size characters instead of holding the whole page.'''
+    def __init__(self, put, chunk_size, encoding, errors):
+        self.put = put
+        self.chunk_size = chunk_size
+        self.encoding = encoding
+        self.errors = errors
+        self.pieces = []
+        self.size = 0
+
+    def write(self, text):
+        self.pieces.append(text)
+        self.size += len(text)
+        if self.size >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.pieces:
+            chunk = u''.join(self.pieces)
+            self.pieces = []
+            self.size = 0
+            self.put(chunk.encode(self.encoding, self.errors))
+
+
+class StreamingRender(object):
+    '''
+    An iterator of encoded chunks of a rendered template, suitable as a
+    WSGI ``app_iter``.
+
+    Mako writes its output as a single call stack, so the template is
+    rendered on a separate thread that hands chunks over through a small
+    bounded queue. Rendering stays at most a couple of chunks ahead of the
+    client so memory use doesn't grow with the size of the page. The routes
+    request config and context variables of the request are carried over to
+    the rendering thread.
+    '''
+    # chunks the render thread can get ahead of the client
+    queue_size = 2
+    # how long to wait for the client before checking if it's gone
+    poll_interval = 0.5
+
+    def __init__(self, template, data, chunk_size):
+        self.template = template
+        self.data = data
+        self.chunk_size = chunk_size
+        self.queue = Queue(self.queue_size)
+        self.closed = False
+        self.thread = None
+        self.context = copy_context() if copy_context else None
+        routes_config = request_config()
+        self.routes_config = dict((name, getattr(routes_config, name))
+                                  for name in REQUEST_CONFIG_ATTRIBUTES
+                                  if hasattr(routes_config, name))
+
+    def put(self, item):
+        while True:
+            if self.closed:
+                raise StreamClosed()
+            try:
+                return self.queue.put(item, timeout=self.poll_interval)
+            except Full:
+                continue
+
+    def render(self):
+        '''Render the template into the queue, runs on its own thread.'''
+        routes_config = request_config()
+        for name, value in self.routes_config.items():
+            setattr(routes_config, name, value)
+        template = self.template
+        writer = ChunkWriter(self.put, self.chunk_size,
+                             template.output_encoding or 'utf-8',
+                             template.encoding_errors)
+        context = LayeredContext(writer, self.data)
+        context._outputting_as_unicode = True
+        try:
+            context._set_with_template(template)
+            template.render_context(context, **page_kwargs(template,
+                                                           self.data))
+            writer.flush()
+        except StreamClosed:
+            return
+        except Exception:
+            try:
+                self.put(sys.exc_info())
+            except StreamClosed:
+                pass
+            return
+        try:
+            self.put(None)
+        except StreamClosed:
+            pass
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.closed:
+            raise StopIteration
+        if self.thread is None:
+            if self.context is not None:
+                self.thread = Thread(target=self.context.run,
+                                     args=(self.render,))
+            else:
+                self.thread = Thread(target=self.render)
+            self.thread.daemon = True
+            self.thread.start()
+        item = self.queue.get()
+        if item is None:
+            self.closed = True
+            raise StopIteration
+        if isinstance(item, tuple):
+            self.closed = True
+            reraise(*item)
+        return item
+    next = __next__
+
+    def close(self):
+        '''Stop rendering, called by the WSGI server when the response is
+        finished or abandoned.'''
+        self.closed = True
+        # unblock a render waiting on a full queue
+        try:
+            while True:
+                self.queue.get_nowait()
+        except Empty:
+            pass
+
+
 class TemplateEngine(object):
     '''
     The basic template engine, looks up templates and renders them.
@@ -28,7 +321,8 @@ class TemplateEngine(object):
                                            ' humanize,'
                                            ' HTMLLiteral as literal,'
                                            ' url_for',
-            'from pybald.core import page']
+            'from pybald.core import page',
+            'from pybald.core import assets']
 
         if config.template_helpers:
             self.template_helpers.extend(config.template_helpers)
@@ -61,10 +355,32 @@ class TemplateEngine(object):
             project_cache_path = None
 
         fs_test = config.template_filesystem_check or config.debug or False
+        # compiled raw_template snippets
+        self.raw_template_cache = None
+        if config.raw_template_cache_size:
+            self.raw_template_cache = LRUCache(config.raw_template_cache_size)
+        # rendered partials and blocks, replace with a TaggedCache around a
+        # MemcachedCache to share fragments between processes
+        self.fragment_cache = None
+        if config.fragment_cache_size:
+            self.fragment_cache = TaggedCache(MemoryCache(
+                                                config.fragment_cache_size))
+        # per template render counts and times, see pybald.core.profiling
+        self.profiler = TemplateProfiler() if config.template_profiling else None
+        # (template, format) -> (mako template, time it was last checked)
+        self.template_cache = {}
+        # with filesystem checks on, templates are checked for changes at
+        # most this often (in seconds), otherwise they're cached for good
+        self.check_interval = (config.template_check_interval if fs_test
+                               else None)
         self.template_args = dict(imports=self.template_helpers,
                                   input_encoding='utf-8',
                                   output_encoding='utf-8',
-                                  default_filters=self.default_filters)
+                                  default_filters=self.default_filters,
+                                  cache_impl='pybald')
+        # kept for precompiling templates ahead of time
+        self.template_paths = template_paths
+        self.module_directory = project_cache_path
         self.lookup = TemplateLookup(directories=template_paths,
                                      module_directory=project_cache_path,
                                      filesystem_checks=fs_test,
@@ -79,16 +395,57 @@ class TemplateEngine(object):
         :param data: the data to render
         :param kargs: Additional arguments to pass to the Template when
                       making the template object
+
+        Compiled templates are kept in an LRU cache (``raw_template_cache``,
+        sized by the ``raw_template_cache_size`` config value) keyed by a
+        hash of the text and the template arguments, so the same snippet is
+        only parsed and compiled once. ``raw_template_cache.stats()`` reports
+        the hits and misses.
         '''
-        template_data = dict(list(config.page_options.items()) + list(data.items()))
         myargs = self.template_args.copy()
         myargs.update(kargs)
-        mytemplate = Template(template_text, **myargs)
-        return mytemplate.render(**template_data)
+        if self.raw_template_cache is None:
+            mytemplate = Template(template_text, **myargs)
+        else:
+            key = hashlib.sha1(u"{0}\0{1!r}".format(
+                                    template_text, sorted(myargs.items())
+                                    ).encode('utf-8')).hexdigest()
+            mytemplate = self.raw_template_cache.get(key)
+            if mytemplate is None:
+                mytemplate = Template(template_text, **myargs)
+                self.raw_template_cache.set(key, mytemplate)
+        return render_layered(mytemplate, render_data(data))
 
-    def partial(self, template_name=None, format="html", **kargs):
-        mytemplate = self._get_template(template_name, format=format)
-        return mytemplate.render_unicode(**kargs)
+    def partial(self, template_name=None, format="html", cache_key=None,
+                ttl=0, tags=(), **kargs):
+        '''
+        Render a template to a unicode string, for including in another
+        page.
+
+        :param template_name: The name of the template to render.
+        :param format: The format of the template.
+        :param cache_key: If given, the rendered output is stored in the
+                          fragment cache under this key and later calls with
+                          the same template and key return it without
+                          rendering. The key must identify everything else
+                          the output depends on.
+        :param ttl: How long to keep the cached output in seconds, 0 keeps
+                    it until it's evicted or invalidated.
+        :param tags: Tags to store the output under (a list or a comma
+                     separated string), see ``fragment_cache.invalidate_tags``.
+        :param kargs: The data to render.
+        '''
+        fragment_cache = self.fragment_cache
+        if cache_key is None or fragment_cache is None:
+            mytemplate = self._get_template(template_name, format=format)
+            return self._render(mytemplate, kargs, as_unicode=True)
+        key = u'partial:{0}:{1}:{2}'.format(template_name, format, cache_key)
+        output = fragment_cache.get(key)
+        if output is None:
+            mytemplate = self._get_template(template_name, format=format)
+            output = self._render(mytemplate, kargs, as_unicode=True)
+            fragment_cache.set(key, output, ttl, split_tags(tags))
+        return output
 
     def form_render(self, template_name=None, format="form", **kargs):
         '''
@@ -105,6 +462,20 @@ class TemplateEngine(object):
             template_id = 'forms/{0}'.format(template_name)
         return self.partial(template_id, format, **kargs)
 
+    def _render(self, mytemplate, data, as_unicode=False):
+        '''Render a template, recording it with the profiler if template
+        profiling is on.'''
+        profiler = self.profiler
+        if profiler is None:
+            return render_layered(mytemplate, data, as_unicode)
+        record = profiler.start(mytemplate.uri)
+        output = None
+        try:
+            output = render_layered(mytemplate, data, as_unicode)
+            return output
+        finally:
+            profiler.stop(record, output)
+
     def _get_template(self, template, format="html"):
         '''
         Retrieves the proper template from the Mako template system.
@@ -118,7 +489,22 @@ class TemplateEngine(object):
         The _get_template method of the template engine constructs a template
         name based on the template_id and the format and retrieves it from the
         Mako template system.
+
+        Resolved templates are memoized by template name and format. When
+        filesystem checks are on, a template is looked up again (and so
+        checked for changes) at most once every ``template_check_interval``
+        seconds.
         '''
+        key = (template, format)
+        try:
+            mytemplate, checked = self.template_cache[key]
+        except KeyError:
+            pass
+        else:
+            if (self.check_interval is None or
+                    default_timer() - checked < self.check_interval):
+                return mytemplate
+
         # format can't be None, set to html as a default
         if format is None:
             format = 'html'
@@ -128,9 +514,9 @@ class TemplateEngine(object):
             template_file = "/{0}.{1}.template".format(template.lower().lstrip('/'),
                                                    format.lower())
         log.debug("Using template: {0}".format(template_file))
-        # TODO: Add memc caching of rendered templates
-        # also need to check if the internal caching is good enough
-        return self.lookup.get_template(template_file)
+        mytemplate = self.lookup.get_template(template_file)
+        self.template_cache[key] = (mytemplate, default_timer())
+        return mytemplate
 
     def __call__(self, template=None, data={}, format="html"):
         '''
@@ -146,8 +532,27 @@ class TemplateEngine(object):
 
         Calls _get_template to retrieve the template and then renders it.
         '''
-        template_data = dict(list(config.page_options.items()) + list(data.items()))
         mytemplate = self._get_template(template, format)
         log.debug("Rendering template")
-        return mytemplate.render(**template_data)
+        return self._render(mytemplate, render_data(data))
+
+    def stream(self, template=None, data={}, format="html",
+               chunk_size=64 * 1024):
+        '''
+        Renders the template in chunks.
+
+        Takes the same arguments as calling the template engine and returns
+        an iterator of encoded chunks of roughly ``chunk_size`` characters
+        (see :class:`StreamingRender`) to use as a response ``app_iter``.
+        The first chunk goes out as soon as it's rendered and memory use
+        stays flat regardless of the size of the page.
+
+        The template is rendered while the response is sent, after the
+        action and the middleware have returned. Anything the template needs
+        from the database should be loaded by the action and errors in the
+        template can no longer change the response status.
+        '''
+        mytemplate = self._get_template(template, format)
+        log.debug("Streaming template")
+        return StreamingRender(mytemplate, render_data(data), chunk_size)
 
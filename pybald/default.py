@@ -3,11 +3,15 @@ default_config = dict(
     # =================
     template_default_helpers=[
         'from pybald.core.helpers import img, link, humanize, HTMLLiteral as literal, url_for',
-        'from pybald.core import page'],
+        'from pybald.core import page',
+        'from pybald.core import assets'],
     # order important, html filter always first!
     template_default_filters=['h', 'unicode'],
     template_helpers=[],
     template_filesystem_check=True,
+    template_check_interval=1,
+    template_profiling=False,
+    raw_template_cache_size=256,
     template_path='app/views',
     cache_path='tmp/viewscache',
     page_options={},
@@ -17,10 +21,29 @@ default_config = dict(
     schema_reflection=False,
     database_engine_uri='',
     database_engine_args={},
+    database_request_scope=False,
     # Asset Pipeline
     # =================
     USE_CDN=False,
     DEFAULT_PROTOCOL="http",
+    ASSET_MANIFEST=None,
+    BUNDLE_ASSETS=False,
+    BUNDLE_AUTO_BUILD=True,
+    BUNDLE_OUTPUT_PATH='/min',
+    # Caching
+    # =================
+    action_cache_size=1024,
+    fragment_cache_size=1024,
+    DISABLE_STATIC_CONTENT_CACHE=False,
+    # Background tasks
+    # =================
+    background_workers=4,
+    background_queue_size=1000,
+    # CSRF
+    # =================
+    csrf_stateless=False,
+    csrf_secret=None,
+    csrf_token_lifetime=3600,
     # Email
     # =================
     smtp_config={},
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+The static asset manifest.
+
+Asset urls get a tag (``/css/site.css?v=TAG``) so browsers and CDNs fetch
+the new file when it changes. By default the tag is the file's modification
+time, which means a ``stat`` for each new asset and different urls on
+servers that deployed the same file at different times.
+
+A manifest built at deploy time maps every file under the static path to a
+hash of its contents instead, so tags are the same on every server and
+looking one up is a dictionary lookup:
+
+    python app.py assets
+
+builds the asset bundles (see :mod:`pybald.core.assets`) and writes the
+manifest to the ``ASSET_MANIFEST`` path in the config, which is loaded when
+the application is configured.
+'''
+import hashlib
+import json
+import os
+import sys
+import logging
+log = logging.getLogger(__name__)
+
+# characters of the content hash used as the tag
+TAG_LENGTH = 12
+
+
+def hash_file(path, block_size=64 * 1024):
+    '''Return the asset tag for a file, a hash of its contents.'''
+    digest = hashlib.md5()
+    with open(path, 'rb') as asset_file:
+        for block in iter(lambda: asset_file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()[:TAG_LENGTH]
+
+
+def build_manifest(static_path, exclude=()):
+    '''
+    Return a manifest for every file under static_path, a dictionary of url
+    path (``/css/site.css``) to content hash.
+
+    :param static_path: The directory static files are served from.
+    :param exclude: Full paths of files to leave out, like the manifest
+                    itself.
+    '''
+    exclude = set(os.path.abspath(path) for path in exclude)
+    manifest = {}
+    for root, dirs, files in os.walk(static_path):
+        for filename in files:
+            path = os.path.join(root, filename)
+            if os.path.abspath(path) in exclude:
+                continue
+            url = '/' + os.path.relpath(path, static_path).replace(os.sep, '/')
+            manifest[url] = hash_file(path)
+    return manifest
+
+
+def write_manifest(manifest, manifest_path):
+    '''Write a manifest as JSON, replacing any existing file in one step so
+    running servers never read half a manifest.'''
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=0, sort_keys=True)
+    os.rename(temp_path, manifest_path)
+
+
+def manifest_path(config):
+    '''The full path of the configured manifest, or None.'''
+    if not config.ASSET_MANIFEST:
+        return None
+    return os.path.join(config.path, config.ASSET_MANIFEST)
+
+
+def load_manifest(config):
+    '''
+    Load the configured asset manifest.
+
+    Returns None when there's no manifest configured. A configured manifest
+    that can't be read is logged and None returned, asset tags then fall
+    back to modification times.
+    '''
+    path = manifest_path(config)
+    if path is None:
+        return None
+    try:
+        with open(path) as manifest_file:
+            return json.load(manifest_file)
+    except (IOError, OSError, ValueError) as err:
+        log.error("Couldn't load the asset manifest {0}: {1}".format(path,
+                                                                      err))
+        return None
+
+
+def start_build_assets(app, options=None):
+    '''Build the configured application's asset bundles and then its asset
+    manifest (if ``ASSET_MANIFEST`` is set).
+
+    :param app: wsgi application passed in (unused)
+    :param options: the parsed command line arguments (unused)
+    '''
+    from pybald import context
+    from pybald.core.assets import prebuild_bundles
+    config = context.config
+    bundles = prebuild_bundles(context.render.template_paths, config)
+    sys.stdout.write("Built {0} bundles\n".format(len(bundles)))
+    path = manifest_path(config)
+    if path is None:
+        sys.stdout.write("No ASSET_MANIFEST configured, skipping the asset "
+                         "manifest\n")
+        return
+    static_path = os.path.join(config.path, config.static_path)
+    manifest = build_manifest(static_path, exclude=[path, path + '.tmp'])
+    write_manifest(manifest, path)
+    sys.stdout.write("Wrote {0} assets to {1}\n".format(len(manifest), path))
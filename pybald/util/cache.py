@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''Small caching helpers and the pluggable cache backends.'''
+import base64
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+from time import time
+from uuid import uuid4
+
+# sentinel for cache misses, so None can be cached
+MISSING = object()
+
+
+class LRUCache(object):
+    '''
+    A bounded, thread-safe, least recently used cache.
+
+    :param size: The maximum number of entries to keep. When full, the least
+                 recently used entry is evicted to make room for a new one.
+
+    The cache counts hits and misses so it can be sized by looking at
+    ``stats()``.
+    '''
+    def __init__(self, size=1024):
+        if size < 1:
+            raise ValueError("LRUCache size must be at least 1")
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __repr__(self):
+        return "<LRUCache {0}/{1} entries>".format(len(self._data), self.size)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        '''Return the cached value for key (marking it as recently used) or
+        default if the key isn't cached.'''
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        '''Store a value, evicting the least recently used entry if the
+        cache is full.'''
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        '''Remove a key from the cache if present.'''
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        '''Empty the cache. The hit/miss counters are kept.'''
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        '''Return a dictionary of the cache size and hit/miss counters.'''
+        return dict(size=self.size, entries=len(self._data),
+                    hits=self.hits, misses=self.misses)
+
+
+class MemoryCache(object):
+    '''
+    A process local cache backend with expiry times, backed by an LRUCache.
+
+    :param size: The maximum number of entries to keep.
+
+    Cache backends implement ``get(key)``, ``set(key, value, ttl=0)`` and
+    ``delete(key)``. A ``ttl`` of zero means the entry doesn't expire (but
+    may still be evicted).
+    '''
+    def __init__(self, size=1024):
+        self.lru = LRUCache(size)
+
+    def __repr__(self):
+        return "<MemoryCache {0!r}>".format(self.lru)
+
+    def get(self, key):
+        '''Return the value stored for key or None.'''
+        entry = self.lru.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires and expires < time():
+            self.lru.delete(key)
+            return None
+        return value
+
+    def set(self, key, value, ttl=0):
+        '''Store a value for ttl seconds (or until evicted when ttl is 0).'''
+        self.lru.set(key, (value, time() + ttl if ttl else 0))
+
+    def delete(self, key):
+        '''Remove a key from the cache.'''
+        self.lru.delete(key)
+
+    def stats(self):
+        '''Return the hit/miss stats of the underlying LRU.'''
+        return self.lru.stats()
+
+
+class MemcachedCache(object):
+    '''
+    A cache backend that stores values in memcached.
+
+    :param client: A memcached client (for example a ``memcache.Client``
+                   from python-memcached) with ``get(key)``,
+                   ``set(key, value, time)`` and ``delete(key)`` methods. Any
+                   object with the same interface, such as a local stand in
+                   for tests, can be used instead.
+
+    Keys are hashed before they're sent to memcached, so any text can be
+    used as a key.
+    '''
+    def __init__(self, client):
+        self.client = client
+
+    def __repr__(self):
+        return "<MemcachedCache {0!r}>".format(self.client)
+
+    def _key(self, key):
+        # memcached keys can't have spaces or be over 250 bytes, so keys are
+        # hashed
+        return base64.urlsafe_b64encode(
+                    hashlib.md5(key.encode('utf-8')).digest()).decode('ascii')
+
+    def get(self, key):
+        '''Return the value stored for key or None.'''
+        return self.client.get(self._key(key))
+
+    def set(self, key, value, ttl=0):
+        '''Store a value for ttl seconds (0 doesn't expire).'''
+        self.client.set(self._key(key), value, ttl)
+
+    def delete(self, key):
+        '''Remove a key from the cache.'''
+        self.client.delete(self._key(key))
+
+
+class TaggedCache(object):
+    '''
+    Wraps a cache backend with tag based invalidation.
+
+    :param backend: The cache backend to store entries in, a ``MemoryCache``
+                    or ``MemcachedCache`` (or anything with the same
+                    interface).
+    :param prefix: Prepended to every key stored in the backend.
+
+    Entries can be stored with a set of tags. Every tag has a version, a
+    random token kept in the backend, and each entry remembers the versions
+    of its tags when it was stored. ``invalidate_tags`` gives tags new
+    versions so every entry stored with them becomes a miss, without having
+    to find those entries (memcached can't list its keys). If a tag version
+    is evicted it's replaced with a new one, which only ever causes misses.
+    '''
+    def __init__(self, backend, prefix='fragment:'):
+        self.backend = backend
+        self.prefix = prefix
+
+    def __repr__(self):
+        return "<TaggedCache {0!r}>".format(self.backend)
+
+    def _tag_key(self, tag):
+        return '{0}tag:{1}'.format(self.prefix, tag)
+
+    def _versions(self, tags):
+        versions = []
+        for tag in tags:
+            version = self.backend.get(self._tag_key(tag))
+            if version is None:
+                version = self._bump(tag)
+            versions.append(version)
+        return tuple(versions)
+
+    def _bump(self, tag):
+        version = uuid4().hex
+        self.backend.set(self._tag_key(tag), version)
+        return version
+
+    def get(self, key):
+        '''Return the value stored for key or None if it's missing, expired
+        or one of its tags has been invalidated.'''
+        entry = self.backend.get(self.prefix + key)
+        if entry is None:
+            return None
+        tags, versions, value = entry
+        if tags and self._versions(tags) != versions:
+            return None
+        return value
+
+    def set(self, key, value, ttl=0, tags=()):
+        '''Store a value for ttl seconds (0 doesn't expire) under a set of
+        tags.'''
+        tags = tuple(tags)
+        self.backend.set(self.prefix + key, (tags, self._versions(tags), value),
+                         ttl)
+
+    def delete(self, key):
+        '''Remove a key from the cache.'''
+        self.backend.delete(self.prefix + key)
+
+    def invalidate_tags(self, *tags):
+        '''Invalidate every entry stored with any of the tags.'''
+        for tag in tags:
+            self._bump(tag)
@@ -1,13 +1,16 @@
 import argparse
 from pybald.util.console import start_console
 from pybald.util.dev_server import start_dev_server
+from pybald.util.precompile import start_precompile
+from pybald.util.assets import start_build_assets
 
 
 def start(app):
     '''Read the command line arguments passed in and start either the
-    console or the development server.
+    console or the development server, or precompile the templates or build
+    the static assets.
 
-    usage: [-h] {console,serve}
+    usage: [-h] {console,serve,precompile,assets}
     '''
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers(help='sub-command help',
@@ -20,5 +23,11 @@ def start(app):
     parser_serve.add_argument('--port', type=int)
     parser_serve.set_defaults(host='0.0.0.0', port=8080)
     parser_serve.set_defaults(run=start_dev_server)
+    parser_precompile = subparsers.add_parser('precompile',
+                                              help='precompile help')
+    parser_precompile.add_argument('--workers', type=int)
+    parser_precompile.set_defaults(run=start_precompile)
+    parser_assets = subparsers.add_parser('assets', help='assets help')
+    parser_assets.set_defaults(run=start_build_assets)
     options = parser.parse_args()
     options.run(app, options)
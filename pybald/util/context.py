@@ -1,7 +1,34 @@
 from threading import local
+try:
+    from threading import get_ident
+except ImportError:
+    from thread import get_ident
+try:
+    from contextvars import ContextVar
+except ImportError:
+    ContextVar = None
 import logging
 log = logging.getLogger(__name__)
 
+# identifies the request being handled when serving through the ASGI
+# adapter, where a single request may run on several threads
+request_scope = ContextVar('pybald_request_scope',
+                           default=None) if ContextVar else None
+
+
+def request_scope_id():
+    '''Return an identifier for the current request scope.
+
+    This is the ASGI request scope when one is set, otherwise the current
+    thread (the scope of a WSGI request). It's used as the scope function for
+    per-request database sessions.
+    '''
+    if request_scope is not None:
+        scope = request_scope.get()
+        if scope is not None:
+            return scope
+    return get_ident()
+
 
 class Proxy(object):
     '''A convenience proxy implementing most of the pass through methods.'''
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+JSON encoding for responses.
+
+``dumps`` encodes data to UTF-8 JSON bytes using the fastest encoder
+available: `orjson <https://github.com/ijl/orjson>`_ when it's installed,
+otherwise the standard library ``json`` module.
+
+    pip install orjson
+
+``iter_json_array`` encodes an iterable as a JSON array a piece at a time,
+for response bodies too large to build in memory.
+'''
+import json
+from six import text_type
+import logging
+log = logging.getLogger(__name__)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def stdlib_dumps(data):
+    '''Encode data as UTF-8 JSON with the standard library encoder.'''
+    return json.dumps(data).encode('utf-8')
+
+
+def orjson_dumps(data):
+    '''Encode data as UTF-8 JSON with orjson. Like the standard library
+    encoder, dictionary keys don't need to be strings.'''
+    return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+
+if orjson is not None:
+    dumps = orjson_dumps
+else:
+    dumps = stdlib_dumps
+
+
+def iter_json_array(iterable, encoder=None, chunk_size=16 * 1024):
+    '''
+    Encode an iterable as a JSON array, yielding chunks of roughly
+    chunk_size bytes.
+
+    :param iterable: The items of the array, each one is encoded separately
+                     so only a chunk's worth is ever held in memory.
+    :param encoder: The function that encodes a single item to JSON,
+                    ``dumps`` by default. Text results are encoded as UTF-8.
+    :param chunk_size: The size in bytes to collect before yielding a chunk.
+    '''
+    if encoder is None:
+        encoder = dumps
+    pieces = [b'[']
+    size = 1
+    separator = b''
+    for item in iterable:
+        encoded = encoder(item)
+        if isinstance(encoded, text_type):
+            encoded = encoded.encode('utf-8')
+        pieces.append(separator)
+        pieces.append(encoded)
+        separator = b','
+        size += len(encoded) + 1
+        if size >= chunk_size:
+            yield b''.join(pieces)
+            pieces = []
+            size = 0
+    pieces.append(b']')
+    yield b''.join(pieces)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+Compile templates ahead of time.
+
+Mako compiles a template into a python module the first time it's rendered,
+so the first requests after a deploy are slow in every worker. Compiling
+every template into the ``cache_path`` module directory before the workers
+start means they find the compiled modules already there.
+
+    python app.py precompile
+'''
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from mako.lookup import TemplateLookup
+import logging
+log = logging.getLogger(__name__)
+
+TEMPLATE_SUFFIX = '.template'
+
+
+def find_templates(directories):
+    '''Return the uris of every template under the template directories. A
+    template found in more than one directory is only listed once, the
+    lookup uses the first one.'''
+    uris = []
+    seen = set()
+    for directory in directories:
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for filename in sorted(files):
+                if not filename.endswith(TEMPLATE_SUFFIX):
+                    continue
+                path = os.path.relpath(os.path.join(root, filename),
+                                       directory)
+                uri = '/' + path.replace(os.sep, '/')
+                if uri not in seen:
+                    seen.add(uri)
+                    uris.append(uri)
+    return uris
+
+
+def compile_templates(directories, module_directory, template_args, uris):
+    '''
+    Compile templates into the module directory.
+
+    Returns a list of (uri, error) pairs, the error is None for templates
+    that compiled. This runs in the worker processes.
+    '''
+    lookup = TemplateLookup(directories=directories,
+                            module_directory=module_directory,
+                            filesystem_checks=True, **template_args)
+    results = []
+    for uri in uris:
+        try:
+            lookup.get_template(uri)
+        except Exception as err:
+            results.append((uri, "{0}: {1}".format(type(err).__name__, err)))
+        else:
+            results.append((uri, None))
+    return results
+
+
+def cpu_count():
+    '''The number of CPUs, or 1 if it can't be determined.'''
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def precompile_templates(directories, module_directory, template_args,
+                         workers=None):
+    '''
+    Compile every template under the directories into the module directory,
+    split across worker processes.
+
+    :param directories: The template directories, in lookup order.
+    :param module_directory: The directory compiled modules are written to.
+    :param template_args: The arguments templates are created with, these
+                          have to match the template engine's.
+    :param workers: The number of processes to use, the number of CPUs by
+                    default. With one worker everything is compiled in this
+                    process.
+
+    Returns a tuple of the compiled uris and a list of (uri, error) pairs
+    for templates that failed.
+    '''
+    if not module_directory:
+        raise ValueError("Templates can only be precompiled when a "
+                         "cache_path is configured")
+    uris = find_templates(directories)
+    workers = max(1, min(workers or cpu_count(), len(uris) or 1))
+    # deal the templates out so each worker gets a similar share
+    batches = [uris[index::workers] for index in range(workers)]
+    if workers == 1:
+        results = compile_templates(directories, module_directory,
+                                    template_args, uris)
+    else:
+        results = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(compile_templates, directories,
+                                       module_directory, template_args, batch)
+                       for batch in batches]
+            for future in futures:
+                results.extend(future.result())
+    compiled = [uri for uri, error in results if error is None]
+    errors = [(uri, error) for uri, error in results if error is not None]
+    return compiled, errors
+
+
+def start_precompile(app, options=None):
+    '''Compile the configured application's templates into its cache_path
+    and report any that fail. Exits with a non-zero status on errors.
+
+    :param app: wsgi application passed in (unused)
+    :param options: an object with a ``workers`` attribute, generally the
+                    parsed command line arguments
+    '''
+    from pybald import context
+    render = context.render
+    workers = getattr(options, 'workers', None)
+    try:
+        compiled, errors = precompile_templates(render.template_paths,
+                                                render.module_directory,
+                                                render.template_args,
+                                                workers=workers)
+    except ValueError as err:
+        sys.stderr.write("{0}\n".format(err))
+        sys.exit(1)
+    for uri, error in errors:
+        sys.stderr.write("{0}: {1}\n".format(uri, error))
+    sys.stdout.write("Compiled {0} templates into {1}, {2} errors\n".format(
+                     len(compiled), render.module_directory, len(errors)))
+    if errors:
+        sys.exit(1)
@@ -61,10 +61,16 @@ setup(name='pybald',
       install_requires=[
           "Routes==2.4.1", "SQLAlchemy==1.3.3",
           "WebOb==1.8.5", "Mako==1.0.7",
-          "WTForms==2.2.1", "alembic==1.0.7", "six==1.12.0"
+          "WTForms==2.2.1", "alembic==1.0.7", "six==1.12.0",
+          # concurrent.futures for background tasks and ChainMap for
+          # layered render data on python 2
+          'futures; python_version < "3"', 'chainmap; python_version < "3"'
       ],
       extras_require={
         'docs': ['Sphinx>=1.6.2'],
+        'json': ['orjson'],
+        'compression': ['brotli'],
+        'assets': ['rcssmin', 'rjsmin'],
         'tests': ['pytest>=3.1.1']
     },
 )
@@ -0,0 +1,6 @@
+import sys
+
+collect_ignore = []
+# the ASGI adapter uses async generators and contextvars, python 3.7+ only
+if sys.version_info < (3, 7):
+    collect_ignore.append('unit/test_asgi.py')
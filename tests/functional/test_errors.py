@@ -18,6 +18,8 @@ def map(urls):
     # errors
     urls.connect('throw_exception', r'/throw_exception', controller='sample',
                  action='throw_exception')
+    urls.connect('render_then_throw', r'/render_then_throw',
+                 controller='sample', action='render_then_throw')
 
 
 class SampleController(Controller):
@@ -29,6 +31,11 @@ class SampleController(Controller):
     def throw_exception(self, req):
         raise Exception("This is a test exception")
 
+    @action
+    def render_then_throw(self, req):
+        context.render.partial('sample', sample_variable='partial')
+        raise Exception("This is a test exception")
+
 
 test_conf = dict(database_engine_uri='sqlite:///:memory:',
                  env_name="SampleTestProjectEnvironment",
@@ -55,6 +62,18 @@ class TestErrors(unittest.TestCase):
         self.assertEqual(resp.status_code, 500)
         self.assertEqual(stack_trace_head, str(resp.text)[:len(stack_trace_head)])
 
+    def test_stack_trace_template_renders(self):
+        "With template profiling on, the stack trace lists the request's renders"
+        profiling_conf = dict(test_conf, template_profiling=True,
+                              template_path='tests/sample_project')
+        pybald.configure(config_object=profiling_conf)
+        app = Router(routes=map, controllers=[SampleController])
+        app = ErrorMiddleware(app)
+        resp = Request.blank('/render_then_throw').get_response(app)
+        self.assertEqual(resp.status_code, 500)
+        self.assertIn('Template renders', resp.text)
+        self.assertIn('/sample.html.template', resp.text)
+
     def test_non_stack_trace(self):
         "When *NOT* in debug mode, throw an Exception and return a generic error"
         test_w_debug_conf = test_conf.copy()
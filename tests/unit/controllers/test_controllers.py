@@ -1,9 +1,15 @@
+import datetime
+import json
+import time
 import unittest
 import pybald
 from pybald import context
 from pybald.core.controllers import (Controller, action, csrf_protected,
-                                     CSRFValidationFailure)
-from webob import Request
+                                     CSRFValidationFailure, has_plain_state,
+                                     stateless_csrf_token,
+                                     action_cached, action_conditional)
+from pybald.util.cache import MemcachedCache
+from webob import Request, exc
 from six.moves.urllib.parse import urlencode
 
 
@@ -16,7 +22,8 @@ class MockStash(dict):
 
 
 class MockSession(object):
-    def __init__(self):
+    def __init__(self, session_id=None):
+        self.session_id = session_id
         self.stash = MockStash()
 
 
@@ -27,6 +34,121 @@ class TempController(Controller):
         return 'Some data'
 
 
+class StateController(Controller):
+    @action
+    def show(self, req):
+        return u"{0} {1}".format(self.item_id, self.user)
+
+
+class PropertyController(Controller):
+    @property
+    def item_id(self):
+        return self._item_id
+
+    @item_id.setter
+    def item_id(self, value):
+        self._item_id = int(value)
+
+    @action
+    def show(self, req):
+        return u"{0}".format(self.item_id + 1)
+
+
+class LocalMemcache(object):
+    '''A local stand in for a memcached client.'''
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, time=0):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+local_memcache = LocalMemcache()
+
+
+class CachedController(Controller):
+    calls = 0
+
+    @action_cached(keys=['item_id'], ttl=60)
+    @action
+    def show(self, req):
+        CachedController.calls += 1
+        return u"item {0}".format(self.item_id)
+
+    @action_cached(keys=['item_id'], backend=MemcachedCache(local_memcache))
+    @action
+    def memcached(self, req):
+        CachedController.calls += 1
+        return u"memcached {0}".format(self.item_id)
+
+
+class HomeController(Controller):
+    @action_cached()
+    @action
+    def index(self, req):
+        return u"home page"
+
+
+class AdminController(Controller):
+    @action_cached()
+    @action
+    def index(self, req):
+        return u"admin page"
+
+
+class PrivateController(Controller):
+    calls = 0
+
+    def _pre(self, req):
+        if not req.headers.get('X-User'):
+            return exc.HTTPForbidden()
+
+    @action_cached(keys=['item_id'])
+    @action
+    def show(self, req):
+        PrivateController.calls += 1
+        return u"secret {0}".format(self.item_id)
+
+
+class ConditionalController(Controller):
+    calls = 0
+    version = 1
+    modified = datetime.datetime(2020, 1, 2, 3, 4, 5)
+
+    def _version(self, req):
+        return self.version
+
+    @action_conditional()
+    @action
+    def body(self, req):
+        ConditionalController.calls += 1
+        return u"body"
+
+    @action_conditional(validator='_version')
+    @action
+    def versioned(self, req):
+        ConditionalController.calls += 1
+        return u"version {0}".format(self.version)
+
+    @action_conditional(validator=lambda self, req: self.modified)
+    @action
+    def dated(self, req):
+        ConditionalController.calls += 1
+        return u"dated"
+
+
+def cached_request(app, item_id, method='GET', headers=None):
+    request = Request.blank('/', method=method, headers=headers)
+    request.urlvars = {'item_id': item_id}
+    return request.get_response(app)
+
+
 class TestControllers(unittest.TestCase):
     def setUp(self):
         context = pybald.configure(config_object=dict(env_name="ControllerTest"))
@@ -114,6 +236,282 @@ class TestControllers(unittest.TestCase):
         else:
             pass
 
+    def test_request_state_assigned(self):
+        "Url variables and extensions are assigned to the controller"
+        request = Request.blank('/')
+        request.urlvars = {'item_id': '12'}
+        request.environ['pybald.extension'] = {'user': 'someone'}
+        self.assertTrue(has_plain_state(StateController))
+        resp = request.get_response(StateController().show)
+        self.assertEqual(resp.text, '12 someone')
+
+    def test_request_state_uses_setters(self):
+        "Controllers with properties have request state set through them"
+        request = Request.blank('/')
+        request.urlvars = {'item_id': '12'}
+        self.assertFalse(has_plain_state(PropertyController))
+        resp = request.get_response(PropertyController().show)
+        self.assertEqual(resp.text, '13')
+
+
+class TestStatelessCSRF(unittest.TestCase):
+    def setUp(self):
+        pybald.configure(config_object=dict(env_name="CSRFTest",
+                                            csrf_stateless=True,
+                                            csrf_secret='not very secret'))
+        self.controller = TempController()
+        self.controller.session = MockSession(session_id='abc123')
+
+    def tearDown(self):
+        context._reset()
+
+    def post(self, token):
+        return Request.blank('/',
+                         content_type="application/x-www-form-urlencoded",
+                         method="POST",
+                         body=urlencode({'__csrf_token__': token}
+                                        ).encode('utf-8'))
+
+    def test_token_not_stashed(self):
+        "Stateless tokens aren't written to the session"
+        Request.blank('/').get_response(self.controller.test1)
+        self.assertEqual(self.controller.session.stash, {})
+        self.assertIn(stateless_csrf_token('abc123'),
+                      self.controller.csrf_input)
+
+    def test_csrf_accept(self):
+        "Accept a signed token for the session"
+        token = stateless_csrf_token('abc123')
+        resp = self.post(token).get_response(self.controller.test1)
+        self.assertEqual(resp.text, 'Some data')
+        self.assertEqual(self.controller.session.stash, {})
+
+    def test_previous_window_accept(self):
+        "Accept tokens from the previous time window"
+        window = int(time.time() // 3600) - 1
+        token = stateless_csrf_token('abc123', window)
+        resp = self.post(token).get_response(self.controller.test1)
+        self.assertEqual(resp.text, 'Some data')
+
+    def test_expired_reject(self):
+        "Reject expired tokens"
+        window = int(time.time() // 3600) - 2
+        token = stateless_csrf_token('abc123', window)
+        with self.assertRaises(CSRFValidationFailure):
+            self.post(token).get_response(self.controller.test1)
+
+    def test_other_session_reject(self):
+        "Reject tokens issued to another session"
+        token = stateless_csrf_token('someone else')
+        with self.assertRaises(CSRFValidationFailure):
+            self.post(token).get_response(self.controller.test1)
+        with self.assertRaises(CSRFValidationFailure):
+            self.post(u'caf\xe9').get_response(self.controller.test1)
+
+    def test_no_session_id_stashed(self):
+        "Sessions without an id fall back to stashed tokens"
+        self.controller.session = MockSession()
+        Request.blank('/').get_response(self.controller.test1)
+        self.assertTrue(self.controller.session.stash.get('csrf_token'))
+
+    def test_stashed_token_accept(self):
+        "Accept a token stashed before the session had an id"
+        self.controller.session = MockSession()
+        Request.blank('/').get_response(self.controller.test1)
+        token = self.controller.session.stash.get('csrf_token')
+        # the session was given an id before the form was posted
+        self.controller.session.session_id = 'abc123'
+        resp = self.post(token).get_response(self.controller.test1)
+        self.assertEqual(resp.text, 'Some data')
+        self.assertIsNone(self.controller.session.stash.get('csrf_token'))
+        # stashed tokens are single use
+        with self.assertRaises(CSRFValidationFailure):
+            self.post(token).get_response(self.controller.test1)
+
+
+class StreamController(Controller):
+    @action
+    def rows(self, req):
+        return (u"row {0}\n".format(index) for index in range(3))
+
+    @action
+    def json_rows(self, req):
+        return self._JSON_stream({'id': index} for index in range(3))
+
+    @action
+    def json_text(self, req):
+        return self._JSON({'id': 1}, encoder=json.dumps)
+
+
+class TestActionCache(unittest.TestCase):
+    def setUp(self):
+        CachedController.calls = 0
+
+    def tearDown(self):
+        context._reset()
+
+    def test_cache_miss_then_hit(self):
+        "Cached actions only run once, the response is replayed"
+        pybald.configure(config_object=dict(env_name="CacheTest"))
+        first = cached_request(CachedController().show, '1')
+        second = cached_request(CachedController().show, '1')
+        self.assertEqual(first.headers['X-Cache'], 'MISS')
+        self.assertEqual(second.headers['X-Cache'], 'HIT')
+        self.assertEqual(second.text, 'item 1')
+        self.assertEqual(second.content_type, first.content_type)
+        self.assertEqual(CachedController.calls, 1)
+
+    def test_cache_keys(self):
+        "Responses are cached per key value"
+        pybald.configure(config_object=dict(env_name="CacheTest"))
+        cached_request(CachedController().show, '1')
+        resp = cached_request(CachedController().show, '2')
+        self.assertEqual(resp.text, 'item 2')
+        self.assertEqual(CachedController.calls, 2)
+
+    def test_post_not_cached(self):
+        "Only GET and HEAD requests are cached"
+        pybald.configure(config_object=dict(env_name="CacheTest"))
+        cached_request(CachedController().show, '1', method='POST')
+        resp = cached_request(CachedController().show, '1', method='POST')
+        self.assertNotIn('X-Cache', resp.headers)
+        self.assertEqual(CachedController.calls, 2)
+
+    def test_memcached_backend(self):
+        "Responses can be stored in memcached"
+        pybald.configure(config_object=dict(env_name="CacheTest"))
+        cached_request(CachedController().memcached, '1')
+        resp = cached_request(CachedController().memcached, '1')
+        self.assertEqual(resp.headers['X-Cache'], 'HIT')
+        self.assertEqual(resp.text, 'memcached 1')
+        self.assertEqual(len(local_memcache.data), 1)
+
+    def test_cache_by_controller(self):
+        "Actions of different controllers don't share cached responses"
+        pybald.configure(config_object=dict(env_name="CacheTest"))
+        resp = Request.blank('/').get_response(HomeController().index)
+        self.assertEqual(resp.text, 'home page')
+        resp = Request.blank('/admin').get_response(AdminController().index)
+        self.assertEqual(resp.text, 'admin page')
+        self.assertEqual(resp.headers['X-Cache'], 'MISS')
+        resp = Request.blank('/').get_response(HomeController().index)
+        self.assertEqual(resp.text, 'home page')
+        self.assertEqual(resp.headers['X-Cache'], 'HIT')
+
+    def test_pre_before_cache(self):
+        "_pre runs before cached responses are returned"
+        pybald.configure(config_object=dict(env_name="CacheTest"))
+        user = {'X-User': 'admin'}
+        cached_request(PrivateController().show, '1', headers=user)
+        resp = cached_request(PrivateController().show, '1')
+        self.assertEqual(resp.status_int, 403)
+        self.assertNotIn('X-Cache', resp.headers)
+        resp = cached_request(PrivateController().show, '1', headers=user)
+        self.assertEqual(resp.headers['X-Cache'], 'HIT')
+        self.assertEqual(resp.text, 'secret 1')
+
+    def test_pre_response_not_cached(self):
+        "Responses from _pre are never cached"
+        pybald.configure(config_object=dict(env_name="CacheTest"))
+        PrivateController.calls = 0
+        cached_request(PrivateController().show, '1')
+        resp = cached_request(PrivateController().show, '1',
+                              headers={'X-User': 'admin'})
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.headers['X-Cache'], 'MISS')
+        self.assertEqual(resp.text, 'secret 1')
+        self.assertEqual(PrivateController.calls, 1)
+
+    def test_cache_disabled(self):
+        "DISABLE_STATIC_CONTENT_CACHE turns caching off"
+        pybald.configure(config_object=dict(env_name="CacheTest",
+                                            DISABLE_STATIC_CONTENT_CACHE=True))
+        cached_request(CachedController().show, '1')
+        resp = cached_request(CachedController().show, '1')
+        self.assertNotIn('X-Cache', resp.headers)
+        self.assertEqual(CachedController.calls, 2)
+
+
+class TestActionConditional(unittest.TestCase):
+    def setUp(self):
+        ConditionalController.calls = 0
+        pybald.configure(config_object=dict(env_name="ConditionalTest"))
+
+    def tearDown(self):
+        context._reset()
+
+    def test_body_etag(self):
+        "Without a validator the ETag is computed from the body"
+        resp = Request.blank('/').get_response(ConditionalController().body)
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.etag)
+        request = Request.blank('/', if_none_match=resp.etag)
+        resp = request.get_response(ConditionalController().body)
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.body, b'')
+
+    def test_validator_skips_action(self):
+        "A matching validator answers 304 without running the action"
+        resp = Request.blank('/').get_response(
+                                        ConditionalController().versioned)
+        self.assertEqual(ConditionalController.calls, 1)
+        request = Request.blank('/', if_none_match=resp.etag)
+        not_modified = request.get_response(ConditionalController().versioned)
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.etag, resp.etag)
+        self.assertEqual(ConditionalController.calls, 1)
+
+        changed = ConditionalController()
+        changed.version = 2
+        resp = Request.blank('/', if_none_match=resp.etag).get_response(
+                                                            changed.versioned)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(ConditionalController.calls, 2)
+
+    def test_last_modified(self):
+        "Datetime validators answer If-Modified-Since"
+        resp = Request.blank('/').get_response(ConditionalController().dated)
+        self.assertEqual(resp.last_modified.year, 2020)
+        request = Request.blank('/', if_modified_since=resp.last_modified)
+        resp = request.get_response(ConditionalController().dated)
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(ConditionalController.calls, 1)
+        request = Request.blank('/', if_modified_since=datetime.datetime(
+                                                            2019, 1, 1))
+        resp = request.get_response(ConditionalController().dated)
+        self.assertEqual(resp.status_code, 200)
+
+    def test_post_not_conditional(self):
+        "Only GET and HEAD requests are answered with 304"
+        request = Request.blank('/', method='POST', if_none_match='*')
+        resp = request.get_response(ConditionalController().versioned)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIsNone(resp.etag)
+
+
+class TestStreaming(unittest.TestCase):
+    def tearDown(self):
+        context._reset()
 
+    def test_generator_action(self):
+        "Generators returned from actions are streamed as the response body"
+        pybald.configure(config_object=dict(env_name="StreamTest"))
+        resp = Request.blank('/').get_response(StreamController().rows)
+        self.assertIsNone(resp.content_length)
+        self.assertFalse(isinstance(resp.app_iter, list))
+        self.assertEqual(resp.body, b"row 0\nrow 1\nrow 2\n")
 
+    def test_json_stream(self):
+        "_JSON_stream encodes a JSON array while it's sent"
+        pybald.configure(config_object=dict(env_name="StreamTest"))
+        resp = Request.blank('/').get_response(StreamController().json_rows)
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertFalse(isinstance(resp.app_iter, list))
+        self.assertEqual(json.loads(resp.text),
+                         [{'id': 0}, {'id': 1}, {'id': 2}])
 
+    def test_json_encoder(self):
+        "_JSON accepts an encoder returning text"
+        pybald.configure(config_object=dict(env_name="StreamTest"))
+        resp = Request.blank('/').get_response(StreamController().json_text)
+        self.assertEqual(resp.json, {'id': 1})
@@ -0,0 +1,101 @@
+import os
+import re
+import shutil
+import tempfile
+import unittest
+import pybald
+from pybald import context
+from pybald.core import assets
+
+sample_project = os.path.abspath('tests/sample_project')
+
+
+class TestBundles(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        shutil.copytree(os.path.join(sample_project, 'public'),
+                        os.path.join(self.path, 'public'))
+        assets.bundle_cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        context._reset()
+
+    def configure(self, **kargs):
+        pybald.configure(config_object=dict(path=self.path,
+                                            template_path=sample_project,
+                                            cache_path=None,
+                                            database_engine_uri='', **kargs))
+
+    def render(self):
+        return context.render('sample_with_bundles').decode('utf-8')
+
+    def test_bundles_off(self):
+        '''Without bundling the assets are linked individually'''
+        self.configure()
+        html = self.render()
+        assert '<bundle' not in html
+        for url in ('/css/test1.css', '/css/test2.css', '/js/test1.js',
+                    '/js/test2.js'):
+            self.assertIn(url, html)
+
+    def test_bundles(self):
+        '''Bundled assets are served from one minified, fingerprinted file'''
+        self.configure(BUNDLE_ASSETS=True)
+        html = self.render()
+        css = re.findall(r'href="(/min/[0-9a-f]{12}\.css)"', html)
+        js = re.findall(r'src="(/min/[0-9a-f]{12}\.js)"', html)
+        self.assertEqual((len(css), len(js)), (1, 1))
+        assert 'test1' not in html
+        with open(os.path.join(self.path, 'public', css[0].lstrip('/'))) as f:
+            self.assertEqual(f.read(), 'body{font-family:Helvetica;'
+                             'font-size:40pt}body{font-family:Helvetica;'
+                             'font-size:40pt}')
+        with open(os.path.join(self.path, 'public', js[0].lstrip('/'))) as f:
+            self.assertEqual(f.read(), 'console.log("hello1")\n\n;\n'
+                                       'console.log("hello1")\n')
+        # rendered again the bundle urls come from the cache
+        os.remove(os.path.join(self.path, 'public', css[0].lstrip('/')))
+        self.assertEqual(self.render(), html)
+
+    def test_bundle_changes_with_content(self):
+        '''Changing a bundled file gives the bundle a new name'''
+        self.configure(BUNDLE_ASSETS=True)
+        before = self.render()
+        with open(os.path.join(self.path, 'public/css/test2.css'), 'a') as f:
+            f.write(u'p { margin: 0; }')
+        assets.bundle_cache.clear()
+        after = self.render()
+        self.assertNotEqual(re.findall(r'/min/\w+\.css', before),
+                            re.findall(r'/min/\w+\.css', after))
+        self.assertEqual(re.findall(r'/min/\w+\.js', before),
+                         re.findall(r'/min/\w+\.js', after))
+
+    def test_prebuild_bundles(self):
+        '''Bundles listed in templates are built ahead of time'''
+        self.configure(BUNDLE_ASSETS=True, BUNDLE_AUTO_BUILD=False)
+        urls = assets.prebuild_bundles([sample_project], context.config)
+        self.assertEqual(len(urls), 2)
+        html = self.render()
+        for url in urls:
+            self.assertIn(url, html)
+
+    def test_unbuilt_bundles(self):
+        '''Without auto building, missing bundles fall back to the files'''
+        self.configure(BUNDLE_ASSETS=True, BUNDLE_AUTO_BUILD=False)
+        html = self.render()
+        assert '/min/' not in html
+        self.assertIn('/css/test1.css', html)
+
+    def test_unknown_filter(self):
+        '''Naming a filter that doesn't exist is an error'''
+        self.configure(BUNDLE_ASSETS=True)
+        with self.assertRaises(ValueError):
+            assets.bundle(u'<bundle filters="nope">'
+                          u'<script src="/js/test1.js"></script></bundle>')
+
+    def test_css_minify(self):
+        '''The built in css minifier keeps strings'''
+        self.assertEqual(assets.css_minify(u'a > b , c {\n  content: "a ; b";'
+                                           u' /* note */ color : red ; }'),
+                         u'a>b,c{content:"a ; b";color :red}')
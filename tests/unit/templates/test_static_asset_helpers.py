@@ -1,7 +1,13 @@
+import os
+import shutil
+import tempfile
 import unittest
 import pybald
 from pybald import context
-from pybald.core.helpers import AssetUrl
+from pybald.core import page
+from pybald.core.helpers import (AssetUrl, asset_url, asset_url_cache,
+                                 rendezvous_host)
+from pybald.util.assets import build_manifest, hash_file, write_manifest
 from routes import request_config
 
 
@@ -84,4 +90,115 @@ class TestStaticAssets(unittest.TestCase):
         a_test_config["USE_CDN"] = True
         pybald.configure(config_object=a_test_config)
         asset_url = AssetUrl(my_static_resource)
-        self.assertEqual(str(asset_url), 'https://awesomecdn.com/static_stuff.js')
\ No newline at end of file
+        self.assertEqual(str(asset_url), 'https://awesomecdn.com/static_stuff.js')
+    def test_asset_url_memoized(self):
+        '''Rewritten urls are cached by url and protocol'''
+        a_test_config = test_config.copy()
+        a_test_config["USE_CDN"] = True
+        pybald.configure(config_object=a_test_config)
+        request_config().protocol = "http"
+        self.assertEqual(asset_url(my_static_resource),
+                         'http://s0.sample.com/static_stuff.js')
+        self.assertIn((my_static_resource, "http"), asset_url_cache)
+        request_config().protocol = "https"
+        self.assertEqual(asset_url(my_static_resource),
+                         'https://awesomecdn.com/static_stuff.js')
+        self.assertEqual(len(asset_url_cache), 2)
+
+    def test_asset_url_cache_reset_on_config_change(self):
+        '''A new config empties the rewritten url cache'''
+        request_config().protocol = "http"
+        a_test_config = test_config.copy()
+        a_test_config["USE_CDN"] = True
+        pybald.configure(config_object=a_test_config)
+        self.assertEqual(asset_url(my_static_resource),
+                         'http://s0.sample.com/static_stuff.js')
+        context._reset()
+        a_test_config["USE_CDN"] = False
+        pybald.configure(config_object=a_test_config)
+        self.assertEqual(asset_url(my_static_resource), my_static_resource)
+
+
+class TestRendezvousHosts(unittest.TestCase):
+    urls = ['/img/{0}.jpg'.format(index) for index in range(2000)]
+
+    def test_stable_host(self):
+        '''Assets map to the same host every time'''
+        hosts = ['s0.sample.com', 's1.sample.com', 's2.sample.com']
+        self.assertEqual(rendezvous_host(hosts, '/img/1.jpg'),
+                         rendezvous_host(list(reversed(hosts)), '/img/1.jpg'))
+        # md5 based, so the same in every process
+        self.assertEqual(rendezvous_host(hosts, '/img/1.jpg'), 's1.sample.com')
+
+    def test_spread(self):
+        '''Assets are spread evenly over the hosts'''
+        hosts = ['s{0}.sample.com'.format(index) for index in range(4)]
+        counts = dict((host, 0) for host in hosts)
+        for url in self.urls:
+            counts[rendezvous_host(hosts, url)] += 1
+        for count in counts.values():
+            assert 400 < count < 600
+
+    def test_adding_a_host(self):
+        '''Adding a host only moves the assets it takes over'''
+        hosts = ['s{0}.sample.com'.format(index) for index in range(4)]
+        before = dict((url, rendezvous_host(hosts, url)) for url in self.urls)
+        hosts.append('s4.sample.com')
+        moved = [url for url in self.urls
+                 if rendezvous_host(hosts, url) != before[url]]
+        assert all(rendezvous_host(hosts, url) == 's4.sample.com'
+                   for url in moved)
+        assert 0.15 < len(moved) / float(len(self.urls)) < 0.25
+
+
+class TestAssetManifest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.path, 'public', 'css'))
+        self.write('public/css/site.css', u'body { color: red; }')
+        self.write('public/app.js', u'var a = 1;')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        context._reset()
+
+    def write(self, name, text):
+        with open(os.path.join(self.path, name), 'w') as f:
+            f.write(text)
+
+    def configure(self, **kargs):
+        pybald.configure(config_object=dict(path=self.path, debug=False,
+                                            **kargs))
+
+    def test_build_manifest(self):
+        '''The manifest maps url paths to content hashes'''
+        manifest = build_manifest(os.path.join(self.path, 'public'))
+        self.assertEqual(sorted(manifest), ['/app.js', '/css/site.css'])
+        self.assertEqual(manifest['/app.js'],
+                         hash_file(os.path.join(self.path, 'public/app.js')))
+        # the same content always gets the same tag
+        self.write('public/copy.js', u'var a = 1;')
+        manifest = build_manifest(os.path.join(self.path, 'public'))
+        self.assertEqual(manifest['/copy.js'], manifest['/app.js'])
+
+    def test_manifest_asset_tags(self):
+        '''Asset tags come from the manifest when there is one'''
+        manifest_path = os.path.join(self.path, 'assets.json')
+        write_manifest(build_manifest(os.path.join(self.path, 'public')),
+                       manifest_path)
+        self.configure(ASSET_MANIFEST='assets.json')
+        tag = context.asset_manifest['/css/site.css']
+        self.assertEqual(page.compute_asset_tag('/css/site.css'),
+                         '/css/site.css?v={0}'.format(tag))
+        # files missing from the manifest fall back to their mtime
+        self.write('public/new.js', u'')
+        assert page.compute_asset_tag('/new.js').startswith('/new.js?v=')
+
+    def test_mtime_asset_tags_retry_missing(self):
+        '''Missing files aren't cached with a placeholder tag'''
+        self.configure()
+        self.assertFalse(context.asset_manifest)
+        # missing files have no tag
+        self.assertEqual(page.compute_asset_tag('/late.js'), '/late.js')
+        self.write('public/late.js', u'')
+        assert page.compute_asset_tag('/late.js').startswith('/late.js?v=')
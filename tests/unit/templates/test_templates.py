@@ -1,16 +1,21 @@
+import json
+import random
 import unittest
 from mako.template import Template
+from mako.exceptions import NameConflictError
 import pybald
 from pybald import context
 from datetime import datetime, timedelta
 from pybald.core.router import Router
+from pybald.util.cache import MemcachedCache, TaggedCache
+from pybald.core.helpers import _js_escapes, js_escape, js_escape_many
 
 now = datetime(2018, 6, 15, 3, 0)
 this_year = now.year
 
 helpers = (
-('page_js', '''${page.add_js('/test.js')}''', b'''<script src="/test.js?v=None"></script>''', {}),
-('page_css', '''${page.add_css('/sample.css')}''', b'''<link type="text/css" href="/sample.css?v=None" media="screen" rel="stylesheet">''', {}),
+('page_js', '''${page.add_js('/test.js')}''', b'''<script src="/test.js"></script>''', {}),
+('page_css', '''${page.add_css('/sample.css')}''', b'''<link type="text/css" href="/sample.css" media="screen" rel="stylesheet">''', {}),
 ('date_humanize_moment_ago', '''${humanize(moment_ago, now)}''', b'just a moment ago', {'now': now, 'moment_ago': (now - timedelta(seconds=55)).strftime("%Y-%m-%d %H:%M:%S")}),
 ('date_humanize_hour', '''${humanize(an_hour_ago, now)}''', b'1 hour ago', {'now': now, 'an_hour_ago': (now - timedelta(minutes=65)).strftime("%Y-%m-%d %H:%M:%S")}),
 ('date_humanize_minutes', '''${humanize(minutes_ago, now)}''', b'15 minutes ago', {'now': now, 'minutes_ago': (now - timedelta(minutes=15)).strftime("%Y-%m-%d %H:%M:%S")}),
@@ -54,6 +59,21 @@ helpers = (
 )
 
 
+class LocalMemcache(object):
+    '''A local stand in for a memcached client.'''
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, time=0):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
 class TestTemplate(unittest.TestCase):
     def setUp(self):
         context = pybald.configure(config_file="tests/sample_project/project.py")
@@ -77,6 +97,255 @@ class TestTemplate(unittest.TestCase):
         template = context.render._get_template('sample')
         assert template.render(sample_variable='sample') == b"<h1>Hello sample!</h1>"
 
+    def test_template_lookup_cached(self):
+        '''Resolved templates are memoized, checked again after the interval'''
+        engine = context.render
+        template = engine._get_template('sample')
+        lookups = []
+        get_template = engine.lookup.get_template
+
+        def counting_get_template(uri):
+            lookups.append(uri)
+            return get_template(uri)
+
+        engine.lookup.get_template = counting_get_template
+        engine.check_interval = 60
+        self.assertIs(engine._get_template('sample'), template)
+        self.assertEqual(lookups, [])
+        engine.check_interval = 0
+        self.assertIs(engine._get_template('sample'), template)
+        self.assertEqual(lookups, ['/sample.html.template'])
+        engine.check_interval = None
+        engine._get_template('sample')
+        self.assertEqual(len(lookups), 1)
+
+    def test_raw_template_cached(self):
+        '''Raw templates are compiled once per text and arguments'''
+        cache = context.render.raw_template_cache
+        cache.clear()
+        for name in ('one', 'two'):
+            result = context.render.raw_template(u'Hi ${name}', {'name': name})
+            self.assertEqual(result, u'Hi {0}'.format(name).encode('utf-8'))
+        self.assertEqual(len(cache), 1)
+        context.render.raw_template(u'Hi ${name}', {'name': 'x'},
+                                    default_filters=[])
+        self.assertEqual(len(cache), 2)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+    def test_layered_render_data(self):
+        '''Renders see the page options under the data without copying or
+        changing either'''
+        context.render.raw_template(u'')
+        page_options = pybald.context.config.page_options
+        page_options.update(site=u'pybald', title=u'default')
+        try:
+            data = {'title': u'page'}
+            template = (u'<%def name="bold(text)"><b>${text}</b></%def>'
+                        u'${capture(bold, title) | n} ${site} ${len(pageargs)}')
+            result = context.render.raw_template(template, data)
+            self.assertEqual(result, b'<b>page</b> pybald 1')
+            self.assertEqual(data, {'title': u'page'})
+            result = context.render.raw_template(
+                        u'<%page args="site"/>${site}', {})
+            self.assertEqual(result, b'pybald')
+        finally:
+            page_options.pop('site')
+            page_options.pop('title')
+
+    def test_layered_render_reserved_names(self):
+        '''Reserved names in the render data are still rejected'''
+        with self.assertRaises(NameConflictError):
+            context.render.raw_template(u'hi', {'context': 1})
+
+    def test_partial_fragment_cache(self):
+        '''Cached partials are rendered once per key until invalidated'''
+        render = context.render
+        for value in ('first', 'second'):
+            result = render.partial('sample', cache_key='greeting',
+                                    tags='greetings', sample_variable=value)
+            self.assertEqual(result, u"<h1>Hello first!</h1>")
+        render.fragment_cache.invalidate_tags('greetings')
+        result = render.partial('sample', cache_key='greeting',
+                                sample_variable='third')
+        self.assertEqual(result, u"<h1>Hello third!</h1>")
+        # without a key the partial is always rendered
+        result = render.partial('sample', sample_variable='fourth')
+        self.assertEqual(result, u"<h1>Hello fourth!</h1>")
+
+    def test_partial_fragment_cache_by_template(self):
+        '''Partials of different templates don't share cache keys'''
+        render = context.render
+        result = render.partial('sample', cache_key='person',
+                                sample_variable='Ann')
+        self.assertEqual(result, u"<h1>Hello Ann!</h1>")
+        result = render.partial('farewell', cache_key='person',
+                                sample_variable='Ann')
+        self.assertEqual(result, u"<h1>Goodbye Ann!</h1>")
+
+    def test_memcached_keys(self):
+        '''Keys are hashed into valid memcached keys'''
+        client = LocalMemcache()
+        cache = TaggedCache(MemcachedCache(client))
+        key = u'a key with spaces and caf\xe9 ' * 20
+        cache.set(key, u'value', tags=['some tag'])
+        self.assertEqual(cache.get(key), u'value')
+        for stored_key in client.data:
+            self.assertTrue(len(stored_key) <= 250)
+            self.assertNotIn(u' ', stored_key)
+        cache.delete(key)
+        self.assertIsNone(cache.get(key))
+
+    def test_block_fragment_cache(self):
+        '''Cached Mako blocks are stored in a pluggable fragment cache'''
+        render = context.render
+        render.fragment_cache = TaggedCache(MemcachedCache(LocalMemcache()))
+        calls = []
+
+        def count():
+            calls.append(1)
+            return len(calls)
+        template = (u'<%block name="nav" cached="True" cache_key="nav" '
+                    u'cache_tags="nav, menus">${count()}</%block>|${count()}')
+        self.assertEqual(render.raw_template(template, {'count': count}),
+                         b'1|2')
+        self.assertEqual(render.raw_template(template, {'count': count}),
+                         b'1|3')
+        render.fragment_cache.invalidate_tags('menus')
+        self.assertEqual(render.raw_template(template, {'count': count}),
+                         b'4|5')
+
+    def test_template_stream(self):
+        '''Stream a template, the chunks add up to the full render'''
+        chunks = list(context.render.stream('sample',
+                                            data={'sample_variable': 'sample'},
+                                            chunk_size=4))
+        assert b''.join(chunks) == b"<h1>Hello sample!</h1>"
+        assert len(chunks) > 1
+
+    def test_template_stream_error(self):
+        '''Errors while streaming are raised while iterating'''
+        stream = context.render.stream('sample', data={})
+        with self.assertRaises(NameError):
+            list(stream)
+
+    def test_template_stream_close(self):
+        '''Closing a stream stops the render'''
+        stream = context.render.stream('sample',
+                                       data={'sample_variable': 'x' * 100},
+                                       chunk_size=1)
+        assert next(stream)
+        stream.close()
+        stream.thread.join(5)
+        assert not stream.thread.is_alive()
+        assert list(stream) == []
+
+
+class Nested(object):
+    '''Renders a partial when it's output.'''
+    def __str__(self):
+        return context.render.partial('sample', sample_variable='inner')
+
+
+class TestTemplateProfiling(unittest.TestCase):
+    def setUp(self):
+        pybald.configure(config_object=dict(
+                            template_path='tests/sample_project',
+                            cache_path=None, template_profiling=True,
+                            database_engine_uri=''))
+
+    def tearDown(self):
+        context._reset()
+
+    def test_profile_renders(self):
+        '''Renders are counted and timed by template'''
+        profiler = context.render.profiler
+        for value in ('one', 'two'):
+            context.render('sample', data={'sample_variable': value})
+        stats = profiler.stats()['/sample.html.template']
+        self.assertEqual(stats.count, 2)
+        self.assertEqual(stats.size, 2 * len(b'<h1>Hello one!</h1>'))
+        assert 0 < stats.max <= stats.total
+        self.assertEqual(stats.nested, 0)
+        profiler.reset()
+        self.assertEqual(profiler.stats(), {})
+
+    def test_profile_nested_renders(self):
+        '''Time spent rendering partials is counted as nested time'''
+        profiler = context.render.profiler
+        context.render('sample', data={'sample_variable': Nested()})
+        stats = profiler.stats()['/sample.html.template']
+        self.assertEqual(stats.count, 2)
+        assert 0 < stats.nested < stats.total
+        self.assertEqual([uri for uri, stats in profiler.top(1)],
+                         ['/sample.html.template'])
+
+    def test_profiling_off(self):
+        '''Profiling is off by default'''
+        context._reset()
+        pybald.configure(config_object=dict(template_path='tests/sample_project',
+                                            cache_path=None,
+                                            database_engine_uri=''))
+        self.assertIsNone(context.render.profiler)
+
+
+def replace_js_escape(value):
+    '''The original js_escape, a replace for each escape.'''
+    if value:
+        for bad, good in _js_escapes:
+            value = value.replace(bad, good)
+    return value
+
+
+class TestJsEscape(unittest.TestCase):
+    def samples(self):
+        escaped = u''.join(bad for bad, good in _js_escapes)
+        alphabet = escaped + u'abc xyz\u00e9\u4e2d\U0001F600\\u0000'
+        rand = random.Random(25)
+        samples = [u'', u'plain text', escaped, escaped[::-1],
+                   u''.join(chr(code) for code in range(0x2030)),
+                   json.dumps([{'id': index, 'name': u"<b>'{0}'</b> & co".format(
+                                    index)} for index in range(500)])]
+        samples.extend(u''.join(rand.choice(alphabet)
+                                for _ in range(rand.randint(1, 200)))
+                       for _ in range(500))
+        return samples
+
+    def test_same_as_replace(self):
+        '''js_escape matches the replace based escaper'''
+        for sample in self.samples():
+            self.assertEqual(js_escape(sample), replace_js_escape(sample))
+        for value in (None, u''):
+            self.assertEqual(js_escape(value), value)
+
+    def test_every_escape(self):
+        '''Each character is escaped on its own and next to others'''
+        for bad, good in _js_escapes:
+            self.assertEqual(js_escape(bad), good)
+            self.assertEqual(js_escape(u'a{0}{0}b'.format(bad)),
+                             u'a{0}{0}b'.format(good))
+
+    def test_escape_many(self):
+        '''Escaping many values matches escaping them one at a time'''
+        samples = self.samples()
+        self.assertEqual(js_escape_many(samples),
+                         [replace_js_escape(sample) for sample in samples])
+        # without NULs the values are escaped in one go
+        samples = [sample.replace(u'\x00', u'') for sample in samples]
+        self.assertEqual(js_escape_many(samples),
+                         [replace_js_escape(sample) for sample in samples])
+        self.assertEqual(js_escape_many(iter([u'a<', u'', u'b'])),
+                         [u'a\\u003C', u'', u'b'])
+        self.assertEqual(js_escape_many([]), [])
+
+    def test_escape_many_fallback(self):
+        '''Values with NULs or that aren't text are escaped one by one'''
+        values = [u'a\x00b', u'\x00', u'<', u'\\u0000']
+        self.assertEqual(js_escape_many(values),
+                         [replace_js_escape(value) for value in values])
+        self.assertEqual(js_escape_many([u'<', None, u'']),
+                         [u'\\u003C', None, u''])
+
 
 def create_case(template, expected, data):
     def run_helper(self):
@@ -0,0 +1,231 @@
+import asyncio
+import threading
+import unittest
+from webob import Response
+import pybald
+from pybald import context
+from pybald.core.router import Router
+from pybald.core.controllers import Controller, action
+from pybald.core.asgi import ASGIAdapter, AsyncRouter, run_sync
+from pybald.core.middleware.asgi import AsyncDbMiddleware, AsyncErrorMiddleware
+from pybald.util.context import request_scope_id
+
+
+def map(urls):
+    urls.connect('wait', r'/wait', controller='asgi', action='wait')
+    urls.connect('blocking', r'/blocking', controller='asgi',
+                 action='blocking')
+    urls.connect('scope', r'/scope', controller='asgi', action='scope')
+    urls.connect('echo', r'/echo/{word}', controller='asgi', action='echo',
+                 conditions=dict(method=["POST"]))
+    urls.connect('chunks', r'/chunks', controller='asgi', action='chunks')
+    urls.connect('poll', r'/poll', controller='asgi', action='poll')
+
+
+# what the streaming and long poll actions did
+events = []
+
+
+class AsgiController(Controller):
+    @action
+    async def wait(self, req):
+        await asyncio.sleep(0)
+        return u"waited"
+
+    @action
+    def blocking(self, req):
+        return u"{0}".format(threading.current_thread() is
+                             threading.main_thread())
+
+    @action
+    async def scope(self, req):
+        thread_scope = await run_sync(req.environ, request_scope_id)
+        return u"{0}".format(thread_scope == request_scope_id())
+
+    @action
+    async def echo(self, req):
+        return u"{0} {1} {2}".format(self.word, req.POST['extra'],
+                                     req.headers['X-Sample'])
+
+    @action
+    def chunks(self, req):
+        def generate():
+            try:
+                for index in range(3):
+                    events.append(threading.current_thread() is
+                                  threading.main_thread())
+                    yield u"chunk{0} ".format(index)
+            finally:
+                events.append('closed')
+        return generate()
+
+    @action
+    async def poll(self, req):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            events.append('cancelled')
+            raise
+        return u"polled"
+
+
+def request(app, path, method='GET', body=b'', headers=(), messages=None):
+    scope = {'type': 'http', 'method': method, 'path': path,
+             'query_string': b'', 'headers': list(headers),
+             'server': ('testserver', 80), 'client': ('127.0.0.1', 1234),
+             'scheme': 'http', 'http_version': '1.1', 'root_path': ''}
+    messages = [{'type': 'http.request', 'body': body,
+                 'more_body': False}] + (messages or [])
+    sent = []
+
+    async def receive():
+        if not messages:
+            # like a server, wait until the client goes away
+            await asyncio.Future()
+        message = messages.pop(0)
+        if message['type'] == 'http.disconnect':
+            await asyncio.sleep(0.01)
+        return message
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    if not sent:
+        return None, {}, b''
+    status = sent[0]['status']
+    body = b''.join(message.get('body', b'') for message in sent[1:])
+    return status, dict(sent[0]['headers']), body
+
+
+class TestASGI(unittest.TestCase):
+    def setUp(self):
+        pybald.configure(config_object=dict(debug=False, cache_path=None))
+        router = Router(routes=map, controllers=[AsgiController])
+        self.app = ASGIAdapter(AsyncErrorMiddleware(AsyncRouter(router)),
+                               max_workers=2)
+
+    def tearDown(self):
+        self.app.executor.shutdown()
+        context._reset()
+        del events[:]
+
+    def test_async_action(self):
+        '''Async actions are awaited on the event loop'''
+        status, headers, body = request(self.app, '/wait')
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b'waited')
+
+    def test_sync_action_in_pool(self):
+        '''Synchronous actions run on the thread pool'''
+        status, headers, body = request(self.app, '/blocking')
+        self.assertEqual(body, b'False')
+
+    def test_request_scope_follows_request(self):
+        '''The request scope is the same on the loop and in the pool'''
+        status, headers, body = request(self.app, '/scope')
+        self.assertEqual(body, b'True')
+
+    def test_request_body_and_headers(self):
+        '''Bodies and headers are translated into the WSGI environ'''
+        status, headers, body = request(
+            self.app, '/echo/hello', method='POST', body=b'extra=data',
+            headers=[(b'content-type', b'application/x-www-form-urlencoded'),
+                     (b'x-sample', b'header')])
+        self.assertEqual(body, b'hello data header')
+        self.assertEqual(headers[b'content-type'],
+                         b'text/html; charset=utf-8')
+
+    def test_streamed_body(self):
+        '''Streamed bodies are produced on the pool a chunk at a time'''
+        sent = []
+        original = self.app.send_response
+
+        async def send_response(environ, resp, send, disconnected):
+            async def recording_send(message):
+                sent.append(message)
+                await send(message)
+            await original(environ, resp, recording_send, disconnected)
+        self.app.send_response = send_response
+        status, headers, body = request(self.app, '/chunks')
+        self.assertEqual(body, b'chunk0 chunk1 chunk2 ')
+        # a message per chunk, after the start, and the last empty one
+        self.assertEqual([message.get('body') for message in sent[1:]],
+                         [b'chunk0 ', b'chunk1 ', b'chunk2 ', b''])
+        self.assertEqual(events, [False, False, False, 'closed'])
+
+    def test_disconnect_cancels_request(self):
+        '''Requests are cancelled when the client disconnects'''
+        status, headers, body = request(
+            self.app, '/poll', messages=[{'type': 'http.disconnect'}])
+        self.assertEqual(status, None)
+        self.assertEqual(events, ['cancelled'])
+
+    def test_disconnect_closes_body(self):
+        '''A streamed body is closed if the client goes away mid stream'''
+        def generate():
+            try:
+                yield b'first'
+                yield b'second'
+            finally:
+                events.append('closed')
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        async def stream():
+            disconnected = asyncio.get_event_loop().create_future()
+            disconnected.set_result(None)
+            environ = {'pybald.executor': self.app.executor}
+            await self.app.send_response(environ, Response(app_iter=generate()),
+                                         send, disconnected)
+        asyncio.run(stream())
+        self.assertEqual([message['type'] for message in sent],
+                         ['http.response.start'])
+        self.assertEqual(events, ['closed'])
+
+    def test_not_found(self):
+        '''Missing urls are handled by the async error middleware'''
+        status, headers, body = request(self.app, '/missing')
+        self.assertEqual(status, 404)
+
+    def test_route_metrics(self):
+        '''Async requests are recorded in the router's metrics'''
+        router = Router(routes=map, controllers=[AsgiController],
+                        metrics=True, metrics_path='/metrics')
+        app = ASGIAdapter(AsyncRouter(router), max_workers=2)
+        try:
+            request(app, '/wait')
+            status, headers, body = request(app, '/metrics')
+        finally:
+            app.executor.shutdown()
+        self.assertEqual(router.metrics.snapshot()['wait'].count, 1)
+        self.assertIn(b'pybald_requests_total{route="wait"} 1', body)
+
+    def test_db_middleware_requires_request_scope(self):
+        '''Per thread database sessions can't be used with async requests'''
+        with self.assertRaises(ValueError):
+            AsyncDbMiddleware(self.app)
+        context._reset()
+        pybald.configure(config_object=dict(debug=False, cache_path=None,
+                                            database_request_scope=True))
+        self.assertIs(AsyncDbMiddleware(self.app).application, self.app)
+
+    def test_lifespan_drains_pool(self):
+        '''The lifespan shutdown event shuts down the thread pool'''
+        messages = [{'type': 'lifespan.startup'},
+                    {'type': 'lifespan.shutdown'}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message['type'])
+
+        asyncio.run(self.app({'type': 'lifespan'}, receive, send))
+        self.assertEqual(sent, ['lifespan.startup.complete',
+                                'lifespan.shutdown.complete'])
+        with self.assertRaises(RuntimeError):
+            self.app.executor.submit(int)
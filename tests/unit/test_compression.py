@@ -0,0 +1,114 @@
+import gzip
+import zlib
+import unittest
+from webob import Request, Response
+from pybald.core.middleware.compression import CompressionMiddleware
+
+page = b'<html>' + b'<p>Some repetitive content</p>' * 100 + b'</html>'
+
+
+def html_app(environ, start_response):
+    resp = Response(body=page, content_type='text/html')
+    resp.md5_etag()
+    resp.conditional_response = True
+    return resp(environ, start_response)
+
+
+def item_app(environ, start_response):
+    '''Every item is at the same version, so they share an ETag.'''
+    body = environ['PATH_INFO'].encode('utf-8') * 200
+    resp = Response(body=body, content_type='text/html', etag='v3')
+    return resp(environ, start_response)
+
+
+def image_app(environ, start_response):
+    return Response(body=page, content_type='image/png')(environ,
+                                                         start_response)
+
+
+def streamed_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return (b'line %d\n' % index for index in range(100))
+
+
+class TestCompression(unittest.TestCase):
+    def test_gzip(self):
+        '''Compress with gzip when the client accepts it'''
+        app = CompressionMiddleware(html_app)
+        resp = Request.blank('/', accept_encoding='gzip').get_response(app)
+        self.assertEqual(resp.content_encoding, 'gzip')
+        self.assertEqual(gzip.decompress(resp.body), page)
+        self.assertEqual(resp.content_length, len(resp.body))
+        self.assertIn('Accept-Encoding', resp.vary)
+        self.assertTrue(resp.headers['ETag'].endswith('-gzip"'))
+
+    def test_deflate_preference(self):
+        '''The client's preferences are respected'''
+        app = CompressionMiddleware(html_app)
+        request = Request.blank('/', accept_encoding='gzip;q=0.5, deflate')
+        resp = request.get_response(app)
+        self.assertEqual(resp.content_encoding, 'deflate')
+        self.assertEqual(zlib.decompress(resp.body), page)
+
+    def test_not_accepted(self):
+        '''Clients without Accept-Encoding get the plain body'''
+        app = CompressionMiddleware(html_app)
+        resp = Request.blank('/').get_response(app)
+        self.assertIsNone(resp.content_encoding)
+        self.assertEqual(resp.body, page)
+        self.assertIn('Accept-Encoding', resp.vary)
+
+    def test_min_size_and_content_type(self):
+        '''Small responses and other content types aren't compressed'''
+        app = CompressionMiddleware(html_app, min_size=len(page) + 1)
+        resp = Request.blank('/', accept_encoding='gzip').get_response(app)
+        self.assertIsNone(resp.content_encoding)
+        app = CompressionMiddleware(image_app)
+        resp = Request.blank('/', accept_encoding='gzip').get_response(app)
+        self.assertIsNone(resp.content_encoding)
+
+    def test_cache(self):
+        '''Compressed bodies are cached by ETag'''
+        app = CompressionMiddleware(html_app)
+        for count in range(3):
+            resp = Request.blank('/', accept_encoding='gzip').get_response(app)
+        self.assertEqual(app.cache.misses, 1)
+        self.assertEqual(app.cache.hits, 2)
+
+    def test_conditional(self):
+        '''Compressed ETags still answer If-None-Match'''
+        app = CompressionMiddleware(html_app)
+        resp = Request.blank('/', accept_encoding='gzip').get_response(app)
+        request = Request.blank('/', accept_encoding='gzip',
+                                if_none_match=resp.headers['ETag'])
+        etag = resp.headers['ETag']
+        resp = request.get_response(app)
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.headers['ETag'], etag)
+
+    def test_cache_by_url(self):
+        '''Urls with the same ETag don't share compressed bodies'''
+        app = CompressionMiddleware(item_app)
+        for path in ('/items/1', '/items/2', '/items/2?page=2'):
+            resp = Request.blank(path, accept_encoding='gzip').get_response(app)
+            self.assertEqual(gzip.decompress(resp.body),
+                             path.split('?')[0].encode('utf-8') * 200)
+        self.assertEqual(app.cache.misses, 3)
+
+    def test_head(self):
+        '''HEAD responses keep their Content-Length'''
+        app = CompressionMiddleware(html_app)
+        resp = Request.blank('/', method='HEAD',
+                             accept_encoding='gzip').get_response(app)
+        self.assertEqual(resp.content_length, len(page))
+        self.assertIsNone(resp.content_encoding)
+        self.assertIn('Accept-Encoding', resp.vary)
+
+    def test_streamed(self):
+        '''Streamed responses are compressed as they're sent'''
+        app = CompressionMiddleware(streamed_app)
+        resp = Request.blank('/', accept_encoding='gzip').get_response(app)
+        self.assertEqual(resp.content_encoding, 'gzip')
+        self.assertEqual(gzip.decompress(resp.body),
+                         b''.join(b'line %d\n' % index
+                                  for index in range(100)))
@@ -0,0 +1,91 @@
+import unittest
+from routes import Mapper
+from pybald.core.dispatch import CompiledDispatcher, compile_segments
+
+
+def environ(path, method='GET'):
+    return {'PATH_INFO': path, 'REQUEST_METHOD': method,
+            'HTTP_HOST': 'localhost'}
+
+
+def map(urls):
+    urls.connect('home', r'/', controller='home')
+    urls.connect('about', r'/about', controller='home', action='about')
+    urls.connect('feed', r'/feed{.format}', controller='home', action='feed')
+    urls.connect('user', r'/users/{user_id}', controller='users',
+                 action='show', requirements={'user_id': r'\d+'})
+    urls.connect('user_named', r'/users/{name}', controller='users',
+                 action='named')
+    urls.connect('user_edit', r'/users/{user_id}/edit', controller='users',
+                 action='edit', conditions=dict(method=["GET"]))
+    urls.connect('user_update', r'/users/{user_id}/edit', controller='users',
+                 action='update', conditions=dict(method=["POST"]))
+    urls.connect('slugged', r'/posts/{post_id}-{slug}', controller='posts',
+                 action='show')
+    # wildcards can't be compiled, they span segments
+    urls.connect('files', r'/files/*path', controller='files', action='show')
+    urls.connect('greedy', r'/files/{path:.*}/raw', controller='files',
+                 action='raw')
+    urls.connect('generic', r'/{controller}/{action}/{id}')
+    urls.connect('generic_action', r'/{controller}/{action}')
+    urls.connect('only_even', r'/even/{num}', controller='numbers',
+                 conditions=dict(function=lambda environ, result:
+                                 int(result['num']) % 2 == 0))
+    urls.connect('odd', r'/even/{num}', controller='numbers', action='odd')
+    urls.redirect('/here', '/there', _redirect_code='302 Found')
+
+
+paths = (('/', 'GET'), ('/about', 'GET'), ('/about/', 'GET'),
+         ('/feed', 'GET'), ('/feed.json', 'GET'),
+         ('/users/12', 'GET'), ('/users/bob', 'GET'), ('/users/', 'GET'),
+         ('/users/12/edit', 'GET'), ('/users/12/edit', 'POST'),
+         ('/users/12/edit', 'DELETE'), ('/posts/12-a-title', 'GET'),
+         ('/files/a/b/c.txt', 'GET'), ('/files/a/b/raw', 'GET'),
+         ('/home/index/1', 'GET'), ('/users/list', 'GET'),
+         ('/nothing/here/at/all', 'GET'), ('/even/4', 'GET'),
+         ('/even/5', 'GET'), ('/here', 'GET'), ('relative', 'GET'),
+         ('/caf%C3%A9', 'GET'))
+
+
+class TestCompiledDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.mapper = Mapper(explicit=False)
+        map(self.mapper)
+        self.clist = ['home', 'users', 'posts', 'files', 'numbers']
+        self.mapper.create_regs(self.clist)
+        self.dispatcher = CompiledDispatcher(self.mapper, self.clist)
+
+    def test_same_results_as_mapper(self):
+        '''Compiled matching returns exactly what routematch returns'''
+        for path, method in paths:
+            expected = self.mapper.routematch(environ=environ(path, method))
+            result = self.dispatcher.match(environ=environ(path, method))
+            self.assertEqual(expected, result, (path, method))
+
+    def test_wildcards_fall_back(self):
+        '''Routes that span segments are matched by the fallback list'''
+        names = [route.name for index, route in self.dispatcher.fallback]
+        self.assertEqual(names, ['files', 'greedy'])
+
+    def test_fallback_order_preserved(self):
+        '''An earlier fallback route wins over a later compiled route'''
+        urlvars, route = self.dispatcher.match(
+            environ=environ('/files/a/b/raw'))
+        self.assertEqual(route.name, 'files')
+
+    def test_static_segments(self):
+        '''Fully static routes compile to static segments'''
+        route = self.mapper._routenames['about']
+        self.assertEqual(compile_segments(route, self.clist),
+                         [(True, 'about')])
+
+    def test_disabled_with_prefix(self):
+        '''Mapper prefixes disable compilation and defer to the mapper'''
+        mapper = Mapper(explicit=False)
+        mapper.prefix = '/app'
+        map(mapper)
+        mapper.create_regs(self.clist)
+        dispatcher = CompiledDispatcher(mapper, self.clist)
+        self.assertFalse(dispatcher.enabled)
+        self.assertEqual(dispatcher.match(environ=environ('/app/about')),
+                         mapper.routematch(environ=environ('/app/about')))
@@ -1,3 +1,5 @@
+import gc
+import threading
 import unittest
 import pybald
 from six.moves.urllib.parse import urlencode
@@ -6,6 +8,8 @@ from webob import Request, exc
 
 
 class TestRouter(unittest.TestCase):
+    router_options = {}
+
     def setUp(self):
         pybald.configure(config_object={'debug': False})
         def map(urls):
@@ -20,6 +24,12 @@ class TestRouter(unittest.TestCase):
             urls.connect('test5', r'/test5', controller='test2',
                          action='_iminvalid')
             urls.redirect('/here', '/there', _redirect_code='302 Found')
+            urls.connect('items', r'/items/{item_id}', controller='test1')
+            urls.connect('item_get', r'/methods/{item_id}', controller='test2',
+                         action='get', conditions=dict(method=["GET"]))
+            urls.connect('item_delete', r'/methods/{item_id}',
+                         controller='test2', action='delete',
+                         conditions=dict(method=["DELETE"]))
 
         class Test1Controller(object):
             def index(self, environ, start_response):
@@ -43,7 +53,8 @@ class TestRouter(unittest.TestCase):
                 start_response('200 OK', [('Content-Type','text/plain')])
                 return ["test5_invalid_action"]
 
-        self.app = Router(routes=map, controllers=[Test1Controller, Test2Controller])
+        self.app = Router(routes=map, controllers=[Test1Controller, Test2Controller],
+                          **self.router_options)
 
     def test_controller_match(self):
         '''Request a URL, match a controller'''
@@ -90,9 +101,221 @@ class TestRouter(unittest.TestCase):
         assert r.method != "DELETE"
         assert resp.body == 'test2_get'
 
+    def test_header_method_override(self):
+        '''X-HTTP-Method-Override overrides a POST without reading the body'''
+        r = Request.blank('/method', method="POST",
+                          headers={'X-HTTP-Method-Override': 'delete'},
+                          content_type="application/x-www-form-urlencoded",
+                          body=b'some=data')
+        resp = r.get_response(self.app)
+        assert resp.body == 'test2_delete'
+        assert 'webob._parsed_post_vars' not in r.environ
+
+    def test_not_header_method_override_on_get(self):
+        '''Only POST requests can have their method overridden'''
+        r = Request.blank('/method',
+                          headers={'X-HTTP-Method-Override': 'delete'})
+        resp = r.get_response(self.app)
+        assert resp.body == 'test2_get'
+
+    def test_multipart_not_parsed(self):
+        '''Multipart bodies stream through to the controller unparsed'''
+        r = Request.blank('/test1', POST={'_method': 'delete',
+                                           'upload': ('a.txt', b'data')})
+        assert r.content_type == 'multipart/form-data'
+        r.get_response(self.app)
+        assert r.method == "POST"
+        assert 'webob._parsed_post_vars' not in r.environ
+
+    def test_large_body_not_parsed(self):
+        '''Urlencoded bodies over the limit aren't parsed for _method'''
+        self.app.override_body_limit = 16
+        r = Request.blank('/test1',
+                          content_type="application/x-www-form-urlencoded",
+                          method="POST",
+                          body=urlencode({'_method': 'delete',
+                                          'padding': 'x' * 32}).encode('utf-8'))
+        r.get_response(self.app)
+        assert r.method == "POST"
+        assert 'webob._parsed_post_vars' not in r.environ
+
+    def test_dispatch_table(self):
+        '''Public controller methods are loaded into the dispatch table'''
+        self.assertIn(('test2', 'delete'), self.app.actions)
+        self.assertNotIn(('test2', '_iminvalid'), self.app.actions)
+
+    def test_dispatch_table_shadowed_action(self):
+        '''An instance attribute shadowing an action is still honoured'''
+        def shadowed(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return ["shadowed"]
+
+        class Test6Controller(object):
+            def __init__(self):
+                self.index = shadowed
+
+            def index(self, environ, start_response):
+                return ["unshadowed"]
+
+        self.app.load([Test6Controller])
+        handler = self.app.get_handler({'controller': 'test6',
+                                        'action': 'index'})
+        self.assertIs(handler, shadowed)
+
+    def test_static_routes(self):
+        '''Routes without url variables are loaded into the exact match table'''
+        table = self.app.static_routes
+        self.assertEqual(table[None, '/test1'][0],
+                         {'controller': 'test1', 'action': 'index'})
+        self.assertEqual(table['DELETE', '/method'][0]['action'], 'delete')
+        self.assertNotIn((None, '/method'), table)
+        self.assertNotIn((None, '/here'), table)
+
+    def test_static_route_shadowed(self):
+        '''A static route after a matching route with variables isn't used'''
+        self.app.map.connect('any', r'/{name}', controller='test2',
+                             action='get')
+        self.app.map.connect('late', r'/late', controller='test1')
+        self.app.map.connect('later', r'/later', controller='test1',
+                             conditions=dict(method=["GET"]))
+        resp = Request.blank('/test1').get_response(self.app)
+        assert resp.body == 'test1'
+        resp = Request.blank('/late').get_response(self.app)
+        assert resp.body == 'test2_get'
+        self.assertIsNone(self.app.match_static(Request.blank('/late').environ))
+        self.assertIsNone(
+                       self.app.match_static(Request.blank('/later').environ))
+
     def test_redirect(self):
         '''Fetch '/here' and redirect to '/there' '''
         r = Request.blank('/here')
         resp = r.get_response(self.app)
         assert resp.status_code == 302
         assert resp.headers['location'] == 'http://localhost/there'
+
+
+class TestCompiledRouter(TestRouter):
+    router_options = dict(compile_routes=True)
+
+
+class TestMatchCacheRouter(TestRouter):
+    router_options = dict(match_cache_size=2)
+
+    def test_cache_hits(self):
+        '''Repeated requests are served from the match cache'''
+        for count in range(3):
+            resp = Request.blank('/items/1').get_response(self.app)
+            assert resp.body == 'test1'
+        self.assertEqual(self.app.match_cache.misses, 1)
+        self.assertEqual(self.app.match_cache.hits, 2)
+
+    def test_cache_keyed_on_method(self):
+        '''The same path with different methods is cached separately'''
+        r = Request.blank('/methods/1')
+        assert r.get_response(self.app).body == 'test2_get'
+        r = Request.blank('/methods/1', method="DELETE")
+        assert r.get_response(self.app).body == 'test2_delete'
+        r = Request.blank('/methods/1')
+        assert r.get_response(self.app).body == 'test2_get'
+        self.assertEqual(self.app.match_cache.hits, 1)
+
+    def test_cache_eviction(self):
+        '''The least recently used match is evicted when the cache is full'''
+        for path in ('/items/1', '/items/2', '/methods/1'):
+            Request.blank(path).get_response(self.app)
+        self.assertEqual(len(self.app.match_cache), 2)
+        self.assertNotIn(('GET', 'localhost:80', '/items/1'),
+                         self.app.match_cache)
+
+    def test_cached_urlvars_copied(self):
+        '''Changing urlvars downstream doesn't change the cached match'''
+        first, route = self.app.match(Request.blank('/items/1').environ)
+        first['controller'] = 'changed'
+        second, route = self.app.match(Request.blank('/items/1').environ)
+        self.assertEqual(second['controller'], 'test1')
+
+    def test_cache_invalidated_on_map_change(self):
+        '''Connecting a new route clears the cache'''
+        Request.blank('/items/1').get_response(self.app)
+        self.assertEqual(len(self.app.match_cache), 1)
+        self.app.map.connect('test6', r'/test6/{item_id}', controller='test1')
+        resp = Request.blank('/test6/1').get_response(self.app)
+        assert resp.body == 'test1'
+        self.assertEqual(len(self.app.match_cache), 1)
+
+    def test_function_conditions_not_cached(self):
+        '''Matches that depend on condition functions are never cached'''
+        self.app.map.connect('test7', r'/test7/{item_id}', controller='test1',
+                             conditions=dict(function=lambda environ, result:
+                                             True))
+        Request.blank('/test7/1').get_response(self.app)
+        self.assertEqual(len(self.app.match_cache), 0)
+
+
+class TestMetricsRouter(TestRouter):
+    router_options = dict(metrics=True, metrics_path='/metrics')
+
+    def test_request_counts(self):
+        '''Requests are counted by route name'''
+        for count in range(3):
+            Request.blank('/test1').get_response(self.app)
+        Request.blank('/items/1').get_response(self.app)
+        stats = self.app.metrics.snapshot()
+        self.assertEqual(stats['test1'].count, 3)
+        self.assertEqual(sum(stats['test1'].buckets), 3)
+        self.assertEqual(stats['items'].count, 1)
+        self.assertEqual(stats['test1'].errors, 0)
+
+    def test_unmatched_and_errors(self):
+        '''Missing urls are recorded as unmatched, exceptions as errors'''
+        with self.assertRaises(exc.HTTPNotFound):
+            Request.blank('/nowhere').get_response(self.app)
+
+        def broken(environ, start_response):
+            raise ValueError("broken")
+
+        self.app.get_handler = lambda urlvars: broken
+        with self.assertRaises(ValueError):
+            Request.blank('/test2').get_response(self.app)
+        stats = self.app.metrics.snapshot()
+        self.assertEqual(stats['unmatched'].count, 1)
+        self.assertEqual(stats['unmatched'].errors, 0)
+        self.assertEqual(stats['test2'].errors, 1)
+
+    def test_quantile(self):
+        '''Quantiles are estimated from the histogram buckets'''
+        metrics = self.app.metrics
+        for duration in (0.002,) * 98 + (0.2, 0.2):
+            metrics.record('slow', duration)
+        self.assertTrue(0.001 < metrics.quantile('slow', 0.5) <= 0.0025)
+        self.assertTrue(0.1 < metrics.quantile('slow', 0.99) <= 0.25)
+        self.assertIsNone(metrics.quantile('missing', 0.5))
+
+    def test_thread_tables_retired(self):
+        '''The tables of threads that have ended are merged and dropped'''
+        metrics = self.app.metrics
+
+        def handle():
+            Request.blank('/test1').get_response(self.app)
+        for count in range(20):
+            thread = threading.Thread(target=handle)
+            thread.start()
+            thread.join()
+        gc.collect()
+        self.assertEqual(len(metrics._tables), 0)
+        self.assertEqual(metrics.snapshot()['test1'].count, 20)
+        metrics.reset()
+        self.assertNotIn('test1', metrics.snapshot())
+
+    def test_prometheus_endpoint(self):
+        '''The metrics path serves the Prometheus text format'''
+        Request.blank('/test1').get_response(self.app)
+        resp = Request.blank('/metrics').get_response(self.app)
+        self.assertEqual(resp.content_type, 'text/plain')
+        text = resp.text
+        self.assertIn('pybald_requests_total{route="test1"} 1', text)
+        self.assertIn('pybald_request_duration_seconds_bucket'
+                      '{route="test1",le="+Inf"} 1', text)
+        self.assertIn('pybald_request_duration_seconds_count'
+                      '{route="test1"} 1', text)
+        self.assertNotIn('route="metrics"', text)
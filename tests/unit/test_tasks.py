@@ -0,0 +1,77 @@
+import threading
+import unittest
+import pybald
+from pybald import context
+from pybald.core.controllers import Controller, action
+from pybald.core.tasks import TaskPool, AfterResponseMiddleware
+from webob import Request
+
+
+class TaskController(Controller):
+    done = None
+
+    @action
+    def index(self, req):
+        self._after_response(self.done.append, 'sent')
+        return u"response"
+
+
+class TestTaskPool(unittest.TestCase):
+    def test_run_and_drain(self):
+        '''Queued tasks run and are drained on shutdown'''
+        pool = TaskPool(max_workers=2)
+        done = []
+        for index in range(10):
+            pool.submit(done.append, index)
+        pool.shutdown()
+        self.assertEqual(sorted(done), list(range(10)))
+        stats = pool.stats()
+        self.assertEqual(stats['completed'], 10)
+        self.assertEqual(stats['pending'], 0)
+        self.assertFalse(pool.submit(done.append, 11))
+        self.assertEqual(pool.stats()['rejected'], 1)
+
+    def test_failures_counted(self):
+        '''Failing tasks are counted and don't stop the pool'''
+        pool = TaskPool(max_workers=1)
+        pool.submit(lambda: 1 / 0)
+        pool.shutdown()
+        self.assertEqual(pool.stats()['failed'], 1)
+
+    def test_bounded_queue(self):
+        '''Tasks beyond the queue size are rejected'''
+        pool = TaskPool(max_workers=1, max_queue=1)
+        release = threading.Event()
+        self.assertTrue(pool.submit(release.wait))
+        self.assertFalse(pool.submit(release.wait))
+        release.set()
+        pool.shutdown()
+        self.assertEqual(pool.stats()['rejected'], 1)
+
+
+class TestAfterResponse(unittest.TestCase):
+    def setUp(self):
+        pybald.configure(config_object=dict(env_name="TaskTest"))
+        TaskController.done = []
+
+    def tearDown(self):
+        context._reset()
+
+    def test_after_response(self):
+        '''Tasks registered by an action run on the background pool'''
+        resp = Request.blank('/').get_response(TaskController().index)
+        context.background_tasks.shutdown()
+        self.assertEqual(resp.text, 'response')
+        self.assertEqual(TaskController.done, ['sent'])
+
+    def test_middleware_defers_tasks(self):
+        '''With the middleware, tasks wait until the response is closed'''
+        pool = TaskPool(max_workers=1)
+        app = AfterResponseMiddleware(TaskController().index, pool=pool)
+        environ = Request.blank('/').environ
+        app_iter = app(environ, lambda status, headers, exc_info=None: None)
+        self.assertEqual(b''.join(app_iter), b'response')
+        self.assertEqual(pool.stats()['submitted'], 0)
+        app_iter.close()
+        pool.shutdown()
+        self.assertEqual(TaskController.done, ['sent'])
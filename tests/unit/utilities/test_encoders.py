@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# encoding: utf-8
+import json
+import unittest
+from pybald.util import encoders
+
+
+class TestEncoders(unittest.TestCase):
+    data = {'name': u'caf\xe9', 'values': [1, 2.5, None, True], 1: 'one'}
+
+    def test_stdlib_dumps(self):
+        '''The standard library encoder returns UTF-8 bytes'''
+        result = encoders.stdlib_dumps(self.data)
+        self.assertIsInstance(result, bytes)
+        self.assertEqual(json.loads(result.decode('utf-8')),
+                         json.loads(json.dumps(self.data)))
+
+    @unittest.skipIf(encoders.orjson is None, "orjson is not installed")
+    def test_orjson_dumps(self):
+        '''orjson produces the same JSON as the standard library'''
+        self.assertEqual(json.loads(encoders.orjson_dumps(self.data)),
+                         json.loads(encoders.stdlib_dumps(self.data)))
+
+    def test_json_array(self):
+        '''Iterables are encoded as JSON arrays in chunks'''
+        items = ({'id': index} for index in range(100))
+        chunks = list(encoders.iter_json_array(items, chunk_size=64))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(json.loads(b''.join(chunks).decode('utf-8')),
+                         [{'id': index} for index in range(100)])
+
+    def test_empty_json_array(self):
+        '''An empty iterable is an empty array'''
+        self.assertEqual(b''.join(encoders.iter_json_array([])), b'[]')
+
+    def test_json_array_text_encoder(self):
+        '''Encoders returning text are encoded to UTF-8'''
+        chunks = encoders.iter_json_array([u'caf\xe9'], encoder=json.dumps)
+        self.assertEqual(json.loads(b''.join(chunks).decode('utf-8')),
+                         [u'caf\xe9'])
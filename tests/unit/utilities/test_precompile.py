@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+from pybald.util.precompile import find_templates, precompile_templates
+
+template_args = dict(input_encoding='utf-8', output_encoding='utf-8',
+                     default_filters=['h', 'unicode'])
+
+
+class TestPrecompile(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.templates = os.path.join(self.path, 'views')
+        self.modules = os.path.join(self.path, 'viewscache')
+        os.makedirs(os.path.join(self.templates, 'users'))
+        for name, text in (('home.html.template', u'Hi ${name}'),
+                           ('users/index.html.template', u'${len(users)}'),
+                           ('notes.txt', u'not a template')):
+            with open(os.path.join(self.templates, name), 'w') as f:
+                f.write(text)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_find_templates(self):
+        '''Find every template under the template directories'''
+        self.assertEqual(find_templates([self.templates]),
+                         ['/home.html.template', '/users/index.html.template'])
+
+    def test_precompile(self):
+        '''Compile templates into the module directory'''
+        compiled, errors = precompile_templates([self.templates], self.modules,
+                                                template_args, workers=2)
+        self.assertEqual(sorted(compiled), ['/home.html.template',
+                                            '/users/index.html.template'])
+        self.assertEqual(errors, [])
+        assert os.path.exists(os.path.join(self.modules,
+                                           'users/index.html.template.py'))
+
+    def test_precompile_default_workers(self):
+        '''By default a worker is used per CPU'''
+        compiled, errors = precompile_templates([self.templates], self.modules,
+                                                template_args)
+        self.assertEqual(len(compiled), 2)
+        self.assertEqual(errors, [])
+
+    def test_precompile_errors(self):
+        '''Templates that don't compile are reported'''
+        with open(os.path.join(self.templates, 'broken.html.template'),
+                  'w') as f:
+            f.write(u'% if x:\nunclosed\n')
+        compiled, errors = precompile_templates([self.templates], self.modules,
+                                                template_args, workers=1)
+        self.assertEqual(len(compiled), 2)
+        self.assertEqual([uri for uri, error in errors],
+                         ['/broken.html.template'])
+
+    def test_precompile_needs_cache_path(self):
+        '''Precompiling without a module directory is an error'''
+        with self.assertRaises(ValueError):
+            precompile_templates([self.templates], None, template_args)